@@ -0,0 +1,69 @@
+"""Measures how long it takes to import the parts of the project, each in a
+fresh interpreter, and which hardware stacks (pyvisa, pyserial, pyaudio) get
+pulled in along the way. Importing the scanner, the processing code or the
+simulator should never need any of them.
+
+    python benchmark_imports.py --repeat 5
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+MODULES = [
+    'scanner',
+    'simulation',
+    'microphone',
+    'microphone.oscilloscope',
+    'microphone.microphone',
+    'printer',
+    'printer.printer',
+    'siggen',
+    'instruments',
+]
+HARDWARE_MODULES = ['visa', 'pyvisa', 'serial', 'pyaudio']
+
+PROBE = '''
+import json, sys, time
+start = time.perf_counter()
+error = None
+try:
+    import %s
+except ImportError as err:
+    error = str(err)
+elapsed = time.perf_counter() - start
+print(json.dumps({'seconds': elapsed, 'error': error,
+                  'hardware': [m for m in %r if m in sys.modules]}))
+'''
+
+
+def import_time(module, repeat):
+    """Imports <module> in <repeat> fresh interpreters.
+    @returns (best seconds, hardware modules imported, import error or None)
+    """
+    root = os.path.dirname(os.path.abspath(__file__))
+    results = []
+    for _ in range(repeat):
+        out = subprocess.check_output([sys.executable, '-c', PROBE % (module, HARDWARE_MODULES)],
+                                      cwd=root)
+        results.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    best = min(r['seconds'] for r in results)
+    return best, results[0]['hardware'], results[0]['error']
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3, dest='repeat',
+                        help='fresh interpreters per module, the best time is shown')
+    parser.add_argument('modules', nargs='*', default=MODULES,
+                        help='modules to import, defaults to all of ours')
+    args = parser.parse_args()
+
+    print('%-26s %10s  %s' % ('module', 'ms', 'hardware stacks imported'))
+    for module in args.modules:
+        seconds, hardware, error = import_time(module, args.repeat)
+        note = ', '.join(hardware) or '-'
+        if error:
+            note += ' (failed: %s)' % error
+        print('%-26s %10.1f  %s' % (module, seconds * 1000, note))
@@ -0,0 +1 @@
+from .registry import InstrumentRegistry, default_registry, registry_for
@@ -0,0 +1,186 @@
+"""One place that finds the USB instruments on the VISA bus. The oscilloscope
+and the signal generator used to each enumerate the bus, open every USB
+device, ask it for *IDN? with a fixed sleep and close the ones that weren't
+theirs, so every startup probed everything twice.
+
+The registry enumerates once, asks all unknown devices for their ID at the
+same time (with a read timeout instead of a sleep), and keeps the handles
+open so that whoever asks for an instrument gets the one we already have.
+The resource -> ID mapping is cached on disk, and a cached entry is only
+trusted while its resource is still on the bus, so instruments we have seen
+before don't need to be probed at all.
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+CACHE_DIR = os.path.expanduser('~/.scanning-microphone')
+DEFAULT_CACHE = os.path.join(CACHE_DIR, 'instruments.json')
+# Milliseconds to wait for an *IDN? reply before giving up on a device
+IDN_TIMEOUT = 1000
+PROBE_WORKERS = 8
+
+_default_registry = None
+# Registries of resource managers given to us, by id() of the manager. The
+# registry keeps its manager alive, so the ids can't be reused.
+_registries = {}
+_default_lock = threading.Lock()
+
+
+def is_usb_instrument(resource):
+    """USB instruments have at least 8 colons in their resource name (bad
+    criteria but whatever), which filters out serial ports and the like."""
+    return resource.count(':') >= 8 and 'USB' in resource
+
+
+def default_registry():
+    """The registry shared by everything that isn't given one, using pyvisa's
+    '@py' backend. Created on first use."""
+    global _default_registry
+    with _default_lock:
+        if _default_registry is None:
+            import visa
+            _default_registry = InstrumentRegistry(visa.ResourceManager('@py'))
+        return _default_registry
+
+
+def registry_for(resource_manager=None):
+    """The registry shared by everything using <resource_manager>, so that
+    the oscilloscope and the signal generator on the same bus only enumerate
+    it once. Created on first use, without a disk cache since other managers
+    (like the simulated one) don't keep their resource names. None gives the
+    default registry."""
+    if resource_manager is None:
+        return default_registry()
+    with _default_lock:
+        key = id(resource_manager)
+        if key not in _registries:
+            _registries[key] = InstrumentRegistry(resource_manager, cache_path=None)
+        return _registries[key]
+
+
+class InstrumentRegistry(object):
+    """Identifies the USB instruments on a VISA bus and shares open handles."""
+    def __init__(self, resource_manager, cache_path=DEFAULT_CACHE, timeout=IDN_TIMEOUT):
+        """
+        @param resource_manager: pyvisa ResourceManager, or a
+                                 simulation.SimulatedResourceManager
+        @param cache_path: file to cache the resource -> ID mapping in, None
+                           to always probe
+        @param timeout: milliseconds to wait for a device to answer *IDN?
+        """
+        self.rm = resource_manager
+        self.cache_path = cache_path
+        self.timeout = timeout
+        self._resources = None
+        self._idns = None
+        self._handles = {}
+        self._lock = threading.RLock()
+
+    def resources(self):
+        """USB instruments currently on the bus, enumerated once."""
+        with self._lock:
+            if self._resources is None:
+                self._resources = [r for r in self.rm.list_resources() if is_usb_instrument(r)]
+            return list(self._resources)
+
+    def identify(self):
+        """Returns a dict of resource name -> *IDN? reply for every USB
+        instrument on the bus. Cached IDs are reused for resources that are
+        still connected, the rest are probed in parallel."""
+        with self._lock:
+            if self._idns is not None:
+                return dict(self._idns)
+            live = self.resources()
+            cached = self._load_cache()
+            idns = dict((r, cached[r]) for r in live if r in cached)
+            unknown = [r for r in live if r not in idns]
+            if unknown:
+                with ThreadPoolExecutor(min(PROBE_WORKERS, len(unknown))) as pool:
+                    for resource, (handle, idn) in zip(unknown, pool.map(self._probe, unknown)):
+                        if idn is not None:
+                            idns[resource] = idn
+                            self._handles[resource] = handle
+                self._save_cache(idns)
+            for resource, idn in idns.items():
+                print('Found device %s with ID: %s' % (resource, idn))
+            self._idns = idns
+            return dict(idns)
+
+    def find(self, match):
+        """Opens (or hands back the already open handle of) the first
+        instrument whose ID contains <match>, ignoring case.
+        @returns (resource name, handle, ID)
+        """
+        for resource, idn in sorted(self.identify().items()):
+            if match.lower() in idn.lower():
+                return resource, self.open(resource), idn
+        raise RuntimeError('Could not find a %s instrument, only found %s. Check '
+                           'the connection' % (match, list(self.identify().values())))
+
+    def open(self, resource):
+        """Shared handle to <resource>, opened the first time it is asked for"""
+        with self._lock:
+            if resource not in self._handles:
+                self._handles[resource] = self._open(resource)
+            return self._handles[resource]
+
+    def close(self):
+        with self._lock:
+            for handle in self._handles.values():
+                handle.close()
+            self._handles = {}
+
+    def forget(self):
+        """Throws away the enumeration and the cached IDs, for when
+        instruments were plugged in or swapped while we were running."""
+        with self._lock:
+            self._resources = None
+            self._idns = None
+            if self.cache_path and os.path.exists(self.cache_path):
+                os.remove(self.cache_path)
+
+    def _open(self, resource):
+        handle = self.rm.open_resource(resource)
+        handle.timeout = self.timeout
+        return handle
+
+    def _probe(self, resource):
+        """Asks one device for its ID. Runs in the probe pool, so it must not
+        touch the registry's state.
+        @returns (handle, ID), or (None, None) if the device didn't answer
+        """
+        try:
+            handle = self._open(resource)
+        except Exception as err:
+            print('Could not open %s: %s' % (resource, str(err)))
+            return None, None
+        try:
+            return handle, handle.query('*IDN?').strip()
+        except Exception as err:
+            print('Device %s did not answer *IDN?: %s' % (resource, str(err)))
+            handle.close()
+            return None, None
+
+    def _load_cache(self):
+        if not self.cache_path or not os.path.exists(self.cache_path):
+            return {}
+        try:
+            with open(self.cache_path) as f:
+                return json.load(f)
+        except ValueError:
+            return {}
+
+    def _save_cache(self, idns):
+        if not self.cache_path:
+            return
+        directory = os.path.dirname(self.cache_path)
+        if directory and not os.path.exists(directory):
+            os.makedirs(directory)
+        with open(self.cache_path, 'w') as f:
+            json.dump(idns, f, indent=2, sort_keys=True)
+
+    def __repr__(self):
+        return 'InstrumentRegistry(%d instruments, %d open)' % (
+            len(self._idns or {}), len(self._handles))
@@ -1,2 +1,19 @@
-from .microphone import Microphone
-from .oscilloscope import OscilloscopeMicrophone
+"""Microphone backends. The classes are imported when they are first used, so
+that importing the package (or a module that doesn't need them) doesn't pull
+in pyaudio or pyvisa."""
+import importlib
+
+_EXPORTS = {
+    'Microphone': '.microphone',
+    'OscilloscopeMicrophone': '.oscilloscope',
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
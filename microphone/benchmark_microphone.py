@@ -1,13 +1,28 @@
 """Benchmark our microphone to see exactly how much many samples per
 second we can query until the oscilloscope just returns the exact
 same sequence (due to it not having enough time to actually calculate
-the FFT with the new samples)"""
+the FFT with the new samples)
+
+With --calibrate, sweeps window width, encoding and delay, fits a latency
+model and saves it to a profile that OscilloscopeMicrophone loads to pick its
+delay automatically.
+
+Run it from the top of the repository with
+    python -m microphone.benchmark_microphone --calibrate
+"""
 
 import argparse
 import numpy as np
 import time
-from matplotlib import pyplot as plt
-from oscilloscope import OscilloscopeMicrophone
+from .oscilloscope import OscilloscopeMicrophone, SYNC_ACQUISITION, \
+    ENCODING_ASCII, ENCODING_RIBINARY, ENCODING_FPBINARY
+from .calibration import AcquisitionProfile, DEFAULT_PROFILE, encoding_key, \
+    fit_latency
+
+CALIBRATION_WIDTHS = [10, 200, 1000, 10000]
+CALIBRATION_ENCODINGS = [(ENCODING_ASCII, 2), (ENCODING_RIBINARY, 2),
+                         (ENCODING_FPBINARY, 4)]
+CALIBRATION_DELAYS = [0.5, 0.35, 0.25, 0.18, 0.12, 0.08, 0.05, 0.03, 0.02, 0.01, 0.0]
 
 
 def test_query_with_delay(oscilloscope, begin, end, delay):
@@ -48,28 +63,104 @@ def test_query_with_delay(oscilloscope, begin, end, delay):
     return num_unique >= num_samples - 1
 
 
+def measure_fetch_time(oscilloscope, begin, end, num_frames=10):
+    """Average time (s) of a single FFT fetch of [begin, end), fetching
+    back to back without any delay."""
+    out = oscilloscope._fetch_fft_sample(begin, end)
+    start = time.time()
+    for _ in range(num_frames):
+        oscilloscope._fetch_fft_sample(begin, end, out=out)
+    return (time.time() - start) / num_frames
+
+
+def calibrate(oscilloscope, begin, rig, widths=CALIBRATION_WIDTHS,
+              encodings=CALIBRATION_ENCODINGS, delays=CALIBRATION_DELAYS):
+    """Sweeps window width, encoding and delay and fits the latency model.
+    The refresh interval is the time between two fetches (delay plus fetch
+    time) at the shortest delay that still gives distinct FFTs, taking the
+    worst case over all widths.
+    @returns AcquisitionProfile
+    """
+    profile = AcquisitionProfile(rig)
+    for encoding, byte_width in encodings:
+        oscilloscope.set_encoding(encoding, byte_width)
+        times = [measure_fetch_time(oscilloscope, begin, begin + width) for width in widths]
+        for width, fetch_time in zip(widths, times):
+            print('%-10s %d bytes  %6d bins   %.4f s/fetch' % (encoding, byte_width, width, fetch_time))
+        profile.latency[encoding_key(encoding, byte_width)] = fit_latency(widths, times)
+
+    # Sweep the delay with the fastest encoding, since that is the one that
+    # will get picked when recording
+    encoding, byte_width = profile.fastest_encoding(widths[-1])
+    oscilloscope.set_encoding(encoding, byte_width)
+    refresh_interval = 0.0
+    for width in widths:
+        safe = None
+        for delay in sorted(delays, reverse=True):
+            if not test_query_with_delay(oscilloscope, begin, begin + width, delay):
+                break
+            safe = delay
+        if safe is None:
+            raise RuntimeError('Oscilloscope returned repeated FFTs even with a '
+                               '%s s delay at %d bins' % (max(delays), width))
+        interval = safe + profile.fetch_time(encoding, byte_width, width)
+        print('%6d bins: distinct FFTs down to a %.3f s delay (%.3f s between frames)'
+              % (width, safe, interval))
+        refresh_interval = max(refresh_interval, interval)
+    profile.refresh_interval = refresh_interval
+    return profile
+
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--sample-start', type=int, default=0, dest='start',
                         help='[sample-start, sample-end) query fft')
     parser.add_argument('--sample-end', type=int, default=10000, dest='end',
                         help='[sample-start, sample-end) query fft')
+    parser.add_argument('--acquisition', action='store_true', dest='acquisition',
+                        help='record using the acquisition counter instead of '
+                        'searching for a fixed delay')
+    parser.add_argument('--seconds', type=float, default=10.0, dest='seconds',
+                        help='how long to record for with --acquisition')
+    parser.add_argument('--calibrate', action='store_true', dest='calibrate',
+                        help='measure the latency model of this rig and save '
+                        'it as an acquisition profile')
+    parser.add_argument('--rig', type=str, default='default', dest='rig',
+                        help='name of the rig saved in the profile')
+    parser.add_argument('--profile', type=str, default=DEFAULT_PROFILE, dest='profile',
+                        help='where to save the acquisition profile')
+    parser.add_argument('--simulate', action='store_true', dest='simulate',
+                        help='run against a simulated oscilloscope')
     args = parser.parse_args()
 
-
-    mic = OscilloscopeMicrophone()
+    rm = None
+    if args.simulate:
+        from simulation import simulated_rig
+        rm, _ = simulated_rig(scope_kwargs={'default_latency': 0.002,
+                                            'transfer_rate': 1e6,
+                                            'refresh_interval': 0.05})
+    mic = OscilloscopeMicrophone(profile=None, resource_manager=rm)
     start = args.start
     end = args.end
-    print('Testing Oscilloscope querying from samples %d to %d' % (start, end))
 
-    delay = 0.5
-    for _ in range(10):
-        is_good = test_query_with_delay(mic, start, end, delay)
-        res_str = 'passed' if is_good else 'bad!'
-        print('Delay: %02f s       Result: %s' % (delay, res_str))
-
-        if is_good:
-            delay *= 0.5
-        else:
-            delay *= 2
-    
+    if args.calibrate:
+        profile = calibrate(mic, start, args.rig)
+        profile.save(args.profile)
+        print('Saved %s to %s' % (profile, args.profile))
+    elif args.acquisition:
+        print('Testing Oscilloscope querying from samples %d to %d' % (start, end))
+        frames = mic._record(args.seconds, start, end, sync=SYNC_ACQUISITION)
+        print('Got %d frames' % len(frames))
+        print(mic.last_stats)
+    else:
+        print('Testing Oscilloscope querying from samples %d to %d' % (start, end))
+        delay = 0.5
+        for _ in range(10):
+            is_good = test_query_with_delay(mic, start, end, delay)
+            res_str = 'passed' if is_good else 'bad!'
+            print('Delay: %02f s       Result: %s' % (delay, res_str))
+
+            if is_good:
+                delay *= 0.5
+            else:
+                delay *= 2
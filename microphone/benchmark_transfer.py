@@ -0,0 +1,85 @@
+"""Benchmark how many FFT frames per second we can pull from the oscilloscope
+with each CURVE? encoding. The ASCII transfer has to send every value as text
+and parse it float by float, while the binary encodings send the raw values
+and get scaled on our side, so the difference should grow with the number of
+bins we ask for.
+
+With --host-fft it also compares unique spectra per second between the MATH
+FFT and FFTs computed on the computer from raw CH1 records.
+
+Run it from the top of the repository with
+    python -m microphone.benchmark_transfer --simulate
+"""
+
+import argparse
+import time
+from .oscilloscope import OscilloscopeMicrophone, ENCODING_ASCII, \
+    ENCODING_RIBINARY, ENCODING_FPBINARY, FFT_SCOPE, FFT_HOST, \
+    MIN_RECORD_DELAY_TIME
+
+
+# (encoding, byte width) pairs that we compare against each other
+ENCODINGS = [
+    (ENCODING_ASCII, 2),
+    (ENCODING_RIBINARY, 1),
+    (ENCODING_RIBINARY, 2),
+    (ENCODING_FPBINARY, 4),
+]
+WIDTHS = [10, 200, 10000]
+
+
+def frames_per_second(oscilloscope, begin, end, num_frames):
+    """Fetches <num_frames> FFT frames for the sample range [begin, end) as
+    fast as possible, reusing a single buffer, and returns frames/s."""
+    out = oscilloscope._fetch_fft_sample(begin, end)
+    start = time.time()
+    for _ in range(num_frames):
+        out = oscilloscope._fetch_fft_sample(begin, end, out=out)
+    return num_frames / (time.time() - start)
+
+
+def spectra_per_second(oscilloscope, start_freq, end_freq, seconds):
+    """Records for <seconds> with the shortest delay allowed and returns the
+    number of unique spectra per second covering [start_freq, end_freq]."""
+    begin, end = oscilloscope.frequency_to_samples(start_freq, end_freq)
+    oscilloscope._record(seconds, int(begin), int(end), delay=MIN_RECORD_DELAY_TIME)
+    return oscilloscope.last_stats.frames_per_second
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--frames', type=int, default=20, dest='frames',
+                        help='number of frames to fetch per measurement')
+    parser.add_argument('--sample-start', type=int, default=0, dest='start',
+                        help='first FFT sample of every window')
+    parser.add_argument('--simulate', action='store_true', dest='simulate',
+                        help='benchmark against a simulated oscilloscope')
+    parser.add_argument('--host-fft', action='store_true', dest='host_fft',
+                        help='also compare the MATH FFT against host side FFTs')
+    parser.add_argument('--seconds', type=float, default=5.0, dest='seconds',
+                        help='seconds to record for each --host-fft measurement')
+    args = parser.parse_args()
+
+    rm = None
+    if args.simulate:
+        from simulation import simulated_rig
+        # Roughly what our MDO3014 does over USB
+        rm, _ = simulated_rig(scope_kwargs={'default_latency': 0.002,
+                                            'transfer_rate': 1e6,
+                                            'refresh_interval': 0.01,
+                                            'math_refresh_interval': 0.05})
+    mic = OscilloscopeMicrophone(resource_manager=rm)
+    print('%-10s %5s %8s %10s' % ('encoding', 'bytes', 'bins', 'frames/s'))
+    for encoding, byte_width in ENCODINGS:
+        mic.set_encoding(encoding, byte_width)
+        for width in WIDTHS:
+            fps = frames_per_second(mic, args.start, args.start + width, args.frames)
+            print('%-10s %5d %8d %10.2f' % (encoding, byte_width, width, fps))
+
+    if args.host_fft:
+        mic.set_encoding(ENCODING_RIBINARY, 2)
+        print('\n%-10s %10s' % ('fft', 'spectra/s'))
+        for fft in (FFT_SCOPE, FFT_HOST):
+            mic.fft = fft
+            fps = spectra_per_second(mic, 27000, 29000, args.seconds)
+            print('%-10s %10.2f' % (fft, fps))
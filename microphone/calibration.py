@@ -0,0 +1,102 @@
+"""Acquisition calibration for a particular oscilloscope rig. Running
+benchmark_microphone.py --calibrate measures how long a CURVE? fetch takes
+for each encoding and window width, and how often the oscilloscope actually
+recomputes its FFT. We fit a simple latency model to that
+
+    fetch time = fixed cost + per bin cost * number of bins
+
+and save it along with the minimum refresh interval to a profile file. The
+OscilloscopeMicrophone loads the profile to pick the shortest delay between
+fetches that still gets a new FFT every time.
+"""
+import json
+import os
+import time
+import numpy as np
+
+PROFILE_DIR = os.path.expanduser('~/.scanning-microphone')
+DEFAULT_PROFILE = os.path.join(PROFILE_DIR, 'acquisition.json')
+
+# Extra room on top of the measured refresh interval, since the refresh rate
+# wobbles a bit depending on what else the scope is doing
+REFRESH_MARGIN = 1.1
+# Shortest delay safe_delay hands out. When a fetch takes longer than the
+# refresh interval, the fetch itself is all the wait the scope needs, but a
+# delay of 0 would still break anything that divides by it.
+MIN_SAFE_DELAY = 0.02
+
+
+def encoding_key(encoding, byte_width):
+    return '%s/%d' % (encoding, byte_width)
+
+
+def fit_latency(widths, times):
+    """Least squares fit of fetch times against window widths.
+    @returns (fixed, per_bin) in seconds and seconds per bin
+    """
+    per_bin, fixed = np.polyfit(np.asarray(widths, dtype=float),
+                                np.asarray(times, dtype=float), 1)
+    return max(float(fixed), 0.0), max(float(per_bin), 0.0)
+
+
+class AcquisitionProfile(object):
+    """Latency model for one rig, as measured by the calibration."""
+    def __init__(self, rig='default', latency=None, refresh_interval=None):
+        """
+        @param rig: name of the rig the profile was measured on
+        @param latency: dict of encoding_key(...) -> (fixed, per_bin) seconds
+        @param refresh_interval: shortest time (s) between two distinct FFTs
+        """
+        self.rig = rig
+        self.latency = latency or {}
+        self.refresh_interval = refresh_interval
+
+    def fetch_time(self, encoding, byte_width, bins):
+        """Predicted time (s) for a single fetch of <bins> FFT bins"""
+        key = encoding_key(encoding, byte_width)
+        if key not in self.latency:
+            return None
+        fixed, per_bin = self.latency[key]
+        return fixed + per_bin * bins
+
+    def safe_delay(self, encoding, byte_width, bins, min_delay=MIN_SAFE_DELAY):
+        """Shortest delay to sleep after each fetch so that the next fetch is
+        guaranteed to see a new FFT, but never below <min_delay>. Returns None
+        if the profile doesn't know about this encoding."""
+        fetch_time = self.fetch_time(encoding, byte_width, bins)
+        if fetch_time is None or self.refresh_interval is None:
+            return None
+        return max(self.refresh_interval * REFRESH_MARGIN - fetch_time, min_delay)
+
+    def fastest_encoding(self, bins):
+        """Returns the (encoding, byte_width) with the lowest predicted fetch
+        time for <bins> bins, or None for an empty profile."""
+        if not self.latency:
+            return None
+        key = min(self.latency, key=lambda k: self.latency[k][0] + self.latency[k][1] * bins)
+        encoding, byte_width = key.split('/')
+        return encoding, int(byte_width)
+
+    def save(self, path=DEFAULT_PROFILE):
+        folder = os.path.dirname(path)
+        if folder and not os.path.exists(folder):
+            os.makedirs(folder)
+        with open(path, 'w') as f:
+            json.dump({'rig': self.rig,
+                       'created': time.time(),
+                       'latency': {k: list(v) for k, v in self.latency.items()},
+                       'refresh_interval': self.refresh_interval}, f, indent=2)
+
+    @classmethod
+    def load(cls, path=DEFAULT_PROFILE):
+        """Loads a profile, or returns None if there is no profile file."""
+        if not path or not os.path.exists(path):
+            return None
+        with open(path) as f:
+            data = json.load(f)
+        latency = {k: tuple(v) for k, v in data.get('latency', {}).items()}
+        return cls(data.get('rig', 'default'), latency, data.get('refresh_interval'))
+
+    def __repr__(self):
+        return "AcquisitionProfile(%s, refresh every %s s, %d encodings)" % (
+            self.rig, self.refresh_interval, len(self.latency))
@@ -0,0 +1,154 @@
+"""Background capture for the microphone backends. A capture thread keeps
+fetching frames from the device into a fixed size, preallocated ring buffer,
+stamping every frame with the host's monotonic clock. The main program can
+keep moving the CNC head (or writing out the previous point) and drain the
+frames whenever it wants.
+
+If the main program does not drain often enough the oldest frames are
+overwritten, and the number of lost frames is counted in RingBuffer.overruns.
+
+Frames are numbered by how many were committed before them, so a reader can
+also remember RingBuffer.written, wait() for more frames to come in and take
+a window() of them without draining anything.
+"""
+import threading
+import numpy as np
+
+
+class RingBuffer(object):
+    """Preallocated buffer holding the last <capacity> frames and the time
+    each of them was captured. Frames are written in place, so the writer asks
+    for the next slot, fills it, and then commits it with a timestamp."""
+    def __init__(self, capacity, frame_shape, dtype=np.float64):
+        self.capacity = capacity
+        self.frames = np.empty((capacity,) + tuple(frame_shape), dtype=dtype)
+        self.timestamps = np.empty(capacity, dtype=np.float64)
+        # Total number of frames ever committed and ever drained. The unread
+        # frames are the ones in [read, written).
+        self.written = 0
+        self.read = 0
+        self.overruns = 0
+        self._reserved = False
+        self._lock = threading.Lock()
+        self._committed = threading.Condition(self._lock)
+
+    def slot(self):
+        """Returns the frame that the next commit() will publish. If the
+        buffer is full, the oldest unread frame is dropped to make room."""
+        with self._lock:
+            if not self._reserved and self.written - self.read >= self.capacity:
+                self.read += 1
+                self.overruns += 1
+            self._reserved = True
+            return self.frames[self.written % self.capacity]
+
+    def commit(self, timestamp):
+        """Publishes the frame last returned by slot()."""
+        with self._lock:
+            self.timestamps[self.written % self.capacity] = timestamp
+            self.written += 1
+            self._reserved = False
+            self._committed.notify_all()
+
+    def append(self, frame, timestamp):
+        self.slot()[...] = frame
+        self.commit(timestamp)
+
+    def drain(self, stop=None):
+        """Removes and returns all unread frames, oldest first.
+        @param stop: only drain up to (not including) frame number <stop>
+        @returns (timestamps, frames) numpy arrays with the same first dimension
+        """
+        with self._lock:
+            start = self.read
+            end = self.written if stop is None else max(min(stop, self.written), start)
+            idx = np.arange(start, end) % self.capacity
+            timestamps = self.timestamps[idx]
+            frames = self.frames[idx]
+            self.read = end
+        return timestamps, frames
+
+    def skip(self):
+        """Marks every unread frame as read, so the next drain() only returns
+        frames committed from now on."""
+        with self._lock:
+            self.read = self.written
+            self.overruns = 0
+
+    def wait(self, count, timeout=None):
+        """Blocks until at least <count> frames have ever been committed.
+        @returns (bool) False if we timed out first
+        """
+        with self._lock:
+            return self._committed.wait_for(lambda: self.written >= count, timeout)
+
+    def window(self, start, stop):
+        """Returns frames number [start, stop) without draining them. When the
+        frames don't wrap around the end of the buffer this is a view, not a
+        copy, and only stays valid until the writer comes around again, so
+        copy it if you want to keep it longer than <capacity> frames.
+        @returns (timestamps, frames) like drain()
+        """
+        with self._lock:
+            oldest = self.written - self.capacity + (1 if self._reserved else 0)
+            if start < oldest or stop > self.written or start > stop:
+                raise IndexError('Frames [%d, %d) are not in the buffer, which holds '
+                                 '[%d, %d)' % (start, stop, max(oldest, 0), self.written))
+            first = start % self.capacity
+            if first + (stop - start) <= self.capacity:
+                return (self.timestamps[first:first + stop - start],
+                        self.frames[first:first + stop - start])
+            idx = np.arange(start, stop) % self.capacity
+            return self.timestamps[idx], self.frames[idx]
+
+    def __len__(self):
+        return self.written - self.read
+
+
+class CaptureThread(object):
+    """Calls <step> over and over in a background thread until stopped. Each
+    call gets the next slot of <buffer> to fill in place, and returns the
+    monotonic time the frame was captured, or None if nothing was captured
+    (in which case the slot is not published)."""
+    def __init__(self, buffer, step):
+        self.buffer = buffer
+        self.step = step
+        self.error = None
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self.running:
+            raise RuntimeError('Capture is already running')
+        self._stop.clear()
+        self.error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Asks the thread to stop and waits for the frame in flight."""
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout)
+            self._thread = None
+        if self.error is not None:
+            raise RuntimeError('Capture thread died: %s' % str(self.error))
+
+    def sleep(self, seconds):
+        """Sleeps for <seconds>, waking up early if we are asked to stop."""
+        self._stop.wait(seconds)
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive()
+
+    def _run(self):
+        while not self._stop.is_set():
+            try:
+                timestamp = self.step(self.buffer.slot())
+            except Exception as err:
+                self.error = err
+                return
+            if timestamp is not None:
+                self.buffer.commit(timestamp)
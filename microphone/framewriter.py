@@ -0,0 +1,101 @@
+"""Streaming writer for recordings. Frames are appended to an open .npy file
+as they come in instead of being collected in a list and dumped at the end, so
+memory use doesn't grow with the length of the recording, and a crash only
+loses the frames since the last flush.
+
+Every flush rewrites the row count in the .npy header (which is padded to a
+fixed size for this), so the file can be opened with np.load at any point,
+even while it is still being written or after the program died.
+"""
+import os
+import struct
+import time
+import numpy as np
+
+NPY_MAGIC = b'\x93NUMPY\x01\x00'
+# Fixed header size (bytes), big enough for any shape we could write
+NPY_HEADER_SIZE = 256
+FLUSH_INTERVAL = 1.0
+BUFFER_FRAMES = 64
+
+
+class FrameWriter(object):
+    """Appends equally shaped frames to a .npy file. The frame shape is taken
+    from the first frame appended."""
+    def __init__(self, fname, dtype=np.float64, buffer_frames=BUFFER_FRAMES,
+                 flush_interval=FLUSH_INTERVAL):
+        """
+        @param fname: file to write, including the .npy extension
+        @param dtype: dtype the frames are stored as
+        @param buffer_frames: frames kept in memory before they are written
+        @param flush_interval: seconds between flushes to disk
+        """
+        self.fname = fname
+        self.dtype = np.dtype(dtype)
+        self.buffer_frames = buffer_frames
+        self.flush_interval = flush_interval
+        self.count = 0
+        self.frame_shape = None
+        self._buffer = None
+        self._buffered = 0
+        self._last_flush = time.time()
+        self._f = open(fname, 'wb')
+        self._write_header()
+
+    def append(self, frame):
+        frame = np.asarray(frame)
+        if self._buffer is None:
+            self.frame_shape = frame.shape
+            self._buffer = np.empty((self.buffer_frames,) + frame.shape, dtype=self.dtype)
+        elif frame.shape != self.frame_shape:
+            raise ValueError('Frame of shape %s does not match shape %s of the '
+                             'earlier frames' % (frame.shape, self.frame_shape))
+        self._buffer[self._buffered] = frame
+        self._buffered += 1
+        if self._buffered == self.buffer_frames:
+            self._write_buffer()
+        if time.time() - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        """Writes out the buffered frames and updates the header, so that
+        everything appended so far survives a crash."""
+        self._write_buffer()
+        self._write_header()
+        self._f.flush()
+        os.fsync(self._f.fileno())
+        self._last_flush = time.time()
+
+    def close(self):
+        if self._f.closed:
+            return
+        self.flush()
+        self._f.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def _write_buffer(self):
+        if self._buffered:
+            self._f.write(self._buffer[:self._buffered].tobytes())
+            self.count += self._buffered
+            self._buffered = 0
+
+    def _write_header(self):
+        shape = (self.count,) + tuple(self.frame_shape or ())
+        header = "{'descr': %r, 'fortran_order': False, 'shape': %r, }" % (
+            self.dtype.str, shape)
+        header_len = NPY_HEADER_SIZE - len(NPY_MAGIC) - 2
+        header = header.ljust(header_len - 1) + '\n'
+        position = self._f.tell()
+        self._f.seek(0)
+        self._f.write(NPY_MAGIC + struct.pack('<H', header_len) + header.encode('latin1'))
+        if position > NPY_HEADER_SIZE:
+            self._f.seek(position)
+
+    def __repr__(self):
+        return "FrameWriter(%s, %d frames)" % (self.fname, self.count + self._buffered)
+
@@ -0,0 +1,57 @@
+"""Amplitudes of a handful of target frequencies, computed for every block of
+audio as it comes in. For a point scan we only care about how loud the drive
+tone is, so instead of saving the whole waveform and running an STFT over it
+afterwards, we keep a few numbers per block.
+
+This is the Goertzel algorithm's result (a single DFT bin at an arbitrary
+frequency) but evaluated as a dot product of the windowed block with
+precomputed complex exponentials, which numpy does much faster than running
+the Goertzel recursion sample by sample in Python.
+"""
+import numpy as np
+
+# int16 samples are scaled to [-1, 1), like librosa.load does
+INT16_SCALE = 1.0 / 32768
+
+
+class Goertzel(object):
+    """Computes the RMS amplitude of each target frequency in blocks of
+    <block_size> samples."""
+    def __init__(self, frequencies, sample_rate, block_size, window='hann'):
+        """
+        @param frequencies: list of target frequencies in Hz
+        @param sample_rate: samples per second of the audio
+        @param block_size: number of samples in every block
+        @param window: 'hann' to match the librosa STFT we used to compute,
+                       or 'rectangular' for the plain Goertzel filter
+        """
+        self.frequencies = np.asarray(frequencies, dtype=np.float64)
+        if np.any(self.frequencies >= sample_rate / 2.0):
+            raise ValueError('Target frequencies must be below the Nyquist '
+                             'frequency of %s Hz' % (sample_rate / 2.0))
+        self.sample_rate = sample_rate
+        self.block_size = block_size
+        window = np.hanning(block_size) if window == 'hann' else np.ones(block_size)
+        n = np.arange(block_size)
+        # (block_size, num_frequencies) windowed DFT basis
+        self.basis = window[:, None] * np.exp(
+            -2j * np.pi * n[:, None] * self.frequencies[None, :] / sample_rate)
+        self.scale = 2.0 / window.sum() / np.sqrt(2)
+
+    def amplitudes(self, blocks, out=None):
+        """RMS amplitude of every target frequency in every block.
+        @param blocks: one block, or an array of blocks with dimensions
+                       (num_blocks, block_size), of int16 or float samples
+        @param out: optional preallocated float array for the result
+        @returns array with dimensions (num_frequencies,) for a single block,
+                 or (num_blocks, num_frequencies)
+        """
+        blocks = np.asarray(blocks)
+        scale = self.scale * (INT16_SCALE if blocks.dtype == np.int16 else 1.0)
+        result = np.abs(np.dot(blocks, self.basis))
+        if out is None:
+            out = result
+        else:
+            out[...] = result
+        out *= scale
+        return out
@@ -0,0 +1,83 @@
+"""FFTs of raw oscilloscope waveforms computed on the computer instead of by
+the oscilloscope's MATH channel. This lets us pick the resolution and window
+ourselves, average several segments of a record together (Welch's method)
+and only keep the bins we care about.
+
+The spectra are amplitude corrected so that a sine wave with an RMS voltage
+of A shows up as a peak of height A, same as the oscilloscope FFT in linear
+RMS mode.
+"""
+import numpy as np
+
+WINDOWS = {
+    'hann': np.hanning,
+    'hamming': np.hamming,
+    'blackman': np.blackman,
+    'rectangular': np.ones,
+}
+
+
+class HostFFT(object):
+    """Turns waveform records of a fixed length into magnitude spectra."""
+    def __init__(self, sample_interval, record_length, segments=1, window='hann'):
+        """
+        @param sample_interval: seconds between waveform points
+        @param record_length: number of points in every waveform record
+        @param segments: number of 50% overlapping segments to average. 1
+                         transforms the whole record at once, more segments
+                         give a smoother spectrum at a coarser resolution.
+        @param window: name of the window applied to each segment
+        """
+        if window not in WINDOWS:
+            raise ValueError('Unknown window %s, choose from %s' % (window, list(WINDOWS)))
+        self.sample_interval = sample_interval
+        self.record_length = record_length
+        self.segments = segments
+        # With 50% overlap, <segments> segments of length L span (segments + 1) * L / 2
+        self.segment_length = int(2 * record_length / (segments + 1)) if segments > 1 else record_length
+        self.step = self.segment_length // 2 if segments > 1 else record_length
+        self.window = WINDOWS[window](self.segment_length)
+        self.scale = 2.0 / self.window.sum() / np.sqrt(2)
+        self.num_bins = self.segment_length // 2 + 1
+
+    @property
+    def bin_width(self):
+        """Hz per FFT bin"""
+        return 1.0 / (self.segment_length * self.sample_interval)
+
+    def frequency_to_bins(self, start_freq, end_freq):
+        """Smallest range of bins [start, end) that encloses the frequencies"""
+        return (int(np.floor(start_freq / self.bin_width)),
+                int(np.ceil(end_freq / self.bin_width)) + 1)
+
+    def bins(self, sample_start=0, sample_end=None):
+        """Clips the bin range [sample_start, sample_end) to the bins the
+        spectrum has, since the default 0 to 10000 of the oscilloscope FFT
+        is more than a record of 10000 points gives us.
+        @returns (sample_start, sample_end) that spectrum() returns bins for
+        """
+        sample_end = self.num_bins if sample_end is None else min(sample_end, self.num_bins)
+        if not 0 <= sample_start < sample_end:
+            raise ValueError('Bins %s to %s are outside the %d bins of the spectrum'
+                             % (sample_start, sample_end, self.num_bins))
+        return sample_start, sample_end
+
+    def spectrum(self, waveform, sample_start=0, sample_end=None, out=None):
+        """Magnitude spectrum of one waveform record, restricted to the bins
+        [sample_start, sample_end), clipped like bins().
+        @param waveform: record of <record_length> points in volts
+        @param out: optional preallocated array for the result
+        """
+        sample_start, sample_end = self.bins(sample_start, sample_end)
+        segments = np.lib.stride_tricks.as_strided(
+            waveform, shape=(self.segments, self.segment_length),
+            strides=(waveform.strides[0] * self.step, waveform.strides[0]),
+            writeable=False)
+        spectra = np.fft.rfft(segments * self.window, axis=1)[:, sample_start:sample_end]
+        # Welch: average the power of the segments, then go back to amplitude
+        power = (spectra.real ** 2 + spectra.imag ** 2).mean(axis=0)
+        if out is None:
+            out = np.empty(sample_end - sample_start)
+        np.sqrt(power, out=out)
+        out *= self.scale
+        return out
@@ -3,14 +3,41 @@ Different parameters may need to be set depending on the type of microphone
 used. For our first test of the scanning microphone, we used a microphone from
 Science Center 102 that plugs into the microphone jack in a desktop computer.
 """
+import contextlib
 import pyaudio
 import numpy as np
+import time
 import wave
+from .capture import RingBuffer
+from .framewriter import FrameWriter, FLUSH_INTERVAL
+from .goertzel import Goertzel
+
+# Seconds of audio the ring buffer behind the input stream can hold before the
+# oldest chunks start getting overwritten.
+CAPTURE_SECONDS = 60.0
+# Extra seconds _record waits for the soundcard before giving up
+RECORD_TIMEOUT = 2.0
 
 
 class Microphone(object):
-    """Class that manages microphone life and settings."""
-    def __init__(self):
+    """Class that manages microphone life and settings. The input stream is
+    opened once, in callback mode, and keeps writing chunks into a ring buffer
+    until close() is called, so recording a point doesn't have to open a new
+    stream and no audio is lost between points.
+
+    With target frequencies, the amplitude of each of them is also computed
+    for every chunk as it comes in (see goertzel.py), and record_to_file saves
+    just those instead of the audio."""
+    def __init__(self, buffer_seconds=CAPTURE_SECONDS, target_frequencies=None,
+                 keep_raw=False):
+        """
+        @param buffer_seconds: seconds of audio kept in the ring buffer. Point
+                               recordings can't be longer than this.
+        @param target_frequencies: list of frequencies (Hz) to track the
+                                   amplitudes of, None to only record audio
+        @param keep_raw: with target frequencies, still save the audio as a
+                         .wav next to the amplitudes
+        """
         # Takes the default microphone detected for now
         # TODO: Make a parameter that selects which microphone to use
         p = pyaudio.PyAudio()
@@ -26,35 +53,199 @@ class Microphone(object):
         self.FRAMES_PER_BUFF = 2048
         self.FORMAT = pyaudio.paInt16
         self.CHANNELS = 1
-        
-    def _record(self, n):
-        """Records for n seconds, while blocking. Only returns control after
-        recording is finished. Returns as sequence of chunks of 2 byte values.
+        self.buffer_seconds = buffer_seconds
+        self.keep_raw = keep_raw
+        self.goertzel = None
+        if target_frequencies is not None:
+            self.goertzel = Goertzel(target_frequencies, self.SR,
+                                     self.FRAMES_PER_BUFF * self.CHANNELS)
+        self._bands = None
+        self.input_overflows = 0
+        self._buffer = None
+        self._stream = None
+        self._capture_stop = None
+
+    def open(self):
+        """Starts the persistent input stream if it isn't running yet.
+        @returns (RingBuffer) the buffer the stream writes chunks into
         """
-        stream = self._p.open(format=self.FORMAT,
-                              channels=self.CHANNELS,
-                              rate=int(self.SR),
-                              input=True,
-                              frames_per_buffer=self.FRAMES_PER_BUFF)
+        if self._stream is not None:
+            return self._buffer
+        nchunks = max(1, int(self.buffer_seconds * self.SR / self.FRAMES_PER_BUFF))
+        self._buffer = RingBuffer(nchunks, (self.FRAMES_PER_BUFF * self.CHANNELS,),
+                                  dtype=np.int16)
+        if self.goertzel is not None:
+            self._bands = RingBuffer(nchunks, self.goertzel.frequencies.shape)
+        self._stream = self._p.open(format=self.FORMAT,
+                                    channels=self.CHANNELS,
+                                    rate=int(self.SR),
+                                    input=True,
+                                    frames_per_buffer=self.FRAMES_PER_BUFF,
+                                    stream_callback=self._callback)
+        self._stream.start_stream()
+        return self._buffer
+
+    def close(self):
+        """Stops the input stream. Chunks already in the ring buffer stay
+        available through drain()."""
+        if self._stream is not None:
+            self._stream.stop_stream()
+            self._stream.close()
+            self._stream = None
+
+    def _callback(self, in_data, frame_count, time_info, status):
+        """Called by PortAudio from its own thread for every chunk. Each chunk
+        is stamped with the monotonic host time at which it finished
+        recording. The band amplitudes go in before the audio, so whoever
+        waits on the audio buffer can count on them being there too."""
+        timestamp = time.monotonic()
+        if status & pyaudio.paInputOverflow:
+            self.input_overflows += 1
+        chunk = np.frombuffer(in_data, dtype=np.int16)
+        if self._bands is not None:
+            self.goertzel.amplitudes(chunk, out=self._bands.slot())
+            self._bands.commit(timestamp)
+        self._buffer.append(chunk, timestamp)
+        return None, pyaudio.paContinue
+
+    def _chunk_numbers(self, n):
+        """Yields the numbers of the chunks making up the next n seconds of
+        audio, each as soon as it is in the ring buffer."""
+        buf = self.open()
         nchunks = int(n * self.SR / self.FRAMES_PER_BUFF)
-        frames = []
-        for _ in range(nchunks):
-            data = stream.read(self.FRAMES_PER_BUFF)
-            frames.append(data)
-        stream.stop_stream()
-        stream.close()
-        return frames
-    
-    def record_to_file(self, n, fname):
-        # add an extension for wav, since other microphone implementations
-        # may save the file in a different format (for example oscilloscope)
-        fname = fname + '.wav'
-        frames = self._record(n)
+        chunk_time = self.FRAMES_PER_BUFF / self.SR
+        start = buf.written
+        for idx in range(start, start + nchunks):
+            if not buf.wait(idx + 1, chunk_time + RECORD_TIMEOUT):
+                raise RuntimeError('Microphone stopped sending audio')
+            yield idx
+
+    def _record(self, n, sink=None):
+        """Records for n seconds, while blocking. Only returns control after
+        recording is finished. Returns the chunks as an int16 array with
+        dimensions (num_chunks, FRAMES_PER_BUFF * CHANNELS), or passes each
+        chunk to sink(chunk) as soon as it comes in if a sink is given (and
+        returns nothing).
+
+        The returned array is a view into the ring buffer when it doesn't wrap
+        around, so it gets overwritten after another buffer_seconds of audio.
+        Copy it if it has to live longer than that.
+        """
+        return self._record_buffer(n, self.open(), sink)
+
+    def record_bands(self, n, sink=None):
+        """Same as _record, but for the amplitudes of the target frequencies.
+        @returns array with dimensions (num_chunks, num_frequencies)
+        """
+        if self.goertzel is None:
+            raise RuntimeError('Microphone has no target frequencies')
+        self.open()
+        return self._record_buffer(n, self._bands, sink)
+
+    def _record_buffer(self, n, buf, sink):
+        """_record for either of the ring buffers, which get chunks with the
+        same numbers at the same time."""
+        if sink is None:
+            if int(n * self.SR / self.FRAMES_PER_BUFF) > buf.capacity:
+                raise ValueError('Cannot record %s s with a %s s buffer, use '
+                                 'record_to_file instead' % (n, self.buffer_seconds))
+            numbers = list(self._chunk_numbers(n))
+            if not numbers:
+                return buf.frames[:0]
+            return buf.window(numbers[0], numbers[-1] + 1)[1]
+        for idx in self._chunk_numbers(n):
+            sink(buf.window(idx, idx + 1)[1][0])
+
+    def start_capture(self, seconds=None):
+        """Starts collecting audio for drain(). Audio is always flowing into
+        the ring buffer, so this only forgets what came in before now; chunks
+        are stamped with the monotonic host time at which they finished
+        recording. Call drain() at least every buffer_seconds, and
+        stop_capture() when done.
+        @param seconds: make sure the ring buffer holds at least this many
+                        seconds, reopening the stream if it has to grow
+        """
+        if seconds is not None and seconds > self.buffer_seconds:
+            self.close()
+            self.buffer_seconds = seconds
+        self.open().skip()
+        self._capture_stop = None
+
+    def stop_capture(self):
+        """Ends the capture. Chunks up to now stay available through drain(),
+        the stream itself keeps running for the next recording."""
+        if self._buffer is not None:
+            self._capture_stop = self._buffer.written
+
+    def drain(self):
+        """Returns every chunk captured since the last drain.
+        @returns (timestamps, chunks) where timestamps are time.monotonic()
+                 values and chunks is an int16 array with dimensions
+                 (num_chunks, FRAMES_PER_BUFF * CHANNELS)
+        """
+        if self._buffer is None:
+            raise RuntimeError('Microphone has not started capturing')
+        return self._buffer.drain(self._capture_stop)
+
+    def default_delay(self, sample_start=None, sample_end=None):
+        """Seconds between two chunks of audio, the soundcard's equivalent of
+        the oscilloscope's delay between fetches. Scans use it to guess how
+        many frames a line gets."""
+        return self.FRAMES_PER_BUFF / self.SR
+
+    def record_to_file(self, n, fname, flush_interval=FLUSH_INTERVAL, delay=None,
+                       sample_start=None, sample_end=None):
+        """Records n seconds of audio into <fname>.wav. Chunks are written as
+        they are read (the wave module keeps the header up to date) and the
+        file is flushed every <flush_interval> seconds, so long recordings
+        don't pile up in memory and a crash keeps what was flushed.
+
+        With target frequencies, the amplitudes go to <fname>.npy instead, with
+        dimensions (num_chunks, num_frequencies), and the monotonic time of
+        every chunk to <fname>.times.npy. The .wav is then only written if
+        keep_raw is set.
+
+        delay, sample_start and sample_end are only there so that scans can
+        call this the same way as OscilloscopeMicrophone.record_to_file, the
+        soundcard always records every chunk of the whole spectrum."""
+        with contextlib.ExitStack() as stack:
+            sinks = []
+            if self.goertzel is None or self.keep_raw:
+                # add an extension for wav, since other microphone implementations
+                # may save the file in a different format (for example oscilloscope)
+                sinks.append(self._wav_sink(stack, fname + '.wav', flush_interval))
+            if self.goertzel is not None:
+                writer = stack.enter_context(
+                    FrameWriter(fname + '.npy', flush_interval=flush_interval))
+                times_writer = stack.enter_context(
+                    FrameWriter(fname + '.times.npy', flush_interval=flush_interval))
+
+                def band_sink(idx):
+                    timestamps, bands = self._bands.window(idx, idx + 1)
+                    writer.append(bands[0])
+                    times_writer.append(timestamps[0])
+
+                sinks.append(band_sink)
+            for idx in self._chunk_numbers(n):
+                for sink in sinks:
+                    sink(idx)
+
+    def _wav_sink(self, stack, fname, flush_interval):
+        """Opens <fname> as a wave file that is closed with <stack>, and
+        returns a function writing chunk number idx of the audio into it."""
+        f = stack.enter_context(open(fname, 'wb'))
         # Save it to an actual file with proper parameters
-        wavefile = wave.open(fname, 'wb')
+        wavefile = wave.open(f, 'wb')
+        stack.callback(wavefile.close)
         wavefile.setnchannels(self.CHANNELS)
         wavefile.setsampwidth(self._p.get_sample_size(self.FORMAT))
         wavefile.setframerate(self.SR)
-        for frame in frames:
-            wavefile.writeframes(frame)
-        wavefile.close()
+        last_flush = [time.time()]
+
+        def sink(idx):
+            wavefile.writeframes(self._buffer.window(idx, idx + 1)[1][0])
+            if time.time() - last_flush[0] >= flush_interval:
+                f.flush()
+                last_flush[0] = time.time()
+
+        return sink
@@ -5,10 +5,16 @@ order to make it easy to switch between the two.
 Some of the command we use to interface with the oscilloscope can be found
 https://download.tek.com/manual/MDO4000-B-MSO-DPO4000B-and-MDO3000-Oscilloscope-Programmer-Manual-Rev-A.pdf
 """
-import visa
+import collections
 import time
 import numpy as np
 import pickle
+from concurrent.futures import ThreadPoolExecutor
+from .capture import RingBuffer, CaptureThread
+from .calibration import AcquisitionProfile, DEFAULT_PROFILE
+from .framewriter import FrameWriter
+from .hostfft import HostFFT
+from instruments import registry_for
 
 # When we query the oscilloscope, it freezes the oscilloscope. Then, the scope
 # has to get new samples to perform the FFT. Therefore, we have to wait until
@@ -17,48 +23,290 @@ import pickle
 # RECORD_DELAY_TIME = 0.40
 RECORD_DELAY_TIME = 0.50
 
+# Bounds for the delay between fetches when _record adapts it. Every time the
+# scope hands us the same FFT twice the delay backs off by DELAY_BACKOFF, and
+# every fresh FFT shrinks it by DELAY_SPEEDUP, so it settles just above the
+# scope's refresh interval.
+MIN_RECORD_DELAY_TIME = 0.02
+MAX_RECORD_DELAY_TIME = 1.0
+DELAY_BACKOFF = 1.5
+DELAY_SPEEDUP = 0.9
+
+# Encodings we can ask CURVE? to use. ASCII is human readable but has to be
+# parsed float by float, so a full 10000 bin FFT is tens of kilobytes of text.
+# The binary encodings send the raw values and we scale them ourselves using
+# the waveform preamble.
+ENCODING_ASCII = 'ascii'
+ENCODING_RIBINARY = 'ribinary'
+ENCODING_FPBINARY = 'fpbinary'
+
+# struct format characters used by pyvisa for each binary format and width
+BINARY_DATATYPES = {
+    (ENCODING_RIBINARY, 1): 'b',
+    (ENCODING_RIBINARY, 2): 'h',
+    (ENCODING_RIBINARY, 4): 'i',
+    (ENCODING_FPBINARY, 4): 'f',
+}
+
+# How _record decides when to fetch the next frame. SYNC_DELAY sleeps a fixed
+# delay after every fetch, SYNC_ACQUISITION polls the acquisition counter and
+# fetches as soon as the scope has acquired (and computed the FFT of) a new
+# waveform.
+SYNC_DELAY = 'delay'
+SYNC_ACQUISITION = 'acquisition'
+ACQUISITION_POLL_TIME = 0.005
+ACQUISITION_TIMEOUT = 2.0
+
+# Number of frames the background capture ring buffer can hold before the
+# oldest undrained frames start getting overwritten.
+CAPTURE_CAPACITY = 4096
+
+# Where the FFT gets computed. FFT_SCOPE reads the scope's MATH channel, whose
+# refresh rate caps how many frames per second we get. FFT_HOST pulls the raw
+# CH1 waveform records instead and computes the FFT on the computer (see
+# hostfft.py), in FFT_WORKERS threads so the next transfer can start while the
+# last record is still being transformed.
+FFT_SCOPE = 'scope'
+FFT_HOST = 'host'
+FFT_WORKERS = 2
+WAVEFORM_SOURCE = 'CH1'
+# Asking for more points than the record has gets us the whole record
+WAVEFORM_MAX_POINTS = 10000000
+
+# Settings that every CURVE? transfer depends on. If any of these change, the
+# waveform preamble (scale and offset of the curve) has to be queried again.
+PREAMBLE_SETTINGS = (':DATa:SOUrce', ':DATa:STARt', ':DATa:STOP',
+                     ':WFMOutpre:ENCdg', ':WFMOutpre:BN_Fmt',
+                     ':WFMOutpre:BYT_Nr', ':WFMOutpre:BYT_Or')
+
+
+class ScopeSession(object):
+    """Remembers the SCPI state that we have set on the oscilloscope so we
+    don't resend it before every frame. Settings are only written when they
+    differ from what we last sent, and all changed settings go out in a single
+    ;-joined write. Values that we query from the scope (the FFT scale and the
+    waveform preamble) are cached until something invalidates them.
+
+    If someone changes settings by hand on the front panel, call invalidate()
+    so that everything is sent and queried again."""
+    def __init__(self, device):
+        self.device = device
+        self.state = {}
+        self._fft_scale = None
+        self._preamble = None
+        self._timebase = None
+
+    def configure(self, settings):
+        """Makes sure that the oscilloscope has the given settings.
+        @param settings: list of (header, value) pairs, for example
+                         [(':DATa:SOUrce', 'MATH'), (':DATa:STARt', 0)]
+        @returns (bool) True if anything had to be sent to the oscilloscope
+        """
+        changed = [(header, value) for header, value in settings
+                   if self.state.get(header) != value]
+        if not changed:
+            return False
+        self.device.write(';'.join('%s %s' % (header, value) for header, value in changed))
+        for header, value in changed:
+            self.state[header] = value
+            if header in PREAMBLE_SETTINGS:
+                self._preamble = None
+                self._timebase = None
+            elif header.upper().startswith(':MATH'):
+                self._fft_scale = None
+        return True
+
+    def preamble(self):
+        """Returns the cached (YMUlt, YOFf, YZEro) values that convert raw
+        binary curve values into the units shown on the oscilloscope."""
+        if self._preamble is None:
+            reply = self.device.query(':WFMOutpre:YMUlt?;YOFf?;YZEro?')
+            self._preamble = tuple(float(v) for v in reply.strip().split(';'))
+        return self._preamble
+
+    def timebase(self):
+        """Returns the cached (XINcr, record length) of the current data
+        source, which for a channel is the seconds between waveform points."""
+        if self._timebase is None:
+            reply = self.device.query(':WFMOutpre:XINcr?;:HORizontal:RECOrdlength?')
+            xincr, record_length = reply.strip().split(';')
+            self._timebase = (float(xincr), int(float(record_length)))
+        return self._timebase
+
+    def fft_scale(self):
+        """Returns the cached (horizontal scale, vertical scale, horizontal
+        units) of the MATH FFT, queried in a single round trip."""
+        if self._fft_scale is None:
+            reply = self.device.query(
+                'MATH:HORIZONTAL:SCALE?;:MATH:VERTICAL:SCALE?;:MATH:HORIZONTAL:UNITS?')
+            xscale, yscale, units = reply.strip().split(';')
+            units = units.strip().replace('"', '')
+            self._fft_scale = (float(xscale), float(yscale), units)
+        return self._fft_scale
+
+    def invalidate(self):
+        """Forgets everything we know about the oscilloscope state."""
+        self.state = {}
+        self._fft_scale = None
+        self._preamble = None
+        self._timebase = None
+
+
+class RecordingStats(object):
+    """Counters describing how a single recording went. Frames are split up
+    into unique frames, duplicates (the scope returned the same FFT as last
+    time) and corrupted frames (the reply could not be parsed)."""
+    def __init__(self):
+        self.frames = 0
+        self.unique = 0
+        self.duplicates = 0
+        self.corrupted = 0
+        self.polls = 0
+        self.wasted_polls = 0
+        self.delay = None
+        self.start_time = time.time()
+        self.end_time = self.start_time
+
+    @property
+    def duration(self):
+        return self.end_time - self.start_time
+
+    @property
+    def frames_per_second(self):
+        """Unique frames per second, which is what we actually care about"""
+        return self.unique / self.duration if self.duration > 0 else 0.0
+
+    @property
+    def wasted_polls_per_frame(self):
+        return self.wasted_polls / float(self.frames) if self.frames else 0.0
+
+    def __repr__(self):
+        return ("RecordingStats(unique=%d, duplicates=%d, corrupted=%d, "
+                "%.2f frames/s, %.2f wasted polls/frame)" % (
+                self.unique, self.duplicates, self.corrupted,
+                self.frames_per_second, self.wasted_polls_per_frame))
+
+
+class DuplicateFilter(object):
+    """Compares every frame with the previous one to catch the oscilloscope
+    returning the same FFT twice (it hasn't finished computing a new one yet).
+    Also adapts the delay between fetches: backs off when we see a duplicate
+    and slowly speeds back up while frames keep coming in fresh."""
+    def __init__(self, delay, min_delay=MIN_RECORD_DELAY_TIME,
+                 max_delay=MAX_RECORD_DELAY_TIME):
+        self.min_delay = min_delay
+        self.max_delay = max_delay
+        self.delay = min(max(delay, min_delay), max_delay)
+        self._last = None
+
+    def is_duplicate(self, frame):
+        duplicate = self._last is not None and np.array_equal(frame, self._last)
+        if duplicate:
+            self.delay = min(self.delay * DELAY_BACKOFF, self.max_delay)
+        else:
+            self.delay = max(self.delay * DELAY_SPEEDUP, self.min_delay)
+            if self._last is None or self._last.shape != frame.shape:
+                self._last = np.array(frame)
+            else:
+                self._last[...] = frame
+        return duplicate
+
+    def reset(self):
+        self._last = None
+
+
 class OscilloscopeMicrophone(object):
     """Implements the interface for the TEKTRONIX MDO3014 oscilloscope. The
     commands should be similar for any TEKTRONIX oscilloscope, but may differ
     slightly in the number of channels."""
-    def __init__(self):
-        # Try to connect to the first USBTMC oscilloscope found.
-        rm = visa.ResourceManager('@py')
-        devices = rm.list_resources()
-        devnames = []
-        for d in devices:
-            # Oscilloscope should have USB and at least 4 pairs of semicolons
-            # (bad critieria but whatever). Need to filter again later because
-            # we also use USB for our signal generator
-            if d.count(':') >= 8 and 'USB' in d:
-                devnames.append(d) 
-
-        if not devnames:
-            print('Only found devices: %s' % str(devices))
-            raise RuntimeError('Could not find an oscilloscope, check connection')
-        
-        rigol_devname = None
-        for d in devnames:
-            potential_device = rm.get_instrument(d)
-            potential_device.write("*IDN?")
-            time.sleep(0.2)  # give the device a bit of time to respond
-            test_id = potential_device.read()
-            print("Checking out device with ID: %s" % test_id)
-
-            if 'tektronix' in test_id.lower():
-                rigol_devname = d
-                self.device = potential_device
-                self.name = test_id
-                break
-            else:
-                print("This is not a tektronix oscilloscope")
-                potential_device.close()
+    def __init__(self, encoding=ENCODING_RIBINARY, byte_width=2, byte_order='msb',
+                 sync=SYNC_DELAY, profile=DEFAULT_PROFILE, resource_manager=None,
+                 registry=None, fft=FFT_SCOPE, fft_segments=1, fft_window='hann', fft_workers=FFT_WORKERS):
+        """Connects to the first tektronix oscilloscope found over USB.
+        @param encoding: how CURVE? transfers the FFT, one of ENCODING_ASCII,
+                         ENCODING_RIBINARY or ENCODING_FPBINARY
+        @param byte_width: bytes per value for the binary encodings (1, 2 or
+                           4 for RIBinary, 4 for FPBinary)
+        @param byte_order: 'msb' (big endian) or 'lsb' (little endian)
+        @param sync: SYNC_DELAY to sleep a fixed delay between frames, or
+                     SYNC_ACQUISITION to wait on the acquisition counter
+        @param profile: AcquisitionProfile, or path to one saved by
+                        benchmark_microphone.py --calibrate. Used to pick the
+                        delay between fetches when none is given.
+        @param resource_manager: VISA resource manager to look for the scope
+                                 with. Defaults to pyvisa's '@py' backend; pass
+                                 a simulation.SimulatedResourceManager to run
+                                 without hardware.
+        @param registry: instruments.InstrumentRegistry to get the scope from,
+                         shared with the signal generator. Defaults to the
+                         one shared by everything using <resource_manager>.
+        @param fft: FFT_SCOPE to read the MATH FFT, or FFT_HOST to fetch raw
+                    CH1 waveforms and compute the FFT on the computer
+        @param fft_segments: number of overlapping segments averaged per
+                             spectrum in FFT_HOST mode (Welch's method)
+        @param fft_window: window applied before the FFT in FFT_HOST mode
+        @param fft_workers: threads computing FFTs in FFT_HOST mode
+        """
+        self.set_encoding(encoding, byte_width, byte_order)
+        if fft not in (FFT_SCOPE, FFT_HOST):
+            raise ValueError('fft must be %s or %s, got %s' % (FFT_SCOPE, FFT_HOST, fft))
+        self.fft = fft
+        self.fft_segments = fft_segments
+        self.fft_window = fft_window
+        self.fft_workers = fft_workers
+        self._host_fft = None
+        self.sync = sync
+        if isinstance(profile, AcquisitionProfile):
+            self.profile = profile
+        else:
+            self.profile = AcquisitionProfile.load(profile)
+        self.last_stats = None
+        self._capture = None
 
-        if not rigol_devname:
-            raise RuntimeError('Could not find an Oscilloscope instrument, check connection')
+        # Connect to the first tektronix oscilloscope the registry knows of.
+        if registry is None:
+            registry = registry_for(resource_manager)
+        _, self.device, self.name = registry.find('tektronix')
 
+        self.session = ScopeSession(self.device)
 
-    def _record(self, n, sample_start=0, sample_end=10000, delay=RECORD_DELAY_TIME):
+    def set_encoding(self, encoding, byte_width=2, byte_order='msb'):
+        """Selects the encoding used when transferring FFT data. Binary
+        encodings are much faster for wide sample ranges, ASCII is kept around
+        as a fallback in case the binary transfer misbehaves."""
+        encoding = encoding.lower()
+        byte_order = byte_order.lower()
+        if encoding != ENCODING_ASCII and (encoding, byte_width) not in BINARY_DATATYPES:
+            raise ValueError('Unsupported encoding %s with %d bytes' % (encoding, byte_width))
+        if byte_order not in ('msb', 'lsb'):
+            raise ValueError('Byte order must be msb or lsb, got %s' % byte_order)
+        self.encoding = encoding
+        self.byte_width = byte_width
+        self.byte_order = byte_order
+
+    def default_delay(self, sample_start, sample_end):
+        """Delay between fetches to use when the caller doesn't give one. The
+        calibration profile knows the fastest delay that is still safe for
+        this window width, otherwise we fall back to RECORD_DELAY_TIME."""
+        delay = None
+        if self.profile:
+            delay = self.profile.safe_delay(self.encoding, self.byte_width,
+                                            sample_end - sample_start,
+                                            min_delay=MIN_RECORD_DELAY_TIME)
+        return RECORD_DELAY_TIME if delay is None else delay
+
+    def _sample_range(self, sample_start, sample_end):
+        """The range of samples a recording gets. The host FFT has fewer bins
+        than the oscilloscope's, so in FFT_HOST mode the range is clipped to
+        them (see HostFFT.bins)."""
+        if self.fft == FFT_HOST:
+            return self.host_fft().bins(sample_start, sample_end)
+        return sample_start, sample_end
+
+    def _record(self, n, sample_start=0, sample_end=10000, delay=None,
+                sync=None, poll_interval=ACQUISITION_POLL_TIME, keep_duplicates=False,
+                min_delay=MIN_RECORD_DELAY_TIME, max_delay=MAX_RECORD_DELAY_TIME,
+                writer=None, times_writer=None):
         """Records for n seconds, while blocking. Only returns control after
         recording is finished. For the oscilloscope, this returns our result
         as a numpy array, with dimensions (num_recordings, num_samples). We will
@@ -70,56 +318,334 @@ class OscilloscopeMicrophone(object):
         MAKE SURE MATH IS TURNED ON ON THE OSCILLOSCOPE OR IT MAY SAY THAT
         THE COMMAND HAS TIMED OUT! The best setting is to turn the display for
         all channels off and math on, so the FFT is the only thing rendering
-        on the display at the time.
+        on the display at the time. In FFT_HOST mode MATH isn't needed, only
+        CH1: its waveform records get transformed on the computer, and sample
+        numbers refer to the bins of host_fft().
 
         To figure out which range of samples of the FFT to record, you may have
         to convert your frequency range of interest into samples range by
         querying the units that the oscilloscope is currently on.
 
+        Every frame is compared with the previous one. Repeated FFTs are
+        dropped (or kept, with keep_duplicates) and make the delay between
+        fetches back off, fresh ones make it shrink again, always staying
+        within [min_delay, max_delay]. Statistics about the recording are kept
+        in self.last_stats.
+
         @param sample_start (int): start of FFT samples to collect
         @param sample_end (int): end of FFT samples to collect
+        @param delay (float): initial seconds to sleep after each fetch
+                              (SYNC_DELAY), picked by default_delay if None
+        @param sync: SYNC_DELAY or SYNC_ACQUISITION, defaults to self.sync
+        @param poll_interval (float): seconds between acquisition counter
+                                      polls (SYNC_ACQUISITION)
+        @param keep_duplicates (bool): keep repeated FFTs instead of dropping them
+        @param min_delay (float): smallest delay the adaptive delay can reach
+        @param max_delay (float): largest delay the adaptive delay can reach
+        @param writer (FrameWriter): if given, frames are appended to it as
+                                     they arrive instead of being returned
+        @param times_writer (FrameWriter): if given, gets the monotonic time
+                                           each frame was fetched at
         """
-        end_time = time.time() + n
+        sample_start, sample_end = self._sample_range(sample_start, sample_end)
+        if delay is None:
+            delay = self.default_delay(sample_start, sample_end)
+        stats = RecordingStats()
+        self.last_stats = stats
         lst = []
-        while time.time() < end_time:
+
+        def keep(frame, timestamp):
+            if writer is None:
+                lst.append(frame)
+            else:
+                writer.append(frame)
+            if times_writer is not None:
+                times_writer.append(timestamp)
+
+        if self.fft == FFT_HOST:
+            fft = self.host_fft()
+            fetch = self._fetch_waveform
+            frame_length = fft.record_length
+        else:
+            fetch = lambda out: self._fetch_fft_sample(sample_start, sample_end, out=out)
+            frame_length = sample_end - sample_start
+        end_time = time.time() + n
+        step = self._frame_step(fetch, stats, sync or self.sync,
+                                DuplicateFilter(delay, min_delay, max_delay),
+                                poll_interval, keep_duplicates, time.sleep)
+        out = np.empty(frame_length)
+        if self.fft == FFT_HOST:
+            # Waveforms are handed to the pool as they arrive and the spectra
+            # collected in order, keeping at most fft_workers records in flight
+            pending = collections.deque()
+            with ThreadPoolExecutor(self.fft_workers) as pool:
+                while time.time() < end_time:
+                    corrupted = stats.corrupted
+                    timestamp = step(out, end_time)
+                    if timestamp is None:
+                        continue
+                    if stats.corrupted != corrupted:
+                        # Mark the spectrum as corrupted, not the FFT of -1s
+                        job = pool.submit(np.full, sample_end - sample_start, -1.0)
+                    else:
+                        job = pool.submit(fft.spectrum, out, sample_start, sample_end)
+                    pending.append((job, timestamp))
+                    out = np.empty(frame_length)
+                    while len(pending) > self.fft_workers:
+                        future, timestamp = pending.popleft()
+                        keep(future.result(), timestamp)
+                while pending:
+                    future, timestamp = pending.popleft()
+                    keep(future.result(), timestamp)
+        else:
+            while time.time() < end_time:
+                timestamp = step(out, end_time)
+                if timestamp is None:
+                    continue
+                keep(out, timestamp)
+                if writer is None:
+                    out = np.empty(frame_length)
+        stats.end_time = time.time()
+        if writer is None:
+            return np.array(lst)
+
+    def _frame_step(self, fetch, stats, sync, dup_filter, poll_interval,
+                    keep_duplicates, sleep):
+        """Builds the function that waits for and fetches a single frame, shared
+        by _record and the background capture. The returned step(out, end_time)
+        decodes the next frame into <out> with fetch(out) and returns the
+        monotonic time it was fetched at, or None if there was no new frame to
+        keep before end_time.
+        """
+        state = {'acquisition': None}
+        if sync == SYNC_ACQUISITION:
+            state['acquisition'] = self._acquisition_count()
+
+        def step(out, end_time):
+            if sync == SYNC_ACQUISITION:
+                acquisition = self._wait_for_acquisition(
+                    state['acquisition'], end_time, poll_interval, stats)
+                if acquisition is None:
+                    return None
+                state['acquisition'] = acquisition
             try:
-                lst.append(self._fetch_fft_sample(sample_start, sample_end))
-                time.sleep(delay)
+                fetch(out)
+                duplicate = dup_filter.is_duplicate(out)
             except ValueError as v_err:
                 # Usually happens when oscilloscope data gets corrupted and
                 # can't be interpreted as a float or something
                 print('Got error when fetching microphone data: %s' % str(v_err))
                 # If there are corrupted data locations we can mark these by
                 # placing -1 values
-                lst.append(np.zeros(sample_end - sample_start) - 1)
-                time.sleep(delay)
-        return np.array(lst)
+                out[:] = -1
+                duplicate = False
+                dup_filter.reset()
+                stats.corrupted += 1
+            else:
+                if duplicate:
+                    stats.duplicates += 1
+                else:
+                    stats.unique += 1
+            timestamp = time.monotonic()
+            stats.frames += 1
+            stats.delay = dup_filter.delay
+            stats.end_time = time.time()
+            if sync == SYNC_DELAY:
+                sleep(dup_filter.delay)
+            if duplicate and not keep_duplicates:
+                return None
+            return timestamp
 
-    def record_to_file(self, num_seconds, fname, delay=0.5, sample_start=0, sample_end=10000):
+        return step
+
+    def _acquisition_count(self):
+        """Number of acquisitions the oscilloscope has made since it started
+        acquiring. The MATH FFT is recomputed once per acquisition."""
+        return int(float(self.device.query('ACQuire:NUMACq?')))
+
+    def _wait_for_acquisition(self, last_count, end_time, poll_interval, stats,
+                              timeout=ACQUISITION_TIMEOUT):
+        """Polls the acquisition counter until it moves past <last_count>, so
+        that the next CURVE? is guaranteed to return a new FFT.
+        @returns (int) the new acquisition count, or None if we ran past
+                 <end_time> before the oscilloscope acquired anything new
+        """
+        give_up_time = time.time() + timeout
+        polls = 0
+        while True:
+            count = self._acquisition_count()
+            polls += 1
+            if count != last_count:
+                break
+            now = time.time()
+            if now >= end_time:
+                count = None
+                break
+            if now >= give_up_time:
+                raise RuntimeError('Oscilloscope did not acquire anything in %s s. '
+                                   'Is it stopped or waiting on a trigger?' % timeout)
+            time.sleep(poll_interval)
+        stats.polls += polls
+        # The poll that saw a new acquisition was useful, the others weren't
+        stats.wasted_polls += polls - 1 if count is not None else polls
+        return count
+
+    def start_capture(self, sample_start=0, sample_end=10000, delay=None,
+                      sync=None, poll_interval=ACQUISITION_POLL_TIME, keep_duplicates=False,
+                      min_delay=MIN_RECORD_DELAY_TIME, max_delay=MAX_RECORD_DELAY_TIME,
+                      capacity=CAPTURE_CAPACITY):
+        """Starts fetching FFT frames in a background thread, so that the
+        caller can keep doing other things (like moving the CNC head) while we
+        record. Frames go into a preallocated ring buffer of <capacity> frames
+        along with the monotonic host time they were fetched at; use drain()
+        to collect them. Don't talk to the oscilloscope from anywhere else
+        until stop_capture() is called.
+
+        The other parameters are the same as for _record."""
+        if self._capture and self._capture.running:
+            raise RuntimeError('Oscilloscope is already capturing')
+        sample_start, sample_end = self._sample_range(sample_start, sample_end)
+        if delay is None:
+            delay = self.default_delay(sample_start, sample_end)
+        stats = RecordingStats()
+        self.last_stats = stats
+        buf = RingBuffer(capacity, (sample_end - sample_start,))
+        if self.fft == FFT_HOST:
+            # Already off the main thread, so the FFT is done in line
+            fft = self.host_fft()
+            waveform = np.empty(fft.record_length)
+            fetch = lambda out: fft.spectrum(self._fetch_waveform(waveform),
+                                             sample_start, sample_end, out=out)
+        else:
+            fetch = lambda out: self._fetch_fft_sample(sample_start, sample_end, out=out)
+        # The capture sleeps on the thread's stop event, so stop_capture()
+        # doesn't have to wait out a whole delay
+        step = self._frame_step(fetch, stats, sync or self.sync,
+                                DuplicateFilter(delay, min_delay, max_delay),
+                                poll_interval, keep_duplicates,
+                                lambda seconds: self._capture.sleep(seconds))
+        # Wait for acquisitions in short chunks so a stop request isn't held up
+        self._capture = CaptureThread(buf, lambda out: step(out, time.time() + 0.1))
+        self._capture.start()
+
+    def stop_capture(self):
+        """Stops the background capture. Frames that haven't been drained yet
+        stay available through drain()."""
+        if self._capture:
+            self._capture.stop()
+
+    def drain(self):
+        """Returns every frame captured since the last drain.
+        @returns (timestamps, frames) where timestamps are time.monotonic()
+                 values and frames has dimensions (num_frames, num_samples)
+        """
+        if not self._capture:
+            raise RuntimeError('Oscilloscope has not started capturing')
+        return self._capture.buffer.drain()
+
+    def record_to_file(self, num_seconds, fname, delay=None, sample_start=0, sample_end=10000,
+                       sync=None, keep_duplicates=False):
         """Records <num_seconds> seconds of oscilloscope data and saves it as
         a numpy array to the file specified. User does not need to pass in a
-        file extension."""
-        fname += '.pkl'
-        frames = self._record(num_seconds, delay=delay,
-                              sample_start=sample_start,
-                              sample_end=sample_end)
-        frames.dump(fname)
-
-    def _fetch_fft_sample(self, sample_start, sample_end):
+        file extension. Frames are written to <fname>.npy as they arrive, and
+        the monotonic time of each frame to <fname>.times.npy, so memory use
+        doesn't depend on the recording length and a crash only loses the
+        last second or so."""
+        with FrameWriter(fname + '.npy') as writer, \
+                FrameWriter(fname + '.times.npy') as times_writer:
+            self._record(num_seconds, delay=delay,
+                         sample_start=sample_start,
+                         sample_end=sample_end, sync=sync,
+                         keep_duplicates=keep_duplicates,
+                         writer=writer, times_writer=times_writer)
+
+    def _fetch_fft_sample(self, sample_start, sample_end, out=None):
         """Gets a sample of an FFT from the MATH command. Command may be
         specialized for the TEKTRONIX MDO3014 Oscilloscope. User specifies the
         range of the samples (corresponding to frequency range of interest).
         @param sample_start: sample number to start recording at
         @param sample_end: sample number to stop recording at
+        @param out: optional preallocated float array to decode the FFT into.
+                    Must have the same length as the returned curve.
+        @returns (np.ndarray) the FFT values, which is <out> if it was given
         """
         # self._write('MATH:DEFINE "FFT(CH1)"')
-        self._write(':DATa:SOUrce MATH')
-        self._write(':DATa:STARt %d' % sample_start)
-        self._write(':DATa:STOP %d' % sample_end)
-        self._write(':WFMOutpre:ENCdg ASCii')
-        self._write(':HEADer 0')
-        self._write(':VERBose 0')
-        return np.array(self.device.query_ascii_values('CURVE?'))
+        # Only the settings that changed since the last frame get sent, so in
+        # steady state CURVE? is the only round trip per frame.
+        self.session.configure(self._curve_settings(sample_start, sample_end))
+        if self.encoding == ENCODING_ASCII:
+            values = self.device.query_ascii_values('CURVE?', container=np.array)
+            if out is None:
+                return values
+            out[:] = values
+            return out
+
+        return self._fetch_binary_curve(BINARY_DATATYPES[(self.encoding, self.byte_width)], out)
+
+    def _fetch_waveform(self, out=None):
+        """Gets the latest raw CH1 waveform record, in volts, for FFT_HOST
+        mode. Always transferred as 2 byte RIBinary, since the record is far
+        too long for ASCII and 1 byte would throw away resolution.
+        @param out: optional preallocated float array of the record length
+        @returns (np.ndarray) the waveform, which is <out> if it was given
+        """
+        self.session.configure(self._waveform_settings())
+        return self._fetch_binary_curve(BINARY_DATATYPES[(ENCODING_RIBINARY, 2)], out)
+
+    def _fetch_binary_curve(self, datatype, out=None):
+        """Sends CURVE? for the already configured binary transfer and scales
+        the raw values with the waveform preamble."""
+        ymult, yoff, yzero = self.session.preamble()
+        raw = self.device.query_binary_values(
+            'CURVE?', datatype=datatype,
+            is_big_endian=(self.byte_order == 'msb'), container=np.array)
+        if out is None:
+            out = np.empty(len(raw), dtype=np.float64)
+        # value = (raw - YOFf) * YMUlt + YZEro, done in place on the buffer
+        np.subtract(raw, yoff, out=out)
+        out *= ymult
+        out += yzero
+        return out
+
+    def _waveform_settings(self):
+        """SCPI settings needed before CURVE? returns the whole CH1 record"""
+        return [(':HEADer', 0),
+                (':VERBose', 0),
+                (':DATa:SOUrce', WAVEFORM_SOURCE),
+                (':DATa:STARt', 1),
+                (':DATa:STOP', WAVEFORM_MAX_POINTS),
+                (':WFMOutpre:ENCdg', 'BINary'),
+                (':WFMOutpre:BN_Fmt', 'RI'),
+                (':WFMOutpre:BYT_Nr', 2),
+                (':WFMOutpre:BYT_Or', self.byte_order.upper())]
+
+    def host_fft(self):
+        """The HostFFT used in FFT_HOST mode, matching the current record
+        length and sample rate of CH1. Change those on the scope (and call
+        session.invalidate()) to trade resolution against frames per second."""
+        self.session.configure(self._waveform_settings())
+        xincr, record_length = self.session.timebase()
+        fft = self._host_fft
+        if fft is None or (fft.sample_interval, fft.record_length) != (xincr, record_length):
+            self._host_fft = HostFFT(xincr, record_length, self.fft_segments, self.fft_window)
+        return self._host_fft
+
+    def _curve_settings(self, sample_start, sample_end):
+        """SCPI settings needed before CURVE? returns the requested window of
+        the MATH FFT in our current encoding."""
+        settings = [(':HEADer', 0),
+                    (':VERBose', 0),
+                    (':DATa:SOUrce', 'MATH'),
+                    (':DATa:STARt', sample_start),
+                    (':DATa:STOP', sample_end)]
+        if self.encoding == ENCODING_ASCII:
+            settings.append((':WFMOutpre:ENCdg', 'ASCii'))
+        else:
+            settings += [(':WFMOutpre:ENCdg', 'BINary'),
+                         (':WFMOutpre:BN_Fmt', 'RI' if self.encoding == ENCODING_RIBINARY else 'FP'),
+                         (':WFMOutpre:BYT_Nr', self.byte_width),
+                         (':WFMOutpre:BYT_Or', self.byte_order.upper())]
+        return settings
 
     def _print_fft_units(self):
         self._query('MATH:HORIZONTAL:SCALE?')
@@ -127,12 +653,21 @@ class OscilloscopeMicrophone(object):
         self._query('MATH:HORIZONTAL:UNITS?')
         self._query('MATH:VERTICAL:UNITS?')
 
+    def _fft_resolution(self):
+        """(Hz per FFT sample, units reported for it) in the current FFT mode"""
+        if self.fft == FFT_HOST:
+            return self.host_fft().bin_width, 'Hz'
+        xscale, _, units = self.session.fft_scale()
+        return xscale, units
+
     def get_fft_scale(self):
         """Returns x and y scale in Hz and volts, respectively"""
-        xscale = self.device.query('MATH:HORIZONTAL:SCALE?')
-        yscale = self.device.query('MATH:VERTICAL:SCALE?')
+        if self.fft == FFT_HOST:
+            # No display involved, the spectra are already in volts
+            return self.host_fft().bin_width, 1.0
+        xscale, yscale, _ = self.session.fft_scale()
         # TODO: Figure why everything is off by a factor of 10^3
-        return float(xscale) / 1000.0, float(yscale)
+        return xscale / 1000.0, yscale
 
     def samples_to_frequency(self, sample_location):
         """Converts FFT sample locations to corresponding frequencies. Make
@@ -142,10 +677,7 @@ class OscilloscopeMicrophone(object):
         @returns (int) frequency that corresponds to that sample location
         """
         try:
-            xscale = self.device.query('MATH:HORIZONTAL:SCALE?')
-            units = self.device.query('MATH:HORIZONTAL:UNITS?')
-            if units:
-                units = str(units).strip().replace('"', '').replace('\n', '')
+            xscale, units = self._fft_resolution()
             print('Oscilloscope FFT has 1 sample as %s %s' % (xscale, units))
             if units != "Hz":
                 raise RuntimeError('Please set oscilloscope units to Hz')
@@ -163,18 +695,13 @@ class OscilloscopeMicrophone(object):
         return (2700, 2800). Will make sure to fully enclose the frequency
         range."""
         try:
-            xscale = self.device.query('MATH:HORIZONTAL:SCALE?')
-            units = self.device.query('MATH:HORIZONTAL:UNITS?')
-            if units:
-                units = str(units).strip().replace('"', '').replace('\n', '')
-            if xscale:
-                xscale = xscale.strip()
+            xscale, units = self._fft_resolution()
             print('Oscilloscope FFT has 1 sample as %s %s' % (xscale, units))
             if units != "Hz":
                 raise RuntimeError('Please set oscilloscope units to Hz')
             
-            lower_sample_idx = np.floor(float(start_freq) / float(xscale))
-            upper_sample_idx = np.ceil(float(end_freq) / float(xscale))
+            lower_sample_idx = np.floor(float(start_freq) / xscale)
+            upper_sample_idx = np.ceil(float(end_freq) / xscale)
             return lower_sample_idx, upper_sample_idx
         except Exception as err:
             print("Are you sure you're on FFT mode with units of Hz? We got ")
@@ -203,8 +730,9 @@ if __name__ == '__main__':
 
     xscale, yscale = mic.get_fft_scale()
     start = time.time()
+    y = None
     for _ in range(NUM_SAMPLES):
-        y = mic._fetch_fft_sample(sample_start, sample_end)
+        y = mic._fetch_fft_sample(sample_start, sample_end, out=y)
     end = time.time()
     print("Took %s seconds to fetch FFT data %d times" % (str(end - start), NUM_SAMPLES))
 
@@ -0,0 +1,6 @@
+"""Orders the points of a scan so that the head travels as little as
+possible between them, and compiles them into G-code programs."""
+from .grid import ORDER_RASTER, ORDER_SERPENTINE, grid_points, prism_points, \
+    scan_lines, path_length, travel_time, compare_paths
+from .route import plan_route, points_from_mask
+from .program import compile_points, parse_capture
@@ -0,0 +1,56 @@
+"""Times the route planner on random and masked point sets, and compares the
+travel of the planned route with visiting the points in the order given and
+in raster order.
+
+Run it from the top of the repository with
+    python -m planner.benchmark_route --points 100000
+"""
+import argparse
+import time
+import numpy as np
+from printer.motion import MotionModel
+from .grid import path_length, travel_time
+from .route import plan_route, points_from_mask
+
+
+def random_points(count, size, seed=0):
+    """<count> points scattered over a <size> mm square"""
+    points = np.zeros((count, 3))
+    points[:, :2] = np.random.default_rng(seed).uniform(0, size, (count, 2))
+    return points
+
+
+def disc_points(count, size):
+    """About <count> grid points inside a disc of diameter <size> mm, in
+    raster order"""
+    cells = int(np.sqrt(count * 4 / np.pi))
+    yy, xx = np.mgrid[0:cells, 0:cells]
+    centre = (cells - 1) / 2.0
+    mask = (xx - centre) ** 2 + (yy - centre) ** 2 <= centre ** 2
+    return points_from_mask(mask.T, size / float(cells))
+
+
+def benchmark(name, points, motion, feedrate):
+    start = time.time()
+    order = plan_route(points)
+    elapsed = time.time() - start
+    planned = points[order]
+    print('%-8s %8d points  planned in %6.2f s  %10.0f mm (%10.0f mm unplanned)  ~%.0f s moving'
+          % (name, len(points), elapsed, path_length(planned), path_length(points),
+             travel_time(planned, motion, feedrate)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=int, default=100000, dest='points')
+    parser.add_argument('--size', type=float, default=200.0, dest='size',
+                        help='mm across the area the points cover')
+    parser.add_argument('--speed', type=float, default=4000.0, dest='speed',
+                        help='feedrate between points in mm/min')
+    parser.add_argument('--profile', default='default', dest='profile',
+                        help='motion profile for the travel time estimate')
+    args = parser.parse_args()
+
+    motion = MotionModel.from_profile(args.profile)
+    benchmark('random', random_points(args.points, args.size), motion, args.speed)
+    benchmark('disc', disc_points(args.points, args.size), motion, args.speed)
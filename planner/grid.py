@@ -0,0 +1,104 @@
+"""Orders for rectangular point scans. The original order is a raster: x in
+the outer loop and y running from 0 to the end in every column, so after each
+column the head travels all the way back to y=0, and after each layer of a
+prism all the way back to the origin. The serpentine (boustrophedon) order
+visits exactly the same points but runs every other column backwards, and
+every other layer backwards, so each step is to a neighbouring point.
+"""
+import numpy as np
+
+ORDER_RASTER = 'raster'
+ORDER_SERPENTINE = 'serpentine'
+ORDERS = (ORDER_RASTER, ORDER_SERPENTINE)
+
+
+def _check_order(order):
+    if order not in ORDERS:
+        raise ValueError('Unknown scan order %s, choose from %s' % (order, ORDERS))
+
+
+def grid_points(distance_x, distance_y, resolution_x, resolution_y, order=ORDER_SERPENTINE):
+    """Points of a rectangular grid from (0, 0) to (distance_x, distance_y).
+    The coordinates are the same whatever the order, so file names don't
+    change.
+    @returns list of (x, y)
+    """
+    _check_order(order)
+    ys = list(np.linspace(0, distance_y, resolution_y))
+    points = []
+    for column, x in enumerate(np.linspace(0, distance_x, resolution_x)):
+        column_ys = ys[::-1] if order == ORDER_SERPENTINE and column % 2 else ys
+        points.extend((x, y) for y in column_ys)
+    return points
+
+
+def prism_points(distance_x, distance_y, distance_z, resolution, resolution_z,
+                 order=ORDER_SERPENTINE):
+    """Points of a stack of grids, one per z layer. With the serpentine order
+    every other layer is walked backwards, so each layer starts above where
+    the last one ended.
+    @returns list of layers, each a list of (x, y, z)
+    """
+    _check_order(order)
+    layer = grid_points(distance_x, distance_y, resolution, resolution, order)
+    layers = []
+    for index, z in enumerate(np.linspace(0, distance_z, resolution_z)):
+        layer_points = layer[::-1] if order == ORDER_SERPENTINE and index % 2 else layer
+        layers.append([(x, y, z) for x, y in layer_points])
+    return layers
+
+
+def scan_lines(distance_x, distance_y, resolution, bidirectional=False):
+    """Lines of a continuous scan, along x, one for each of <resolution> y
+    values from 0 to <distance_y>. Bidirectional scans run every other line
+    from distance_x back to 0 instead of travelling back without recording.
+    @returns list of ((x start, y), (x end, y))
+    """
+    lines = []
+    for index, y in enumerate(np.linspace(0, distance_y, resolution)):
+        if bidirectional and index % 2:
+            lines.append(((distance_x, y), (0, y)))
+        else:
+            lines.append(((0, y), (distance_x, y)))
+    return lines
+
+
+def path_length(points, start=None):
+    """Total distance travelled visiting <points> in order from <start>
+    (the origin by default) and coming back to it, in mm."""
+    points = np.asarray(points, dtype=float)
+    if not len(points):
+        return 0.0
+    if start is None:
+        start = np.zeros(points.shape[1])
+    path = np.vstack([start, points, start])
+    return float(np.linalg.norm(np.diff(path, axis=0), axis=1).sum())
+
+
+def travel_time(points, motion, feedrate, start=None):
+    """Seconds spent moving between <points> (plus from and back to
+    <start>), stopping at each one, according to a printer.motion.MotionModel.
+    """
+    points = np.asarray(points, dtype=float)
+    if not len(points):
+        return 0.0
+    if start is None:
+        start = np.zeros(points.shape[1])
+    path = np.vstack([start, points, start])
+    deltas = np.zeros((len(path) - 1, 3))
+    deltas[:, :path.shape[1]] = np.diff(path, axis=0)
+    return float(motion.durations(deltas, feedrate).sum())
+
+
+def compare_paths(baseline, planned, name='Planned', motion=None, feedrate=3000.0):
+    """Prints how much travel <planned> saves over visiting the same points
+    in the <baseline> order, and the time saved if given a motion model."""
+    before = path_length(baseline)
+    after = path_length(planned)
+    saved = 100.0 * (before - after) / before if before else 0.0
+    message = '%s path: %.1f mm of travel instead of %.1f mm (%.0f%% less)' % (
+        name, after, before, saved)
+    if motion is not None:
+        seconds = travel_time(baseline, motion, feedrate) - travel_time(planned, motion, feedrate)
+        message += ', about %.0f s less moving at %s mm/min' % (seconds, feedrate)
+    print(message)
@@ -0,0 +1,69 @@
+"""Compiles a point scan into one G-code program, so that the whole scan can
+be streamed to the printer with printcore.startprint instead of pushing every
+move through send_now and sleeping in between.
+
+Every point is a move, an M400 so that nothing else happens until the head
+has stopped, and a ";@capture <index>" host command. printcore doesn't send
+host commands to the printer, it hands them to its hostcommandcb, and since
+it only moves on to the next line once the previous one was answered, the
+capture callback runs right after the M400's ok, with the head at the point.
+The next move isn't sent until the callback returns.
+
+Moves are absolute, relative to the printer's origin (set it with G92, which
+is what Printer.reset_origin and Scanner.set_as_origin do), and only name the
+axes that change. The feedrate is only given once, the printer keeps it.
+"""
+import re
+import numpy as np
+
+CAPTURE = ';@capture'
+# Decimal places of the coordinates in the program (0.1 um)
+PRECISION = 4
+GCODE_WORD = re.compile(r'([A-Z])(-?[\d.]+)')
+
+
+def _move(target, previous, feed):
+    words = ['%s%.*f' % (axis, PRECISION, value)
+             for axis, value, last in zip('XYZ', target, previous) if value != last]
+    if not words:
+        return None
+    return 'G0 %s%s' % (' '.join(words), feed)
+
+
+def compile_points(points, feedrate, start=(0.0, 0.0, 0.0), return_to_start=True):
+    """G-code that visits <points> in order with absolute moves, starting
+    with the head at <start>, and captures at each one.
+    @param points: (n, 3) array-like of coordinates relative to the origin
+    @param feedrate: mm/min
+    @returns printer.gcoder.LightGCode
+    """
+    from printer.gcoder import LightGCode
+    path = np.round(np.vstack([start, np.asarray(points, dtype=float)]), PRECISION).tolist()
+    lines = ['G90']
+    feed = ' F%s' % feedrate
+    for index in range(1, len(path)):
+        move = _move(path[index], path[index - 1], feed)
+        if move:
+            lines.append(move)
+            feed = ''
+        lines.append('M400')
+        lines.append('%s %d' % (CAPTURE, index - 1))
+    if return_to_start and len(path) > 1:
+        move = _move(path[0], path[-1], feed)
+        if move:
+            lines.append(move)
+    return LightGCode(lines)
+
+
+def parse_capture(command):
+    """Index of the point a ";@capture <index>" host command is for, or None
+    if it's some other host command."""
+    words = command.split()
+    if len(words) == 2 and words[0] == CAPTURE:
+        return int(words[1])
+    return None
+
+
+def parse_words(line):
+    """Letter -> value of the words of a G-code line, like {'G': 0.0, 'X': 1.0}"""
+    return dict((letter, float(value)) for letter, value in GCODE_WORD.findall(line.split(';')[0]))
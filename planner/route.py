@@ -0,0 +1,169 @@
+"""Orders an arbitrary set of points (a sparse or masked region, say only the
+part above the lattice) so that visiting them takes little travel. This is
+the travelling salesman problem, so we settle for a fast heuristic: a greedy
+nearest neighbour tour, then 2-opt passes that undo the crossings it leaves
+behind.
+
+Both are built to handle 100k+ points in a few seconds. The nearest neighbour
+search only looks at the grid cells around the current point, and 2-opt only
+tries to swap edges that are at most <window> steps apart on the tour, which
+lets every pass be done with a handful of numpy operations.
+"""
+import numpy as np
+
+# How many steps ahead on the tour 2-opt looks for an edge to swap with
+TWO_OPT_WINDOW = 30
+TWO_OPT_PASSES = 10
+# Points per grid cell the nearest neighbour search aims for
+POINTS_PER_CELL = 2.0
+# Rings of cells searched around the current point before giving up and
+# looking through every point that is left
+MAX_RINGS = 3
+
+
+def points_from_mask(mask, spacing, origin=(0.0, 0.0, 0.0), z=0.0):
+    """Points at the True cells of a 2D (x, y) or 3D (x, y, z) boolean mask.
+    @param spacing: mm between cells, a number or one per axis
+    @param origin: (x, y, z) of cell [0, 0(, 0)]
+    @param z: height of the points of a 2D mask
+    @returns (n, 3) array of points
+    """
+    mask = np.asarray(mask, dtype=bool)
+    if mask.ndim not in (2, 3):
+        raise ValueError('Expected a 2D or 3D mask, got %d dimensions' % mask.ndim)
+    spacing = np.broadcast_to(np.asarray(spacing, dtype=float), (mask.ndim,))
+    points = np.zeros((mask.sum(), 3))
+    points[:, :mask.ndim] = np.argwhere(mask) * spacing
+    if mask.ndim == 2:
+        points[:, 2] = z
+    return points + np.asarray(origin, dtype=float)
+
+
+def nearest_neighbour(points, start):
+    """Greedy tour: from <start>, always go to the closest point not visited
+    yet.
+    @returns indices of <points> in the order they are visited
+    """
+    n = len(points)
+    extent = points.max(axis=0) - points.min(axis=0)
+    axes = np.flatnonzero(extent > 0)
+    if n < 3 or not len(axes):
+        return np.argsort(np.linalg.norm(points - start, axis=1), kind='stable')
+    # Cells sized to hold a couple of points each, over the axes that vary.
+    # The other axes are the same for every point, so they don't change
+    # which one is closest.
+    cell = (np.prod(extent[axes]) * POINTS_PER_CELL / n) ** (1.0 / len(axes))
+    lowest = points[:, axes].min(axis=0)
+    # Cells are numbered row by row, with a margin of MAX_RINGS empty cells
+    # around the edges so that neighbouring cells never wrap around
+    shape = np.floor(extent[axes] / cell).astype(int) + 1 + 2 * MAX_RINGS
+    strides = np.cumprod(np.concatenate([[1], shape[:-1]]))
+
+    def cell_of(coordinates):
+        index = np.floor((coordinates - lowest) / cell).astype(int) + MAX_RINGS
+        return np.clip(index, 0, shape - 1).dot(strides)
+
+    keys = cell_of(points[:, axes]).tolist()
+    cells = {}
+    for index, key in enumerate(keys):
+        cells.setdefault(key, []).append(index)
+    # Cell number offsets at each Chebyshev distance from the current cell
+    rings = []
+    for r in range(MAX_RINGS + 1):
+        grid = np.stack(np.meshgrid(*[np.arange(-r, r + 1)] * len(axes), indexing='ij'), -1)
+        grid = grid.reshape(-1, len(axes))
+        rings.append(grid[np.abs(grid).max(axis=1) == r].dot(strides).tolist())
+
+    # The search itself is plain python, the cells are too small for numpy
+    # to pay off
+    padded = np.zeros((n, 3))
+    padded[:, :len(axes)] = points[:, axes]
+    xs, ys, zs = padded.T.tolist()
+    visited = np.zeros(n, dtype=bool)
+    # The start may well be outside the grid, so the first point is found
+    # the slow way
+    best = int(_lengths(points, np.asarray(start, dtype=float)).argmin())
+    order = []
+    for step in range(n):
+        if step:
+            best, best_distance = -1, np.inf
+        for r, offsets in enumerate(rings if step else ()):
+            # Anything in this ring or further is at least (r - 1) cells away
+            if best >= 0 and ((r - 1) * cell) ** 2 > best_distance:
+                break
+            for offset in offsets:
+                bucket = cells.get(here_key + offset)
+                if bucket:
+                    for index in bucket:
+                        dx, dy, dz = xs[index] - hx, ys[index] - hy, zs[index] - hz
+                        distance = dx * dx + dy * dy + dz * dz
+                        if distance < best_distance:
+                            best, best_distance = index, distance
+        else:
+            if step and (best < 0 or (MAX_RINGS * cell) ** 2 < best_distance):
+                # Nothing close by, look through everything that's left
+                left = np.flatnonzero(~visited)
+                best = int(left[_lengths(padded[left], np.array([hx, hy, hz])).argmin()])
+        order.append(best)
+        visited[best] = True
+        here_key = keys[best]
+        bucket = cells[here_key]
+        bucket.remove(best)
+        if not bucket:
+            del cells[here_key]
+        hx, hy, hz = xs[best], ys[best], zs[best]
+    return np.array(order, dtype=int)
+
+
+def _lengths(a, b):
+    return np.sqrt(((a - b) ** 2).sum(axis=1))
+
+
+def two_opt(path, window=TWO_OPT_WINDOW, passes=TWO_OPT_PASSES):
+    """Improves an open path (its first point stays first) by reversing the
+    stretches between pairs of edges whose swap shortens it, for edges up to
+    <window> steps apart.
+    @param path: (n, d) points in visiting order
+    @returns order of the rows of <path> after improving
+    """
+    order = np.arange(len(path))
+    for _ in range(passes):
+        improved = False
+        for span in range(2, min(window, len(path) - 1) + 1):
+            p = path[order]
+            edges = _lengths(p[:-1], p[1:])
+            # Swapping edges (i, i + 1) and (i + span, i + span + 1) for
+            # (i, i + span) and (i + 1, i + span + 1)
+            count = len(p) - span - 1
+            gain = (edges[:count] + edges[span:span + count]
+                    - _lengths(p[:count], p[span:span + count])
+                    - _lengths(p[1:count + 1], p[span + 1:span + 1 + count]))
+            candidates = np.flatnonzero(gain > 1e-9)
+            if not len(candidates):
+                continue
+            # Apply the ones that don't overlap, in order along the path
+            taken_until = -1
+            for start in candidates.tolist():
+                if start > taken_until:
+                    order[start + 1:start + span + 1] = order[start + 1:start + span + 1][::-1].copy()
+                    taken_until = start + span + 1
+            improved = True
+        if not improved:
+            break
+    return order
+
+
+def plan_route(points, start=(0.0, 0.0, 0.0), window=TWO_OPT_WINDOW, passes=TWO_OPT_PASSES):
+    """Orders <points> for a short path starting at <start>.
+    @param points: (n, 2) or (n, 3) array-like of coordinates
+    @returns indices of <points> in visiting order
+    """
+    points = np.asarray(points, dtype=float)
+    if not len(points):
+        return np.zeros(0, dtype=int)
+    start = np.asarray(start, dtype=float)[:points.shape[1]]
+    order = nearest_neighbour(points, start)
+    # Keep the start at the front of the path so 2-opt can't move it
+    path = np.vstack([start, points[order]])
+    improved = two_opt(path, window, passes)
+    return order[improved[1:] - 1]
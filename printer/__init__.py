@@ -1 +1,22 @@
-from .printer import Printer
\ No newline at end of file
+"""Printer control. Printer is imported when it is first used, so that
+importing the package doesn't pull in pyserial."""
+import importlib
+
+_EXPORTS = {
+    'Printer': '.printer',
+    'MachineProfile': '.printer',
+    'MACHINES': '.printer',
+    'MotionModel': '.motion',
+    'Segment': '.motion',
+    'PositionLog': '.telemetry',
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
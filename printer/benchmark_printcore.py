@@ -0,0 +1,197 @@
+"""Times how long printcore takes to get commands to a printer and how much
+CPU it burns while it waits, against a fake printer that answers every line
+with an ok after a fixed latency. No hardware needed.
+
+    * round trip: send_and_wait, minus the fake printer's latency, is what
+      printcore itself adds to every command
+    * streaming: lines per second through startprint, with --window lines in
+      flight. With --window 1 every line waits for the last one's ok, so
+      the time per line over the latency is the round trip during a print.
+    * waiting: CPU used while a program waits --wait seconds for an M400,
+      like it does while the head crosses a long scan line
+    * soak (with --soak): peak memory every million lines pushed through,
+      which should stay flat however long the session gets
+
+The first three run twice, with printcore's threads waiting on its
+Condition and, as a baseline, with them polling every millisecond like
+printcore used to (PollingPrintcore). Outside a print neither of them waits
+for anything, so the send_and_wait round trip comes out the same.
+
+Run it from the top of the repository with
+    python -m printer.benchmark_printcore --window 1
+    python -m printer.benchmark_printcore --window 4 --sender condition
+    python -m printer.benchmark_printcore --soak 10000000
+"""
+import argparse
+import resource
+import sys
+import threading
+import time
+from queue import Queue, Empty
+import numpy as np
+from . import printcore as printcore_module
+from .gcoder import LightGCode
+
+
+class FakeSerial(object):
+    """Enough of serial.Serial for printcore, answering ok to every line
+    <latency> seconds after it was written, and to M400 <wait> seconds after"""
+    latency = 0.001
+    wait = 0.0
+
+    def __init__(self, *args, **kwargs):
+        self.is_open = True
+        self._replies = Queue()
+        self._lines = Queue()
+        self._replies.put('start\n')
+        thread = threading.Thread(target=self._answer)
+        thread.daemon = True
+        thread.start()
+
+    def _answer(self):
+        while True:
+            line = self._lines.get()
+            time.sleep(self.wait if 'M400' in line else self.latency)
+            self._replies.put('ok\n')
+
+    def write(self, data):
+        self._lines.put(data.decode())
+        return len(data)
+
+    def readline(self):
+        try:
+            return self._replies.get(timeout=0.25).encode()
+        except Empty:
+            return b''
+
+    def open(self):
+        self.is_open = True
+
+    def close(self):
+        self.is_open = False
+
+    def isOpen(self):
+        return self.is_open
+
+    def setDTR(self, dtr):
+        pass
+
+
+class PollingPrintcore(printcore_module.printcore):
+    """printcore with the print and send threads checking what they wait for
+    every millisecond, the way they did before they waited on a Condition"""
+    def _wait_until(self, ready):
+        while self.printer and self.printing and not ready():
+            time.sleep(0.001)
+
+
+# Which printcore to measure, by the name the results are printed under
+SENDERS = {
+    'condition': printcore_module.printcore,
+    'polling': PollingPrintcore,
+}
+
+
+def connect(window, sender=printcore_module.printcore):
+    # There's no tty to set up
+    printcore_module.Serial = FakeSerial
+    printcore_module.disable_hup = lambda port: None
+    p = sender('fake', 250000)
+    p.window_size = window
+    while not p.online:
+        time.sleep(0.01)
+    return p
+
+
+def run(p, lines):
+    """Streams <lines> with startprint and blocks until they're done.
+    @returns seconds it took
+    """
+    done = threading.Event()
+    p.endcb = done.set
+    start = time.monotonic()
+    p.startprint(LightGCode(lines))
+    done.wait()
+    return time.monotonic() - start
+
+
+def round_trip(p, count, label=''):
+    times = []
+    for _ in range(count):
+        start = time.monotonic()
+        p.send_and_wait('M105')
+        times.append(time.monotonic() - start - FakeSerial.latency)
+    times = np.array(times) * 1000
+    print('%-10s round trip   %5d commands  host overhead median %.3f ms, 99th percentile %.3f ms'
+          % (label, count, np.median(times), np.percentile(times, 99)))
+
+
+def streaming(p, count, label=''):
+    elapsed = run(p, ['G0 X%d' % (i % 100) for i in range(count)])
+    print('%-10s streaming    %5d lines     %.0f lines/s, %.3f ms per line over the latency'
+          % (label, count, count / elapsed, (elapsed / count - FakeSerial.latency) * 1000))
+
+
+def waiting(p, seconds, label=''):
+    FakeSerial.wait = seconds
+    cpu = time.process_time()
+    elapsed = run(p, ['G0 X10', 'M400'])
+    cpu = time.process_time() - cpu
+    FakeSerial.wait = 0.0
+    print('%-10s waiting      %5.1f s        %.1f%% of a core' % (label, elapsed, 100 * cpu / elapsed))
+
+
+def peak_memory():
+    """Most memory this process has used so far, in MB"""
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kB on Linux, bytes on macOS
+    return peak / (1e6 if sys.platform == 'darwin' else 1e3)
+
+
+def soak(p, count, report=1000000):
+    """Sends <count> checksummed lines straight through printcore, as fast as
+    the fake printer answers them"""
+    FakeSerial.latency = 0.0
+    start = time.monotonic()
+    for lineno in range(count):
+        p._send('G0 X%d Y%d' % (lineno % 200, lineno % 7), lineno, True)
+        # Don't let the fake printer fall behind, or its own queue grows
+        if lineno % 1000 == 999:
+            while p.in_flight > 1000:
+                time.sleep(0.001)
+        if (lineno + 1) % report == 0:
+            print('soak    %9d lines  peak memory %6.1f MB  %.0f lines/s'
+                  % (lineno + 1, peak_memory(), (lineno + 1) / (time.monotonic() - start)))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--latency', type=float, default=0.001, dest='latency',
+                        help='seconds the fake printer takes to answer a line')
+    parser.add_argument('--window', type=int, default=1, dest='window',
+                        help='lines in flight while streaming')
+    parser.add_argument('--commands', type=int, default=1000, dest='commands')
+    parser.add_argument('--wait', type=float, default=5.0, dest='wait',
+                        help='seconds the fake printer takes to answer M400')
+    parser.add_argument('--soak', type=int, default=0, dest='soak',
+                        help='only send this many lines, reporting memory use')
+    parser.add_argument('--sender', default='both', choices=sorted(SENDERS) + ['both'],
+                        dest='sender', help='printcore to measure, both to compare them')
+    args = parser.parse_args()
+
+    FakeSerial.latency = args.latency
+    if args.soak:
+        p = connect(args.window)
+        try:
+            soak(p, args.soak)
+        finally:
+            p.disconnect()
+        sys.exit()
+    for name in (sorted(SENDERS) if args.sender == 'both' else [args.sender]):
+        p = connect(args.window, SENDERS[name])
+        try:
+            round_trip(p, args.commands, name)
+            streaming(p, args.commands, name)
+            waiting(p, args.wait, name)
+        finally:
+            p.disconnect()
@@ -5,7 +5,7 @@ are going to be
     * /dev/ttyACM0 OR /dev/ttyUSB0 OR /dev/ttyUSB1
     * Baud Rate: 250000 OR 115200, most likely the first
 """
-from printer import Printer
+from .printer import Printer
 import time
 
 
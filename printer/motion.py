@@ -0,0 +1,231 @@
+"""How long moves take and where the head is during them. Printers don't move
+at the feedrate right away: the firmware plans every move as a trapezoid,
+jumping to a "jerk" speed, accelerating up to the feedrate, cruising, and
+decelerating again, with separate limits for each axis. Assuming distance /
+speed gets short moves badly wrong, and puts frames recorded at the ends of
+a continuous scan line in the wrong place.
+
+The limits can be read from the firmware with M503 (see
+Printer.motion_model), or taken from one of the PROFILES below. Since the
+scanner waits for every move to finish before sending the next one, each move
+is planned to start and end at rest.
+"""
+import json
+import re
+import numpy as np
+
+AXES = 'XYZ'
+# Same acceleration the gcoder duration estimates assume, in mm/s^2
+DEFAULT_ACCELERATION = 2000.0
+
+# Limits for the machines we've used, per axis (X, Y, Z). Feedrates and jerks
+# are in mm/s, accelerations in mm/s^2. Run M503 on the printer to check them.
+PROFILES = {
+    # Only the acceleration gcoder assumes, with generous speed limits
+    'default': {
+        'max_feedrate': (500.0, 500.0, 500.0),
+        'max_acceleration': (DEFAULT_ACCELERATION,) * 3,
+        'acceleration': DEFAULT_ACCELERATION,
+        'jerk': (10.0, 10.0, 0.4),
+    },
+    # LulzBot TAZ 5 firmware defaults
+    'taz5': {
+        'max_feedrate': (800.0, 800.0, 8.0),
+        'max_acceleration': (9000.0, 9000.0, 100.0),
+        'acceleration': 500.0,
+        'jerk': (8.0, 8.0, 0.4),
+    },
+}
+
+# Settings lines in the M503 report, like "echo:  M201 X9000 Y9000 Z100 E10000"
+M503_SETTING = re.compile(r'M(\d+)((?:\s+[A-Z]-?[\d.]+)+)')
+
+
+def parse_m503(lines):
+    """Pulls the motion settings out of the lines a printer answered M503 with.
+    @returns dict of gcode number -> {letter: value}, like {201: {'X': 9000.0}}
+    """
+    settings = {}
+    for line in lines:
+        match = M503_SETTING.search(line)
+        if match:
+            words = match.group(2).split()
+            settings[int(match.group(1))] = dict((w[0], float(w[1:])) for w in words)
+    return settings
+
+
+def save_move(path, model, start, end, feedrate, started):
+    """Writes down a move next to a recording made during it, so that the
+    processing code can work out where the head was for every frame.
+    @param started: time.monotonic() when the move was sent
+    """
+    with open(path, 'w') as f:
+        json.dump({'start': list(map(float, start)), 'end': list(map(float, end)),
+                   'feedrate': float(feedrate), 'started': started,
+                   'model': model.to_dict()}, f, indent=2)
+
+
+def load_move(path):
+    """Reads a move written by save_move.
+    @returns (Segment, time.monotonic() when the move was sent)
+    """
+    with open(path) as f:
+        move = json.load(f)
+    model = MotionModel(**move['model'])
+    return model.segment(move['start'], move['end'], move['feedrate']), move['started']
+
+
+class Segment(object):
+    """One straight move that starts and ends at rest, with a trapezoidal
+    speed profile along it."""
+    def __init__(self, start, end, speed, acceleration, jerk_speed):
+        """
+        @param start, end: (x, y, z) in mm
+        @param speed: cruise speed in mm/s, already limited by every axis
+        @param acceleration: mm/s^2 along the move
+        @param jerk_speed: mm/s the head can jump to from rest
+        """
+        self.start = np.asarray(start, dtype=float)
+        self.end = np.asarray(end, dtype=float)
+        self.length = float(np.linalg.norm(self.end - self.start))
+        self.direction = (self.end - self.start) / self.length if self.length else np.zeros(3)
+        self.acceleration = float(acceleration)
+        self.entry_speed = min(float(jerk_speed), float(speed))
+        self.speed = float(speed)
+        # Distance spent speeding up (and the same again slowing down). If the
+        # move is too short to reach the speed it's a triangle instead.
+        ramp = (self.speed ** 2 - self.entry_speed ** 2) / (2 * self.acceleration)
+        if 2 * ramp > self.length:
+            ramp = self.length / 2
+            self.speed = np.sqrt(self.acceleration * self.length + self.entry_speed ** 2)
+        self.ramp_distance = ramp
+        self.ramp_time = (self.speed - self.entry_speed) / self.acceleration
+        self.cruise_time = (self.length - 2 * ramp) / self.speed if self.length else 0.0
+
+    @property
+    def duration(self):
+        """Seconds from the start of the move until the head stops"""
+        if not self.length:
+            return 0.0
+        return 2 * self.ramp_time + self.cruise_time
+
+    def distance_at(self, t):
+        """Distance along the move <t> seconds after it started (clipped to
+        the ends), for a number or an array of times."""
+        t = np.clip(np.asarray(t, dtype=float), 0.0, self.duration)
+        a, v0, v = self.acceleration, self.entry_speed, self.speed
+        braking = t - self.ramp_time - self.cruise_time
+        return np.where(
+            t < self.ramp_time, v0 * t + 0.5 * a * t ** 2,
+            np.where(braking < 0, self.ramp_distance + v * (t - self.ramp_time),
+                     self.length - self.ramp_distance + v * braking - 0.5 * a * braking ** 2))
+
+    def position_at(self, t):
+        """(x, y, z) of the head <t> seconds after the move started, shape
+        (3,) for a single time or (len(t), 3) for an array."""
+        distance = self.distance_at(t)
+        return self.start + np.multiply.outer(distance, self.direction)
+
+    def __repr__(self):
+        return 'Segment(%.2f mm, %.3f s, cruising at %.1f mm/s)' % (
+            self.length, self.duration, self.speed)
+
+
+class MotionModel(object):
+    """Per-axis speed, acceleration and jerk limits of a printer."""
+    def __init__(self, max_feedrate, max_acceleration, acceleration=DEFAULT_ACCELERATION, jerk=(10.0, 10.0, 0.4)):
+        """
+        @param max_feedrate: (x, y, z) fastest each axis moves, mm/s
+        @param max_acceleration: (x, y, z) mm/s^2 limit of each axis
+        @param acceleration: mm/s^2 the firmware uses for moves
+        @param jerk: (x, y, z) mm/s each axis can jump to from rest
+        """
+        self.max_feedrate = np.asarray(max_feedrate, dtype=float)
+        self.max_acceleration = np.asarray(max_acceleration, dtype=float)
+        self.acceleration = float(acceleration)
+        self.jerk = np.asarray(jerk, dtype=float)
+
+    @classmethod
+    def from_profile(cls, name):
+        if name not in PROFILES:
+            raise ValueError('Unknown motion profile %s, choose from %s' % (name, sorted(PROFILES)))
+        return cls(**PROFILES[name])
+
+    @classmethod
+    def from_m503(cls, lines, fallback='default'):
+        """Model from a printer's M503 report. Settings the firmware didn't
+        report are taken from the <fallback> profile."""
+        return cls.from_settings(parse_m503(lines), fallback)
+
+    @classmethod
+    def from_settings(cls, settings, fallback='default'):
+        """Model from M503 settings already run through parse_m503"""
+        model = cls.from_profile(fallback)
+
+        def axes(code, current):
+            values = settings.get(code, {})
+            return [values.get(axis, current[i]) for i, axis in enumerate(AXES)]
+
+        model.max_feedrate = np.array(axes(203, model.max_feedrate))
+        model.max_acceleration = np.array(axes(201, model.max_acceleration))
+        model.jerk = np.array(axes(205, model.jerk))
+        # Newer firmware reports P(rint)/R(etract)/T(ravel), older S/T(retract)
+        m204 = settings.get(204, {})
+        if 'P' in m204:
+            model.acceleration = m204.get('T', m204['P'])
+        elif 'S' in m204:
+            model.acceleration = m204['S']
+        return model
+
+    def to_dict(self):
+        return {
+            'max_feedrate': self.max_feedrate.tolist(),
+            'max_acceleration': self.max_acceleration.tolist(),
+            'acceleration': self.acceleration,
+            'jerk': self.jerk.tolist(),
+        }
+
+    def segment(self, start, end, feedrate):
+        """Plans the move from <start> to <end> at <feedrate> mm/min."""
+        start = np.asarray(start, dtype=float)
+        end = np.asarray(end, dtype=float)
+        delta = end - start
+        length = np.linalg.norm(delta)
+        if not length:
+            return Segment(start, end, 1.0, self.acceleration, 0.0)
+        # How fast the move may go so that no single axis exceeds its limits
+        share = np.abs(delta) / length
+        moving = share > 0
+        speed = min(feedrate / 60.0, (self.max_feedrate[moving] / share[moving]).min())
+        acceleration = min(self.acceleration, (self.max_acceleration[moving] / share[moving]).min())
+        jerk_speed = (self.jerk[moving] / share[moving]).min()
+        return Segment(start, end, speed, acceleration, jerk_speed)
+
+    def durations(self, deltas, feedrate=3000.0):
+        """Seconds each of many relative moves takes at <feedrate> mm/min,
+        the same as duration() but for an (n, 3) array of (dx, dy, dz) at
+        once, for planning long scans."""
+        deltas = np.abs(np.asarray(deltas, dtype=float))
+        lengths = np.sqrt((deltas ** 2).sum(axis=1))
+        moving = lengths > 0
+        share = deltas[moving] / lengths[moving, None]
+        with np.errstate(divide='ignore'):
+            speed = np.minimum(feedrate / 60.0, (self.max_feedrate / share).min(axis=1))
+            acceleration = np.minimum(self.acceleration, (self.max_acceleration / share).min(axis=1))
+            entry = np.minimum(speed, (self.jerk / share).min(axis=1))
+        length = lengths[moving]
+        ramp = (speed ** 2 - entry ** 2) / (2 * acceleration)
+        triangle = 2 * ramp > length
+        speed = np.where(triangle, np.sqrt(acceleration * length + entry ** 2), speed)
+        ramp = np.where(triangle, length / 2, ramp)
+        times = np.zeros(len(deltas))
+        times[moving] = 2 * (speed - entry) / acceleration + (length - 2 * ramp) / speed
+        return times
+
+    def duration(self, dx=0.0, dy=0.0, dz=0.0, feedrate=3000.0):
+        """Seconds a relative move of (dx, dy, dz) takes at <feedrate> mm/min"""
+        return self.segment((0, 0, 0), (dx or 0.0, dy or 0.0, dz or 0.0), feedrate).duration
+
+    def __repr__(self):
+        return 'MotionModel(acceleration %.0f mm/s^2, max feedrate %s mm/s)' % (
+            self.acceleration, self.max_feedrate.tolist())
@@ -34,8 +34,8 @@ import socket
 import re
 from functools import wraps, reduce
 from collections import deque
-import gcoder
-from utils import set_utf8_locale, install_locale, decode_utf8
+from . import gcoder
+from .utils import set_utf8_locale, install_locale, decode_utf8
 try:
     set_utf8_locale()
 except:
@@ -43,6 +43,26 @@ except:
 install_locale('pronterface')
 # from printrun.plugins import PRINTCORE_HANDLER
 
+# Seconds the print and send threads wait for a wake up before checking
+# again anyway, in case something changed without waking them
+WAIT_TIMEOUT = 0.1
+# Commands kept in self.sent, the most recent ones
+SENT_HISTORY = 10000
+# Checksummed lines kept for resending. The printer can only ask again for
+# lines it hasn't answered yet, and there are at most window_size of those.
+RESEND_HISTORY = 1024
+# Seconds without an ok before the commands still waiting for one are given up
+# on, since an ok the printer dropped would otherwise hold everything up for
+# good. Has to be longer than the slowest command, like an M400 after a long
+# slow move.
+ACK_TIMEOUT = 300.0
+
+class Ack(threading.Event):
+    """Set when the printer answers a command sent with send_and_wait, or when
+    its answer isn't going to come anymore, which sets lost too"""
+    lost = False
+
+
 def locked(f):
     @wraps(f)
     def inner(*args, **kw):
@@ -72,13 +92,33 @@ class printcore():
         self.baud = None
         self.dtr = None
         self.port = None
+        # Follows the position through every command sent, so that pause
+        # can go back to it on resume. Set to None to save the time it takes.
         self.analyzer = gcoder.GCode()
         # Serial instance connected to the printer, should be None when
         # disconnected
         self.printer = None
         # clear to send, enabled after responses
-        # FIXME: should probably be changed to a sliding window approach
         self.clear = 0
+        # Notified whenever something the print and send threads wait on
+        # changes: an answer from the printer, the print stopping or the
+        # connection going away
+        self._state_changed = threading.Condition()
+        # How many lines we may send ahead of the printer's oks while
+        # printing. The firmware keeps this many commands in its buffer
+        # (BUFSIZE in Marlin's Configuration_adv.h, 4 by default), so going
+        # above that only leaves lines waiting in its serial buffer. 1 waits
+        # for every ok before sending the next line.
+        self.window_size = 1
+        # Most lines that were ever in flight at once since the print started
+        self.peak_in_flight = 0
+        # Resend requests still to come for lines that were in flight behind
+        # resend_line, the line the printer asked us to resend
+        self.resends_to_ignore = 0
+        self.resend_line = None
+        # oks still to come for the M105s sent while waiting for the printer
+        # to come online, which don't answer anything in pending_acks
+        self.probes_to_ignore = 0
         # The printer has responded to the initial command and is active
         self.online = False
         # is a print currently running, true if printing, false if paused
@@ -91,9 +131,19 @@ class printcore():
         self.paused = False
         self.sentlines = {}
         self.log = deque(maxlen = 10000)
-        self.sent = []
+        self.sent = deque(maxlen = SENT_HISTORY)
+        # One (lineno, ack) entry per command written to the printer that
+        # hasn't been answered with an ok yet, oldest first. lineno is None
+        # for commands without a line number and checksum. Commands sent with
+        # send_and_wait have an Ack as their ack, which is set by their ok.
+        self.pending_acks = deque()
+        self.ack_timeout = ACK_TIMEOUT
+        # time.monotonic() of the last ok
+        self.last_ok = time.monotonic()
         self.writefailures = 0
         self.tempcb = None  # impl (wholeline)
+        self.poscb = None  # impl (wholeline, time received)
+        self.hostcommandcb = None  # impl (wholeline)
         self.recvcb = None  # impl (wholeline)
         self.sendcb = None  # impl (wholeline)
         self.preprintsendcb = None  # impl (wholeline)
@@ -152,6 +202,7 @@ class printcore():
                 self.read_thread = None
             if self.print_thread:
                 self.printing = False
+                self._wake()
                 self.print_thread.join()
             self._stop_sender()
             try:
@@ -166,6 +217,7 @@ class printcore():
         self.printer = None
         self.online = False
         self.printing = False
+        self._release_acks()
 
     @locked
     def connect(self, port = None, baud = None, dtr=None):
@@ -253,6 +305,8 @@ class printcore():
             self.printer.setDTR(1)
             time.sleep(0.2)
             self.printer.setDTR(0)
+            # The printer reboots and forgets what it hadn't answered yet
+            self._forget_pending()
 
     def _readline(self):
         try:
@@ -305,8 +359,10 @@ class printcore():
                 and self.printer.isOpen())
 
     def _listen_until_online(self):
+        probes = 0
         while not self.online and self._listen_can_continue():
             self._send("M105")
+            probes += 1
             if self.writefailures >= 4:
                 logging.error(_("Aborting connection attempt after 4 failed writes."))
                 return
@@ -330,6 +386,16 @@ class printcore():
                 if line.startswith(tuple(self.greetings)) \
                    or line.startswith('ok') or "T:" in line:
                     self.online = True
+                    # The probes aren't in the way of real commands, but the
+                    # oks for the ones still unanswered may come in late. An
+                    # ok answers the first of them, and a greeting means the
+                    # printer just booted and lost the ones sent before.
+                    if line.startswith('ok'):
+                        probes -= 1
+                    elif line.startswith(tuple(self.greetings)):
+                        probes = 0
+                    self.probes_to_ignore = probes
+                    self.pending_acks.clear()
                     for handler in self.event_handler:
                         try: handler.on_online()
                         except: logging.error(traceback.format_exc())
@@ -344,14 +410,39 @@ class printcore():
         self.clear = True
         if not self.printing:
             self._listen_until_online()
+        after_resend = False
         while self._listen_can_continue():
             line = self._readline()
             if line is None:
                 break
             if line.startswith('DEBUG_'):
                 continue
+            if line.startswith('ok'):
+                self.last_ok = time.monotonic()
+            if line.startswith('ok') and self.probes_to_ignore:
+                # Late answer to an M105 from _listen_until_online
+                self.probes_to_ignore -= 1
+                continue
+            if line.startswith('ok') and after_resend:
+                # Marlin and Repetier follow every resend request with an ok
+                # for the line they turned down, which isn't in pending_acks
+                # anymore
+                after_resend = False
+                self.clear = True
+                self._wake()
+                continue
+            if line:
+                after_resend = False
+            if line.startswith(tuple(self.greetings)) and self.online:
+                # The printer restarted, nothing we sent before is going to
+                # be answered
+                self._forget_pending()
             if line.startswith(tuple(self.greetings)) or line.startswith('ok'):
                 self.clear = True
+            if line.startswith('ok') and self.pending_acks:
+                lineno, ack = self.pending_acks.popleft()
+                if ack is not None:
+                    ack.set()
             if line.startswith('ok') and "T:" in line:
                 for handler in self.event_handler:
                     try: handler.on_temp(line)
@@ -362,21 +453,114 @@ class printcore():
                 except: self.logError(traceback.format_exc())
             elif line.startswith('Error'):
                 self.logError(line)
+            elif line.startswith('X:') and self.poscb:
+                # position report (M114 or auto-report), timestamped here so
+                # it isn't delayed by whatever the callback's consumer does
+                try: self.poscb(line, time.monotonic())
+                except: self.logError(traceback.format_exc())
             # Teststrings for resend parsing       # Firmware     exp. result
             # line="rs N2 Expected checksum 67"    # Teacup       2
             if line.lower().startswith("resend") or line.startswith("rs"):
+                after_resend = True
                 for haystack in ["N:", "N", ":"]:
                     line = line.replace(haystack, " ")
                 linewords = line.split()
+                toresend = None
                 while len(linewords) != 0:
                     try:
                         toresend = int(linewords.pop(0))
-                        self.resendfrom = toresend
                         break
                     except:
                         pass
+                if self.resends_to_ignore and toresend == self.resend_line:
+                    # The firmware turns down every numbered line after the
+                    # one it wants again, and asks for that one each time.
+                    # Those lines get resent anyway. Marlin drops the lines
+                    # still in its receive buffer without asking, so fewer of
+                    # these may come than we counted.
+                    self.resends_to_ignore -= 1
+                    self.clear = True
+                    self._wake()
+                    continue
+                if toresend is not None:
+                    self.resendfrom = toresend
+                    self.resend_line = toresend
+                    # The line asked for and everything after it gets sent
+                    # again, and goes back into pending_acks then
+                    resent = [entry for entry in self.pending_acks
+                              if entry[0] is not None and entry[0] >= toresend]
+                    for entry in resent:
+                        self.pending_acks.remove(entry)
+                    self.resends_to_ignore = sum(1 for lineno, ack in resent
+                                                 if lineno > toresend)
                 self.clear = True
+            if line:
+                self._wake()
         self.clear = True
+        self._release_acks()
+        self._wake()
+
+    def _release_acks(self):
+        """Gives up on every command still waiting for an ok, waking up
+        everyone waiting in send_and_wait. They find out that they weren't
+        acknowledged through Ack.lost."""
+        while self.pending_acks:
+            lineno, ack = self.pending_acks.popleft()
+            if ack is not None:
+                ack.lost = True
+                ack.set()
+        self._wake()
+
+    def _forget_pending(self):
+        """Starts counting oks afresh, after the printer restarted"""
+        self._release_acks()
+        self.probes_to_ignore = 0
+        self.resends_to_ignore = 0
+
+    @property
+    def in_flight(self):
+        """Lines sent to the printer that it hasn't answered yet"""
+        return len(self.pending_acks)
+
+    def _wake(self):
+        """Wakes up the print and send threads to check what they're waiting
+        for again"""
+        with self._state_changed:
+            self._state_changed.notify_all()
+
+    def _wait_until(self, ready):
+        """Blocks until ready() is True, or printing stops, or the printer
+        goes away"""
+        with self._state_changed:
+            while self.printer and self.printing and not ready():
+                self._state_changed.wait(WAIT_TIMEOUT)
+
+    def _wait_for_acks(self, ready):
+        """_wait_until for things that need oks from the printer. If none
+        comes in for ack_timeout seconds, the commands still waiting for one
+        are given up on (see _release_acks).
+        returns ready()
+        """
+        started = time.monotonic()
+
+        def stalled():
+            return time.monotonic() - max(started, self.last_ok) > self.ack_timeout
+
+        self._wait_until(lambda: ready() or stalled())
+        done = ready()
+        if not done and self.printing and stalled():
+            self.logError(_("No ok from the printer for %d s, giving up on the %d commands "
+                            "it hasn't answered") % (self.ack_timeout, len(self.pending_acks)))
+            self._release_acks()
+        return done
+
+    def _can_send(self):
+        """Whether another line may go out: while fewer than window_size are
+        waiting for an ok. Lines the printer doesn't answer (comments, host
+        commands) never count, so they can't open the window any wider."""
+        if self.printer_tcp and self.tcp_streaming_mode:
+            return True
+        return len(self.pending_acks) < self.window_size
 
     def _start_sender(self):
         self.stop_send_thread = False
@@ -395,11 +579,16 @@ class printcore():
                 command = self.priqueue.get(True, 0.1)
             except QueueEmpty:
                 continue
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
-            self._send(command)
-            while self.printer and self.printing and not self.clear:
-                time.sleep(0.001)
+            command, ack = self._unpack(command)
+            self._wait_until(self._can_send)
+            self._send(command, ack = ack)
+            self._wait_until(self._can_send)
+
+    def _unpack(self, item):
+        """priqueue holds either a command or (command, ack Event)"""
+        if isinstance(item, tuple):
+            return item
+        return item, None
 
     def _checksum(self, command):
         return reduce(lambda x, y: x ^ y, map(ord, command))
@@ -418,6 +607,8 @@ class printcore():
         self.printing = True
         self.lineno = 0
         self.resendfrom = -1
+        self.resends_to_ignore = 0
+        self.peak_in_flight = 0
         self._send("M110", -1, True)
         if not gcode or not gcode.lines:
             return True
@@ -453,6 +644,7 @@ class printcore():
         if not self.printing: return False
         self.paused = True
         self.printing = False
+        self._wake()
 
         # try joining the print thread: enclose it in try/except because we
         # might be calling it from the thread itself
@@ -469,6 +661,8 @@ class printcore():
         self.print_thread = None
 
         # saves the status
+        if self.analyzer is None:
+            return
         self.pauseX = self.analyzer.abs_x
         self.pauseY = self.analyzer.abs_y
         self.pauseZ = self.analyzer.abs_z
@@ -480,7 +674,7 @@ class printcore():
         """Resumes a paused print.
         """
         if not self.paused: return False
-        if self.paused:
+        if self.analyzer is not None:
             # restores the status
             self.send_now("G90")  # go to absolute coordinates
 
@@ -527,6 +721,19 @@ class printcore():
         else:
             self.logError(_("Not connected to printer."))
 
+    def send_and_wait(self, command, timeout = None):
+        """Sends a command ahead of the command queue like send_now, then
+        blocks until the printer answers it with an ok. Meant for commands
+        like M400 that the firmware only acknowledges once they're done.
+        returns True if the ok came in, False on timeout or disconnect.
+        """
+        if not self.online:
+            self.logError(_("Not connected to printer."))
+            return False
+        ack = Ack()
+        self.priqueue.put_nowait((command, ack))
+        return ack.wait(timeout) and not ack.lost
+
     def _print(self, resuming = False):
         self._stop_sender()
         try:
@@ -543,7 +750,7 @@ class printcore():
                 self._sendnext()
             self.sentlines = {}
             self.log.clear()
-            self.sent = []
+            self.sent.clear()
             for handler in self.event_handler:
                 try: handler.on_end()
                 except: logging.error(traceback.format_exc())
@@ -561,16 +768,19 @@ class printcore():
             self._start_sender()
 
     def process_host_command(self, command):
-        """only ;@pause command is implemented as a host command in printcore, but hosts are free to reimplement this method"""
+        """only ;@pause command is implemented as a host command in printcore,
+        the rest go to hostcommandcb. Runs in the print thread, so nothing
+        more is sent until it returns."""
         command = command.lstrip()
         if command.startswith(";@pause"):
             self.pause()
+        elif self.hostcommandcb:
+            self.hostcommandcb(command)
 
     def _sendnext(self):
         if not self.printer:
             return
-        while self.printer and self.printing and not self.clear:
-            time.sleep(0.001)
+        self._wait_until(self._can_send)
         # Only wait for oks when using serial connections or when not using tcp
         # in streaming mode
         if not self.printer_tcp or not self.tcp_streaming_mode:
@@ -579,12 +789,18 @@ class printcore():
             self.clear = True
             return
         if self.resendfrom < self.lineno and self.resendfrom > -1:
+            if self.resendfrom not in self.sentlines:
+                self.logError(_("Printer asked for line %d again, which is too old to resend")
+                              % self.resendfrom)
+                self.printing = False
+                return
             self._send(self.sentlines[self.resendfrom], self.resendfrom, False)
             self.resendfrom += 1
             return
         self.resendfrom = -1
         if not self.priqueue.empty():
-            self._send(self.priqueue.get_nowait())
+            command, ack = self._unpack(self.priqueue.get_nowait())
+            self._send(command, ack = ack)
             self.priqueue.task_done()
             return
         if self.printing and self.queueindex < len(self.mainqueue):
@@ -617,6 +833,17 @@ class printcore():
                 return
             tline = gline.raw
             if tline.lstrip().startswith(";@"):  # check for host command
+                # Host commands go with the printer's state after everything
+                # before them, so let it answer all of that first
+                if not self._wait_for_acks(lambda: not self.pending_acks) and self.printing:
+                    self.logError(_("Stopping before %s, the printer didn't answer "
+                                    "everything before it") % tline.strip())
+                    self.printing = False
+                    return
+                if not self.printing:
+                    # Paused or cancelled while waiting. A resumed print
+                    # starts from this host command again.
+                    return
                 self.process_host_command(tline)
                 self.queueindex += 1
                 self.clear = True
@@ -637,6 +864,11 @@ class printcore():
                 self.clear = True
             self.queueindex += 1
         else:
+            if self.pending_acks:
+                # With more than one line in flight the last ones may not
+                # have been answered yet, and may still have to be resent
+                self._wait_for_acks(lambda: not self.pending_acks or self.resendfrom > -1)
+                return
             self.printing = False
             self.clear = True
             if not self.paused:
@@ -644,22 +876,24 @@ class printcore():
                 self.lineno = 0
                 self._send("M110", -1, True)
 
-    def _send(self, command, lineno = 0, calcchecksum = False):
+    def _send(self, command, lineno = 0, calcchecksum = False, ack = None):
         # Only add checksums if over serial (tcp does the flow control itself)
         if calcchecksum and not self.printer_tcp:
             prefix = "N" + str(lineno) + " " + command
             command = prefix + "*" + str(self._checksum(prefix))
             if "M110" not in command:
                 self.sentlines[lineno] = command
+                self.sentlines.pop(lineno - RESEND_HISTORY, None)
         if self.printer:
             self.sent.append(command)
             # run the command through the analyzer
             gline = None
-            try:
-                gline = self.analyzer.append(command, store = False)
-            except:
-                logging.warning(_("Could not analyze command %s:") % command +
-                                "\n" + traceback.format_exc())
+            if self.analyzer is not None:
+                try:
+                    gline = self.analyzer.append(command, store = False)
+                except:
+                    logging.warning(_("Could not analyze command %s:") % command +
+                                    "\n" + traceback.format_exc())
             if self.loud:
                 logging.info("SENT: %s" % command)
 
@@ -670,6 +904,9 @@ class printcore():
                 try: self.sendcb(command, gline)
                 except: self.logError(traceback.format_exc())
             try:
+                entry = (lineno if command.startswith("N") else None, ack)
+                self.pending_acks.append(entry)
+                self.peak_in_flight = max(self.peak_in_flight, len(self.pending_acks))
                 self.printer.write((command + "\n").encode('ascii'))
                 if self.printer_tcp:
                     try:
@@ -690,3 +927,6 @@ class printcore():
             except RuntimeError as e:
                 self.logError(_("Socket connection broken, disconnected. ({0}): {1}").format(e.errno, decode_utf8(e.strerror)))
                 self.writefailures += 1
+            if self.writefailures and self.pending_acks and self.pending_acks[-1] is entry:
+                # it never got to the printer, so there's no ok coming for it
+                self.pending_acks.pop()
@@ -23,7 +23,9 @@ import serial
 import logging
 import threading
 from serial import SerialException
-from printcore import printcore
+from .printcore import printcore
+from .motion import MotionModel, parse_m503
+from .telemetry import PositionLog, Poller, parse_m114, AXES, TELEMETRY_INTERVAL
 import time
 
 logger = logging.getLogger(__name__)
@@ -66,26 +68,110 @@ class Status(object):
         return self.extruder_temp != 0
 
 
+class MachineProfile(object):
+    """How to talk to one kind of machine, and what to keep asking it while
+    it's connected."""
+    def __init__(self, name, baudrate=250000, greetings=('start', 'Grbl '), window=1,
+                 motion='default', travel=None, status_polls=(), monitor_interval=3,
+                 poll_when_idle=False):
+        """
+        @param baudrate: baudrate setting of the firmware
+        @param greetings: starts of the lines the firmware says hello with
+        @param window: lines to send ahead of the printer's oks while running
+                       a program, at most the firmware's command buffer
+                       (BUFSIZE, 4 on Marlin). 1 waits for every ok.
+        @param motion: name of the printer.motion profile with its speed,
+                       acceleration and jerk limits, for the settings M503
+                       doesn't report
+        @param travel: (x, y, z) mm each axis can move, None if we don't know
+        @param status_polls: (command, every) pairs, each command is sent
+                             once every <every> status checks
+        @param monitor_interval: seconds between status checks
+        @param poll_when_idle: only send the polls when nothing else is
+                               queued or waiting for an answer, so they never
+                               hold up a move
+        """
+        self.name = name
+        self.baudrate = baudrate
+        self.greetings = tuple(greetings)
+        self.window = window
+        self.motion = motion
+        self.travel = travel
+        self.status_polls = tuple(status_polls)
+        self.monitor_interval = monitor_interval
+        self.poll_when_idle = poll_when_idle
+
+    def check_travel(self, extent):
+        """Raises ValueError if a scan <extent> (x, y, z) mm across doesn't
+        fit on the machine"""
+        if self.travel is None:
+            return
+        for axis, size, limit in zip('xyz', extent, self.travel):
+            if abs(size) > limit:
+                raise ValueError('The scan is %s mm across in %s, but the %s machine only moves %s mm'
+                                 % (abs(size), axis, self.name, limit))
+
+    def __repr__(self):
+        return 'MachineProfile(%s)' % self.name
+
+
+MACHINES = {
+    # Any Marlin 3D printer. Checks on the SD card print (M27) and the
+    # temperatures (M105) like a printer host does.
+    'printer': MachineProfile('printer', status_polls=(('M27', 1), ('M105', 10))),
+    # The TAZ 5 in science center 102 with the microphone on it. Nothing gets
+    # hot and there's no SD card print, so it isn't asked about either, and
+    # programs keep Marlin's 4 command buffer full.
+    'scanner': MachineProfile('scanner', window=4, motion='taz5', travel=(298.0, 275.0, 250.0)),
+}
+
+
 class Printer(object):
     """Generic Printer control class. Connect and move the printer head using
     this check."""
-    def __init__(self, serial=None, baudrate=250000, block=True):
+    def __init__(self, serial=None, baudrate=None, block=True, window=None, profile='printer'):
         '''initializes our printer class. Will choose the first USB device
         detected if serial was not specified.
         
         @param serial:
-        @param baudrate: baudrate setting of your 3D printer/CNC
+        @param baudrate: baudrate setting of your 3D printer/CNC, None for
+                         the profile's
         @param block: will we block until printer has been connected?
+        @param window: lines to send ahead of the printer's oks while running
+                       a program, None for the profile's
+        @param profile: MachineProfile or the name of one in MACHINES
         '''
+        if not isinstance(profile, MachineProfile):
+            if profile not in MACHINES:
+                raise ValueError('Unknown machine %s, choose from %s' % (profile, sorted(MACHINES)))
+            profile = MACHINES[profile]
+        self.profile = profile
         # Set the current status of the printer
         self.status = Status()
         self.statuscheck = False
         self.status_thread = None
+        # Set to stop the status checks right away instead of after their
+        # next wait
+        self._status_stop = threading.Event()
         self.paused = False
         self.userm114 = 0
         self.userm105 = 0
-        self.m105_waitcycles = 0
-        self.monitor_interval = 3
+        self.status_cycles = 0
+        self.monitor_interval = profile.monitor_interval
+        # Lines the printer sends back are collected here while we're waiting
+        # for the answer to a query like M503
+        self._replies = None
+        self._replies_lock = threading.Lock()
+        self._settings = None
+        # Measured head positions, filled in while telemetry is running
+        self.positions = PositionLog()
+        self.steps_per_mm = None
+        self._poller = None
+        self._autoreport = False
+        # Positioning mode ("G90" or "G91") and feedrate we last sent, so we
+        # only send them again when they change. None when we don't know.
+        self._mode = None
+        self._feedrate = None
 
         if not serial:
             possible_serials = self.scanserial()
@@ -97,11 +183,13 @@ class Printer(object):
         print('Attempting to look for connections on: %s' % self.serial)
 
         # PARAMETERS THAT MAY NEED TO BE CHANGED
-        self.baudrate = baudrate
+        self.baudrate = baudrate or profile.baudrate
 
         # Connect using lower level printcore system
+        self._p = printcore()
+        self._p.greetings = list(profile.greetings)
         try:
-            self._p = printcore(port=self.serial, baud=self.baudrate)
+            self._p.connect(self.serial, self.baudrate)
         except SerialException as e:
             # Currently, there is no errno, but it should be there in the future
             if e.errno == 2:
@@ -118,6 +206,9 @@ class Printer(object):
             else:
                 raise RuntimeError(str(e))
         
+        self._p.recvcb = self._recv
+        self._p.window_size = window or profile.window
+
         self.statuscheck = True
         self.status_thread = threading.Thread(target = self.statuschecker)
         self.status_thread.start()
@@ -128,33 +219,45 @@ class Printer(object):
     def reset(self):
         '''resets the internal implementation of the printer'''
         self._p.reset()
-    
+        # The firmware starts over in absolute mode at its default feedrate
+        self._mode = None
+        self._feedrate = None
+
+    def _set_mode(self, mode):
+        """Switches to absolute (G90) or relative (G91) positioning, unless
+        the printer is in that mode already"""
+        if mode != self._mode:
+            self._p.send_now(mode)
+            self._mode = mode
+
+    def _move_command(self, x, y, z, speed):
+        """G0 for the axes that aren't None, with the feedrate only if it
+        changed since the last move"""
+        pkt = "G0"
+        for axis, value in zip("XYZ", (x, y, z)):
+            if value is not None:
+                pkt += " {}{}".format(axis, value)
+        if speed and speed != self._feedrate:
+            pkt += " F{}".format(speed)
+            self._feedrate = speed
+        return pkt
+
     def move_coord(self, x=None, y=None, z=None, speed=None):
         """Moves x, y, z units relative to the current position at a certain
-        speed. The speed is measured in mm/minute, and defaults at 6cm/sec."""
-        self._p.send_now("G91")
-        pkt = "G0 "
-        pkt += "X{} ".format(x) if x else ""
-        pkt += "Y{} ".format(y) if y else ""
-        pkt += "Z{} ".format(z) if z else ""
-        pkt += "F{} ".format(speed) if speed else ""
-        self._p.send_now(pkt)
-        self._p.send_now("G90")
-
+        speed. The speed is measured in mm/minute, and defaults at 6cm/sec.
+        Leaves the printer in relative mode until the next move_abs."""
+        self._set_mode("G91")
+        self._p.send_now(self._move_command(x or None, y or None, z or None, speed))
 
     def move_abs(self, x=None, y=None, z=None, speed=None):
         """Moves to the coordinate (x, y, z) units relative to the origin. The
-        origin location can be set with the reset_origin function. The speed is
-        measured in mm/minute, and defaults at 6cm/sec."""
-        self._p.send_now("G91")
-        pkt = "G0 "
-        pkt += "X{} ".format(x) if x else ""
-        pkt += "Y{} ".format(y) if y else ""
-        pkt += "Z{} ".format(z) if z else ""
-        pkt += "F{} ".format(speed) if speed else ""
-        pkt += "\n"
-        self._p.send_now(pkt)
-        
+        origin location can be set with the reset_origin function. Axes that
+        are None stay where they are. The speed is measured in mm/minute, and
+        defaults at 6cm/sec. Only one command goes out per move once the
+        printer is in absolute mode."""
+        self._set_mode("G90")
+        self._p.send_now(self._move_command(x, y, z, speed))
+
     def move_now(self, l):
         """Executes an immediate move command in the form <axis> <number>"""
         if len(l.split()) < 2:
@@ -184,10 +287,143 @@ class Printer(object):
         self._p.send_now("G91")
         self._p.send_now("G0 " + axis + str(l[1]))
         self._p.send_now("G90")
+        self._mode = "G90"
+
+    def wait_for_moves(self, timeout=None):
+        """Blocks until every move we've sent has finished, by sending M400
+        (which the firmware only answers once its planner is empty) and
+        waiting for its ok.
+        @param timeout: seconds to wait at most, None for forever
+        @returns (bool) False if we timed out or lost the printer first
+        """
+        return self._p.send_and_wait("M400", timeout)
+
+    def run_program(self, program, on_capture, timeout=None):
+        """Streams a whole program (see planner.program) with printcore's
+        print thread and blocks until it is done. Each ";@capture" host
+        command calls <on_capture> with the rest of the line, after the
+        M400 before it was answered; nothing more is sent until it returns.
+        @param program: printer.gcoder.LightGCode
+        @param timeout: seconds to wait at most for the whole program
+        """
+        done = threading.Event()
+        errors = []
+
+        def host_command(command):
+            if errors:
+                return
+            try:
+                on_capture(command)
+            except Exception as e:
+                # Raising here would kill the print thread without telling
+                # anyone, so stop streaming and raise it from here instead
+                errors.append(e)
+                self._p.printing = False
+
+        self._p.hostcommandcb = host_command
+        self._p.endcb = done.set
+        try:
+            if not self._p.startprint(program):
+                raise RuntimeError('Printer is offline or already running a program')
+            if not done.wait(timeout):
+                self._p.cancelprint()
+                raise RuntimeError('Program did not finish within %s s' % timeout)
+            if self._p.queueindex and not errors:
+                # The print thread gave up without getting to the end (it
+                # starts over at 0 when it does)
+                raise RuntimeError('Program stopped at line %d, see the log for why'
+                                   % self._p.queueindex)
+        finally:
+            self._p.hostcommandcb = None
+            self._p.endcb = None
+            # A program that stopped halfway may have left either mode
+            self._mode = None
+            self._feedrate = None
+        if errors:
+            raise errors[0]
+
+    def query(self, command, timeout=None):
+        """Sends <command> and collects everything the printer says until
+        it answers ok.
+        @returns list of the lines received, without the ok
+        """
+        with self._replies_lock:
+            self._replies = []
+            try:
+                if not self._p.send_and_wait(command, timeout):
+                    raise RuntimeError('Printer did not answer %s within %s s' % (command, timeout))
+                return [line for line in self._replies
+                        if not line.startswith('ok') and not line.startswith('X:')]
+            finally:
+                self._replies = None
+
+    def firmware_settings(self, timeout=5.0):
+        """The firmware's settings report (M503), read once.
+        @returns dict of gcode number -> {letter: value}, see parse_m503
+        """
+        if self._settings is None:
+            self._settings = parse_m503(self.query("M503", timeout))
+        return self._settings
+
+    def motion_model(self, timeout=5.0, fallback=None):
+        """Reads the feedrate, acceleration and jerk limits from the
+        firmware's settings report (M503).
+        @param fallback: motion profile for the settings it doesn't report,
+                         None for the machine profile's
+        @returns printer.motion.MotionModel
+        """
+        return MotionModel.from_settings(self.firmware_settings(timeout),
+                                         fallback or self.profile.motion)
+
+    def start_telemetry(self, interval=TELEMETRY_INTERVAL, autoreport=None):
+        """Starts logging where the head is to self.positions, every
+        <interval> seconds.
+        @param autoreport: have the firmware send its position on its own
+                           (M154) instead of polling M114. It only counts in
+                           whole seconds, so by default it's only used for
+                           intervals of a second or more, and only if the
+                           firmware says it can (M115).
+        """
+        self.stop_telemetry()
+        steps = self.firmware_settings().get(92, {})
+        if all(axis in steps for axis in AXES):
+            self.steps_per_mm = tuple(steps[axis] for axis in AXES)
+        if autoreport is None:
+            autoreport = interval >= 1 and any('AUTOREPORT_POS:1' in line
+                                               for line in self.query("M115", 5.0))
+        self._p.poscb = self._position
+        if autoreport:
+            self._p.send_now("M154 S%d" % max(1, int(round(interval))))
+            self._autoreport = True
+        else:
+            self._poller = Poller(self._p.send_now, "M114", interval)
+
+    def stop_telemetry(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+        if self._autoreport:
+            self._p.send_now("M154 S0")
+            self._autoreport = False
+        self._p.poscb = None
+
+    def _position(self, line, timestamp):
+        """Called by printcore's listen thread for every position report"""
+        position = parse_m114(line, self.steps_per_mm)
+        if position is not None:
+            self.positions.append(timestamp, position)
+
+    def _recv(self, line):
+        """Called by printcore's listen thread for every line received"""
+        replies = self._replies
+        if replies is not None:
+            replies.append(line.strip())
 
     def reset_origin(self):
         """Chooses the current point and resets the coordinate axis to the
-        point (0, 0, 0) in XYZ space. Useful for when starting scans."""
+        point (0, 0, 0) in XYZ space. Useful for when starting scans. The
+        point is where the last move sent ends, it doesn't have to have
+        finished."""
         self._p.send_now("G92 X0 Y0 Z0 E0")
 
     @classmethod
@@ -200,7 +436,18 @@ class Printer(object):
             baselist += glob.glob(g)
         return [p for p in baselist if _bluetoothfilter(p)]
 
+    def stop_status(self):
+        """Stops the status checks (M27/M105) and waits for their thread"""
+        self.statuscheck = False
+        self._status_stop.set()
+        thread = self.status_thread
+        if thread is not None and thread is not threading.current_thread():
+            thread.join()
+        self.status_thread = None
+
     def disconnect(self):
+        self.stop_telemetry()
+        self.stop_status()
         self._p.disconnect()
 
     def statuschecker_inner(self, do_monitoring=True):
@@ -210,29 +457,25 @@ class Printer(object):
                 self.status_thread = None
                 self.disconnect()
                 return
-            if do_monitoring:
-                if not self.paused:
-                    self._p.send_now("M27")
-                if self.m105_waitcycles % 10 == 0:
-                    self._p.send_now("M105")
-                self.m105_waitcycles += 1
-        cur_time = time.time()
-        wait_time = 0
-        while time.time() < cur_time + self.monitor_interval - 0.25:
-            if not self.statuscheck:
-                break
-            time.sleep(0.25)
-            # Safeguard: if system time changes and goes back in the past,
-            # we could get stuck almost forever
-            wait_time += 0.25
-            if wait_time > self.monitor_interval - 0.25:
-                break
-        # Always sleep at least a bit, if something goes wrong with the
-        # system time we'll avoid freezing the whole app this way
-        time.sleep(0.25)
+            if do_monitoring and not (self.profile.poll_when_idle and self._busy()):
+                for command, every in self.profile.status_polls:
+                    # SD print status means nothing while paused
+                    if command == "M27" and self.paused:
+                        continue
+                    if self.status_cycles % every == 0:
+                        self._p.send_now(command)
+                self.status_cycles += 1
+        # Waits on the monotonic clock, so changes to the system time can't
+        # stretch it out, and returns as soon as stop_status is called
+        self._status_stop.wait(self.monitor_interval)
+
+    def _busy(self):
+        """Whether anything is queued for the printer or waiting for its
+        answer"""
+        return self._p.printing or not self._p.priqueue.empty() or self._p.in_flight > 0
 
     def statuschecker(self):
-        while self.statuscheck:
+        while self.statuscheck and not self._status_stop.is_set():
             self.statuschecker_inner()
 
 
@@ -0,0 +1,134 @@
+"""Where the head actually is, as opposed to where we told it to go. The
+printer is polled with M114 and every report is kept with the time it came in,
+so recordings can be matched up with the positions measured while they were
+being made.
+
+M114 reports two positions: X:/Y:/Z:, which is where the last planned move
+ends, and the stepper counts after "Count", which is where the motors are
+right now. We want the second one, so the counts are divided by the steps per
+mm from M92 when we know them.
+"""
+import re
+import threading
+import numpy as np
+
+AXES = 'XYZ'
+# Seconds between M114 polls
+TELEMETRY_INTERVAL = 0.05
+# Measurements a PositionLog keeps before overwriting the oldest, about 55
+# minutes of polling every TELEMETRY_INTERVAL. Scans save what they need after
+# every line, so this only has to outlast the longest line.
+POSITION_HISTORY = 65536
+# "X:10.00 Y:0.00 Z:0.00 E:0.00 Count X:800 Y:0 Z:0"
+M114_AXIS = re.compile(r'([XYZ]):\s*(-?[\d.]+)')
+
+
+def parse_m114(line, steps_per_mm=None):
+    """Head position in a M114 report.
+    @param steps_per_mm: (x, y, z) from M92, to use the stepper counts
+    @returns (x, y, z) in mm, or None if <line> isn't a position report
+    """
+    planned, _, counts = line.partition('Count')
+    values = dict(M114_AXIS.findall(planned))
+    if not all(axis in values for axis in AXES):
+        return None
+    position = [float(values[axis]) for axis in AXES]
+    if steps_per_mm is not None and counts:
+        steps = dict(M114_AXIS.findall(counts))
+        if all(axis in steps for axis in AXES):
+            position = [float(steps[axis]) / s for axis, s in zip(AXES, steps_per_mm)]
+    return tuple(position)
+
+
+class PositionLog(object):
+    """Timestamped head positions, appended to from the thread that reads the
+    printer's replies. Only the last <capacity> of them are kept, in a ring,
+    so telemetry can stay on for days without its memory growing."""
+    def __init__(self, capacity=POSITION_HISTORY):
+        self._times = np.empty(capacity)
+        self._positions = np.empty((capacity, 3))
+        # Measurements ever appended, the newest is at (_count - 1) % capacity
+        self._count = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._count, len(self._times))
+
+    def _ordered(self):
+        """(times, positions) of the measurements still kept, oldest first.
+        Views into the ring until it wraps around, copies after that. Call
+        with the lock held."""
+        if self._count <= len(self._times):
+            return self._times[:self._count], self._positions[:self._count]
+        split = self._count % len(self._times)
+        return (np.concatenate([self._times[split:], self._times[:split]]),
+                np.concatenate([self._positions[split:], self._positions[:split]]))
+
+    def append(self, timestamp, position):
+        """
+        @param timestamp: time.monotonic() when the position was measured
+        @param position: (x, y, z) in mm
+        """
+        with self._lock:
+            index = self._count % len(self._times)
+            self._times[index] = timestamp
+            self._positions[index] = position
+            self._count += 1
+
+    def clear(self):
+        with self._lock:
+            self._count = 0
+
+    def between(self, start, end):
+        """Positions measured from <start> to <end> (monotonic times).
+        @returns (times, positions) arrays of shape (n,) and (n, 3)
+        """
+        with self._lock:
+            times, positions = self._ordered()
+            first = np.searchsorted(times, start, side='left')
+            last = np.searchsorted(times, end, side='right')
+            return times[first:last].copy(), positions[first:last].copy()
+
+    def latest(self):
+        """(time, (x, y, z)) of the last measurement, or None"""
+        with self._lock:
+            if not self._count:
+                return None
+            index = (self._count - 1) % len(self._times)
+            return self._times[index], self._positions[index].copy()
+
+    def interpolate(self, times):
+        """Head position at each of <times>, interpolated between the
+        measurements around it.
+        @returns array of shape (len(times), 3)
+        """
+        with self._lock:
+            if not self._count:
+                raise ValueError('No positions have been measured yet')
+            measured, positions = self._ordered()
+            return np.stack([np.interp(times, measured, positions[:, axis])
+                             for axis in range(3)], axis=-1)
+
+    def __repr__(self):
+        return 'PositionLog(%d positions)' % len(self)
+
+
+class Poller(object):
+    """Sends a command every <interval> seconds in a daemon thread, for
+    printers that can't report their position on their own."""
+    def __init__(self, send, command='M114', interval=TELEMETRY_INTERVAL):
+        self.send = send
+        self.command = command
+        self.interval = interval
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.send(self.command)
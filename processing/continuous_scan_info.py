@@ -9,19 +9,22 @@ import argparse
 
 import numpy as np
 from matplotlib import pyplot as plt
+from processing.recordings import load_frames, find_recordings, frame_positions
 
 
 def compile_data_to_array(data_dir, sample_start=None, sample_end=None):
-    fnames = list(sorted(glob.glob(os.path.join(data_dir, "*.pkl"))))
+    """Stacks the continuous lines of a scan into an image, one row per y.
+    Lines recorded in reverse (continuous_<xmax>_<xmin>_<y>) are flipped to
+    run along +x like the others."""
+    fnames = find_recordings(data_dir)
     
     print('Found %s records' % len(fnames))
-    # Load into a list of tuples of xmin, xmax, y, data
+    # Load into a list of tuples of y, xstart, xend, positions, data
     data = []
     XMIN = None
     XMAX = None
     for fname in fnames:
-        with open(fname, 'rb') as f:
-            fft_data = pickle.load(f)
+        fft_data = load_frames(fname)
 
         # Isolate the frequency range we're interested in if we collected
         # extra frequencies. otherwise, just take the argmax along the freqbins
@@ -30,27 +33,31 @@ def compile_data_to_array(data_dir, sample_start=None, sample_end=None):
         if not sample_end: sample_end = n_freq_bins
         amplitudes = fft_data[:, sample_start:sample_end].max(axis=1)
 
-        name = os.path.basename(fname).replace('.pkl', '').replace('continuous_', '')
+        name = os.path.splitext(os.path.basename(fname))[0].replace('continuous_', '')
         coords = [float(coord) for coord in name.split('_')]
-        xmin, xmax, y = coords
-        XMIN = xmin
-        XMAX = xmax
-        data.append((xmin, xmax, y, amplitudes))
+        xstart, xend, y = coords
+        XMIN = min(xstart, xend)
+        XMAX = max(xstart, xend)
+        positions = frame_positions(fname, len(amplitudes), xstart, xend)
+        if xstart > xend:
+            # recorded from xmax back to xmin, flip it so x increases
+            positions, amplitudes = positions[::-1], amplitudes[::-1]
+        data.append((y, xstart, xend, positions, amplitudes))
         
     # Sort by y coordinate (xmin and xmax are expected to be the same for all)
-    data = list(sorted(data))
+    data = list(sorted(data, key=lambda d: d[0]))
     if not data:
         raise RuntimeError('No Data Found')
         
     # Just get the amplitudes and stack them on each other to form an image
     ampdata = [d[-1] for d in data]
+    positions = [d[-2] for d in data]
 
     # Get the minimum size of any of these, so we can interpolate to a fixed array length
     target_size = np.median(np.array([len(x) for x in ampdata]))
     print('Median number of records in continguous strip: %s' % str(target_size))
-    resized_ampdata = [np.interp(np.linspace(XMIN, XMAX, target_size),
-                       np.linspace(XMIN, XMAX, len(d)), d)
-                       for d in ampdata]
+    resized_ampdata = [np.interp(np.linspace(XMIN, XMAX, int(target_size)), x, d)
+                       for x, d in zip(positions, ampdata)]
     resized_ampdata = np.array(resized_ampdata)
 
     return resized_ampdata
@@ -7,19 +7,45 @@ import skimage
 
 import numpy as np
 from matplotlib import pyplot as plt
+from processing.recordings import load_frames, find_recordings, frame_positions
 
 
-def compile_data_to_array(data_dir, sample_start=None, sample_end=None):
-    fnames = list(sorted(glob.glob(os.path.join(data_dir, "*.pkl"))))
+def estimate_lag(positions, ampdata, directions, grid):
+    """Estimates how far behind the head the recorded frames are, from how
+    far the forward lines are shifted from the reverse ones. A frame lagging
+    by <lag> mm shows up <lag> mm ahead of where it was measured, which is
+    +x on forward lines and -x on reverse lines, so the two disagree by twice
+    the lag.
+    @returns lag in mm
+    """
+    forward = [np.interp(grid, x, d) for x, d, direction in zip(positions, ampdata, directions) if direction > 0]
+    reverse = [np.interp(grid, x, d) for x, d, direction in zip(positions, ampdata, directions) if direction < 0]
+    if not forward or not reverse:
+        return 0.0
+    forward = np.mean(forward, axis=0)
+    reverse = np.mean(reverse, axis=0)
+    correlation = np.correlate(forward - forward.mean(), reverse - reverse.mean(), mode='full')
+    shift = (np.argmax(correlation) - (len(grid) - 1)) * (grid[1] - grid[0])
+    return shift / 2.0
+
+
+def compile_data_to_array(data_dir, sample_start=None, sample_end=None, lag=0.0):
+    """Stacks the continuous lines of a scan into an image, one row per y.
+    Lines recorded in reverse (continuous_<xmax>_<xmin>_<y>) are flipped to
+    run along +x like the others.
+    @param lag: mm the frames lag behind the head, to move them back by
+                along the direction each line was recorded in, or 'auto' to
+                estimate it from the forward and reverse lines
+    """
+    fnames = find_recordings(data_dir)
     
     print('Found %s records' % len(fnames))
-    # Load into a list of tuples of xmin, xmax, y, data
+    # Load into a list of tuples of y, xstart, xend, positions, data
     data = []
     XMIN = None
     XMAX = None
     for fname in fnames:
-        with open(fname, 'rb') as f:
-            fft_data = pickle.load(f)
+        fft_data = load_frames(fname)
 
         # Isolate the frequency range we're interested in if we collected
         # extra frequencies. otherwise, just take the argmax along the freqbins
@@ -30,26 +56,36 @@ def compile_data_to_array(data_dir, sample_start=None, sample_end=None):
         argmaxes = fft_data[:].argmax(axis=1)
         # print(argmaxes)
 
-        name = os.path.basename(fname).replace('.pkl', '').replace('continuous_', '')
+        name = os.path.splitext(os.path.basename(fname))[0].replace('continuous_', '')
         coords = [float(coord) for coord in name.split('_')]
-        xmin, xmax, y = coords
-        XMIN = xmin
-        XMAX = xmax
-        data.append((xmin, xmax, y, amplitudes))
+        xstart, xend, y = coords
+        XMIN = min(xstart, xend)
+        XMAX = max(xstart, xend)
+        positions = frame_positions(fname, len(amplitudes), xstart, xend)
+        if xstart > xend:
+            # recorded from xmax back to xmin, flip it so x increases
+            positions, amplitudes = positions[::-1], amplitudes[::-1]
+        data.append((y, xstart, xend, positions, amplitudes))
         
     # Sort by y coordinate (xmin and xmax are expected to be the same for all)
-    data = list(sorted(data))
+    data = list(sorted(data, key=lambda d: d[0]))
     if not data: raise RuntimeError('No Data Found')
         
     # Just get the amplitudes and stack them on each other to form an image
     ampdata = [d[-1] for d in data]
+    positions = [d[-2] for d in data]
+
+    directions = [np.sign(d[2] - d[1]) for d in data]
 
     # Get the minimum size of any of these, so we can interpolate to a fixed array length
     target_size = np.median(np.array([len(x) for x in ampdata]))
     print('Median number of records in continguous strip: %s' % str(target_size))
-    resized_ampdata = [np.interp(np.linspace(XMIN, XMAX, target_size),
-                       np.linspace(XMIN, XMAX, len(d)), d)
-                       for d in ampdata]
+    grid = np.linspace(XMIN, XMAX, int(target_size))
+    if lag == 'auto':
+        lag = estimate_lag(positions, ampdata, directions, grid)
+        print('Estimated lag between the head and the frames: %.3f mm' % lag)
+    positions = [x - lag * direction for x, direction in zip(positions, directions)]
+    resized_ampdata = [np.interp(grid, x, d) for x, d in zip(positions, ampdata)]
     resized_ampdata = np.array(resized_ampdata)
 
     return resized_ampdata
@@ -65,12 +101,17 @@ if __name__ == '__main__':
     parser.add_argument('--end', default=None, type=int, dest="end",
                         help="Sample number to end calculating from in "
                         "frequency bins from FFT")
+    parser.add_argument('--lag', default='0', type=str, dest="lag",
+                        help="mm the frames lag behind the head, corrected "
+                        "along each line's direction, or 'auto' to estimate "
+                        "it from bidirectional scans")
     parser.add_argument('--save', default=None, type=str, dest="save",
                         help="Where to save resulting image on disk")
     args = parser.parse_args()
 
 
-    ampdata = compile_data_to_array(args.data, args.start, args.end)
+    lag = args.lag if args.lag == 'auto' else float(args.lag)
+    ampdata = compile_data_to_array(args.data, args.start, args.end, lag)
     fig = plt.figure(figsize=(16, 16)) 
     long_side = max(list(ampdata.shape))
     short_side = min(list(ampdata.shape))
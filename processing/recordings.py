@@ -0,0 +1,49 @@
+"""Loading the files a scan writes for every recording, shared by the
+processing scripts: the frames (<name>.npy, or a .pkl dump from older scans),
+the time each frame was captured (<name>.times.npy), the move the scanner
+made during a continuous line (<name>.motion.json) and the head positions
+measured along it (<name>.positions.npy).
+"""
+import glob
+import pickle
+import os
+
+import numpy as np
+
+
+def load_frames(fname):
+    """Loads one recording, either a .npy written while recording or a .pkl
+    dump from older scans."""
+    if fname.endswith('.pkl'):
+        with open(fname, 'rb') as f:
+            return pickle.load(f)
+    return np.load(fname)
+
+
+def find_recordings(data_dir):
+    """Recordings in a scan folder, skipping the frame timestamp files"""
+    fnames = glob.glob(os.path.join(data_dir, "*.pkl"))
+    fnames += [f for f in glob.glob(os.path.join(data_dir, "*.npy"))
+               if not f.endswith('.times.npy') and not f.endswith('.positions.npy')]
+    return list(sorted(fnames))
+
+
+def frame_positions(fname, n_frames, xmin, xmax):
+    """x coordinate of the head for every frame of a continuous line. With
+    the frame times (<name>.times.npy) we use, in order of preference, the
+    positions measured during the line (<name>.positions.npy) or the move the
+    scan saved (<name>.motion.json), which the motion model tells us the head
+    position along. Older scans fall back to assuming the frames are spread
+    evenly over the line."""
+    base = os.path.splitext(fname)[0]
+    if os.path.exists(base + '.times.npy'):
+        times = np.load(base + '.times.npy')[:n_frames]
+        if len(times) == n_frames and os.path.exists(base + '.positions.npy'):
+            measured = np.load(base + '.positions.npy')
+            if len(measured) > 1:
+                return np.interp(times, measured[:, 0], measured[:, 1])
+        if len(times) == n_frames and os.path.exists(base + '.motion.json'):
+            from printer.motion import load_move
+            segment, started = load_move(base + '.motion.json')
+            return segment.position_at(times - started)[:, 0]
+    return np.linspace(xmin, xmax, n_frames)
@@ -7,48 +7,170 @@ current data sources have been:
 The first one takes much less time since the FFT is being done onboard, so
 usually we will be using raw FFT samples from the attached oscilloscope.
 """
+import importlib
+import os
 import time
-import sys
 import numpy as np
-import os
-import tqdm
-sys.path.append('./microphone')
-sys.path.append('./printer')
-
-
-# Switch up the import depending on which data collection device you're using
-# from microphone import Microphone
-from oscilloscope import OscilloscopeMicrophone as Microphone
-from printer import Printer
-from siggen import SignalGenerator
+from printer.motion import MotionModel, save_move
+from planner import ORDER_RASTER, ORDER_SERPENTINE, grid_points, prism_points, scan_lines, \
+    compare_paths, path_length, travel_time, plan_route, points_from_mask, compile_points, \
+    parse_capture
 
 
 PRINTER_CONNECT_TIME = 2.0
+PRINTER_CONNECT_POLL_TIME = 0.05
 MOVEMENT_DELAY_TIME = 0.2
 MOVEMENT_DELAY_MULTIPLIER = 0.1
+# How we know a move has finished. 'm400' asks the printer to tell us (it only
+# answers M400 once its planner is empty), 'sleep' guesses from the distance
+# and speed and pads the guess with the delays above.
+MOTION_SYNC_M400 = 'm400'
+MOTION_SYNC_SLEEP = 'sleep'
+# Seconds to wait for M400 to be answered before giving up on the printer
+MOVE_TIMEOUT = 60.0
+# Padding after a continuous scan line when we have to guess when it ended
+LINE_PADDING_TIME = 0.5
+
+
+# Backends connect to a microphone and a printer, and return them along with a
+# function that connects to the signal generator (which we only do when it's
+# going to be used). They import their modules when they are called, so that
+# importing this file stays fast and works on machines without pyvisa,
+# pyserial or pyaudio installed.
+def oscilloscope_backend(serial=None, machine='printer', **kwargs):
+    """Tektronix oscilloscope FFT as the microphone. <machine> is the name of
+    the printer's profile in printer.printer.MACHINES."""
+    from microphone.oscilloscope import OscilloscopeMicrophone
+    from printer.printer import Printer
+    from siggen.rigol import SignalGenerator
+    print('Trying to connect printer through USB port {}'.format(serial))
+    return OscilloscopeMicrophone(**kwargs), Printer(serial=serial, profile=machine), SignalGenerator
+
+
+def soundcard_backend(serial=None, machine='printer', **kwargs):
+    """Microphone plugged into the computer's microphone jack, <machine> as
+    for oscilloscope_backend"""
+    from microphone.microphone import Microphone
+    from printer.printer import Printer
+    from siggen.rigol import SignalGenerator
+    print('Trying to connect printer through USB port {}'.format(serial))
+    return Microphone(**kwargs), Printer(serial=serial, profile=machine), SignalGenerator
+
+
+def simulated_backend(serial=None, field=None, scope_kwargs=None, **kwargs):
+    """Simulated oscilloscope, signal generator and printer sharing one
+    simulation.AcousticField, which can be passed in as <field> to move the
+    sound around."""
+    from simulation import simulated_rig, SimulatedPrinter
+    from microphone.oscilloscope import OscilloscopeMicrophone
+    from siggen.rigol import SignalGenerator
+    from instruments import InstrumentRegistry
+    rm, field = simulated_rig(field, scope_kwargs)
+    # One registry for both, so the simulated bus is only probed once
+    registry = InstrumentRegistry(rm, cache_path=None)
+    kwargs.setdefault('profile', None)
+    return (OscilloscopeMicrophone(registry=registry, **kwargs),
+            SimulatedPrinter(field),
+            lambda: SignalGenerator(registry=registry))
+
+
+BACKENDS = {
+    'oscilloscope': oscilloscope_backend,
+    'soundcard': soundcard_backend,
+    'sim': simulated_backend,
+}
+
+
+def load_backend(name):
+    """Looks up a backend by name in BACKENDS, or imports it if it is given as
+    'package.module:function'."""
+    if name in BACKENDS:
+        return BACKENDS[name]
+    module, _, function = name.partition(':')
+    if not function:
+        raise ValueError('Unknown backend %s, choose from %s or give '
+                         'module:function' % (name, sorted(BACKENDS)))
+    return getattr(importlib.import_module(module), function)
+
+
+def progress(iterable):
+    """Progress bar over <iterable>. tqdm is only imported once a scan starts."""
+    import tqdm
+    return tqdm.tqdm(iterable)
+
 
 class Scanner(object):
     """Scanner object that manages the printer and the microphone. Each object
     should represent any sequence of scans using the same microphone and
     printer"""
-    def __init__(self, serial=None):
-        self.mic = Microphone()
+    def __init__(self, serial=None, backend='oscilloscope', motion_sync=MOTION_SYNC_M400,
+                 motion=None, telemetry=None, **backend_kwargs):
+        """
+        @param serial: serial port of the printer, found automatically if None
+        @param backend: name of the hardware to use, one of BACKENDS or a
+                        'module:function' returning (microphone, printer,
+                        signal generator factory)
+        @param motion_sync: MOTION_SYNC_M400 to wait for the printer to say
+                            it has stopped, or MOTION_SYNC_SLEEP to sleep for
+                            an estimate of the travel time instead
+        @param motion: printer.motion.MotionModel or the name of a motion
+                       profile, used to work out how long moves take. If
+                       None, the limits are read from the printer's firmware.
+        @param telemetry: seconds between measurements of the head position
+                          (M114), None to not measure it. Continuous scans
+                          save the positions measured during each line.
+        Other keyword arguments go to the backend (like machine='scanner' to
+        pick the printer's profile), and from there to the microphone.
+        """
+        if motion_sync not in (MOTION_SYNC_M400, MOTION_SYNC_SLEEP):
+            raise ValueError('Unknown motion_sync %s, choose from %s or %s'
+                             % (motion_sync, MOTION_SYNC_M400, MOTION_SYNC_SLEEP))
+        connect = load_backend(backend)
+        self.mic, self.p, self._connect_siggen = connect(serial=serial, **backend_kwargs)
         self.siggen = None   # only connect signal generator when it's going to be used
-        print('Trying to connect printer through USB port {}'.format(serial))
-        self.p = Printer(serial=serial)
 
         # Wait some time for handshake to occur with printer
-        time.sleep(PRINTER_CONNECT_TIME)
+        deadline = time.time() + PRINTER_CONNECT_TIME
+        while not self.p.online() and time.time() < deadline:
+            time.sleep(PRINTER_CONNECT_POLL_TIME)
 
         if not self.p.online():
             raise RuntimeError("Printer is not online. Are you connecting to right USB?")
-        
+
+        if motion_sync == MOTION_SYNC_M400 and not hasattr(self.p, 'wait_for_moves'):
+            print('Printer cannot tell us when it has stopped, sleeping after moves instead')
+            motion_sync = MOTION_SYNC_SLEEP
+        self.motion_sync = motion_sync
+        # Where the last move we sent ends, relative to the origin set with
+        # set_as_origin
+        self.position = np.zeros(3)
+        self.motion = self._motion_model(motion)
+        print('Using %s' % repr(self.motion))
+        self.telemetry = False
+        if telemetry is not None:
+            if hasattr(self.p, 'start_telemetry'):
+                self.p.start_telemetry(telemetry)
+                self.telemetry = True
+            else:
+                print('Printer cannot report its position, not measuring it')
+
+    def _motion_model(self, motion):
+        if isinstance(motion, MotionModel):
+            return motion
+        if motion is not None:
+            return MotionModel.from_profile(motion)
+        if hasattr(self.p, 'motion_model'):
+            try:
+                return self.p.motion_model()
+            except RuntimeError as err:
+                print('Could not read the motion settings from the printer: %s' % str(err))
+        return MotionModel.from_profile('default')
 
     def scan(self):
         raise NotImplementedError
 
     def scan_rectangular_lattice(self, begin_coord, end_coord, resolution,
-                                 record_time=2.0, savepath="./data"):
+                                 record_time=2.0, savepath="./data", order=ORDER_SERPENTINE):
         """Scans along a square lattice and saves each audio clip at each location.
         Audio clips will be saved the format:
             <savepath>/<time.time()>_<xloc>_<yloc>_<zloc>.wav
@@ -58,6 +180,8 @@ class Scanner(object):
         @param end_coord: tuple of x and y coordinate to scan until
         @param resolution: number of samples for each dimension. If 10 is selected, we'll scan 100 points.
         @param savepath: folder that your saved wave files will be sent to.
+        @param order: ORDER_SERPENTINE to run every other column backwards,
+                      ORDER_RASTER to start every column at y=0
         """
         # Create a folder to store all of our sound samples in
         print_begin_time = int(time.time())
@@ -68,24 +192,20 @@ class Scanner(object):
         # begin_coord is just the origin already.
         distance_x = end_coord[0] - begin_coord[0]
         distance_y = end_coord[1] - begin_coord[1]
-        scan_points = [(x, y) for x in np.linspace(0, distance_x, resolution) 
-                              for y in np.linspace(0, distance_y, resolution)]
+        scan_points = self._grid_points(distance_x, distance_y, resolution, resolution, order)
         
         # Beginning at the begin_coord, we are doing to stop and keep scanning
-        previous_coord = begin_coord
-        for p_x, p_y in tqdm.tqdm(scan_points):
-            dx = p_x - previous_coord[0]
-            dy = p_y - previous_coord[1]
-            self.move(x=dx, y=dy)
+        self.set_as_origin()
+        for p_x, p_y in progress(scan_points):
+            self.move_to(x=p_x, y=p_y)
             fname = os.path.join(savefolder, "{}_{}_{}".format(p_x, p_y, 0))
             self.mic.record_to_file(record_time, fname)
-            previous_coord = p_x, p_y
 
-        # Move back to our original location. Important since we are using relative coordinates.
-        self.move(x=-distance_x, y=-distance_y)
+        # Move back to our original location
+        self.move_to(x=0, y=0)
 
     def scan_rectangular_prism(self, begin_coord, end_coord, resolution,
-                               resolution_z, record_time=2.0, savepath="./data"):
+                               resolution_z, record_time=2.0, savepath="./data", order=ORDER_SERPENTINE):
         """Scans along a square lattice and saves each audio clip at each
         location. Audio clips will be saved the format:
             <savepath>/<time.time()>_<xloc>_<yloc>_<zloc>.wav
@@ -95,6 +215,10 @@ class Scanner(object):
         @param end_coord: tuple of x, y, z coordinate to scan until
         @param resolution: number of samples for each dimension. If 10 is selected, we'll scan 100 points.
         @param savepath: folder that your saved wave files will be sent to.
+        @param order: ORDER_SERPENTINE to run every other column and every
+                      other layer backwards (so each layer starts right above
+                      where the last one ended), ORDER_RASTER to start every
+                      column at y=0 and every layer at the origin
         """
         # Create a folder to store all of our sound samples in
         print_begin_time = int(time.time())
@@ -106,34 +230,54 @@ class Scanner(object):
         distance_x = end_coord[0] - begin_coord[0]
         distance_y = end_coord[1] - begin_coord[1]
         distance_z = end_coord[2] - begin_coord[2]
-        for index, z in enumerate(np.linspace(0, distance_z, resolution_z)):
-            print('Scanning height z=%s, layer %d/%d' % (z, index + 1, resolution_z))
-            scan_points = [(x, y) for x in np.linspace(0, distance_x, resolution) 
-                                for y in np.linspace(0, distance_y, resolution)]
-            
-            # Beginning at the begin_coord, we are doing to stop and keep scanning
-            previous_coord = begin_coord
-            for p_x, p_y in tqdm.tqdm(scan_points):
-                dx = p_x - previous_coord[0]
-                dy = p_y - previous_coord[1]
-                self.move(x=dx, y=dy)
-                fname = os.path.join(savefolder, "{}_{}_{}".format(p_x, p_y, z))
-                self.mic.record_to_file(record_time, fname)
-                previous_coord = p_x, p_y
+        self._check_travel(distance_x, distance_y, distance_z)
+        layers = prism_points(distance_x, distance_y, distance_z, resolution, resolution_z, order)
+        if order != ORDER_RASTER:
+            raster = prism_points(distance_x, distance_y, distance_z, resolution, resolution_z, ORDER_RASTER)
+            compare_paths(sum(raster, []), sum(layers, []), order.capitalize(), self.motion)
 
-            # Move back to our original location. Important since we are using relative coordinates.
-            self.move(x=-distance_x, y=-distance_y)
+        # Beginning at the begin_coord, we are doing to stop and keep scanning
+        self.set_as_origin()
+        for index, layer in enumerate(layers):
+            print('Scanning height z=%s, layer %d/%d' % (layer[0][2], index + 1, resolution_z))
+            for p_x, p_y, p_z in progress(layer):
+                self.move_to(x=p_x, y=p_y, z=p_z)
+                fname = os.path.join(savefolder, "{}_{}_{}".format(p_x, p_y, p_z))
+                self.mic.record_to_file(record_time, fname)
 
-            # Move up Z coordinates
-            self.move(z=(distance_z / resolution_z))
-        
-        # Move back to our original location in z
-        self.move(z=-distance_z)
+        # Move back to our original location
+        self.move_to(x=0, y=0, z=0)
+
+    def wait_for_moves(self, estimate=0.0):
+        """Blocks until the head has stopped. With M400 sync we wait for the
+        printer to tell us, otherwise we sleep for <estimate> seconds."""
+        if self.motion_sync == MOTION_SYNC_SLEEP:
+            time.sleep(estimate)
+        elif not self.p.wait_for_moves(MOVE_TIMEOUT):
+            raise RuntimeError("Printer did not finish moving within %s s" % MOVE_TIMEOUT)
+
+    def _check_travel(self, x=0.0, y=0.0, z=0.0):
+        """Raises ValueError if a scan x, y, z mm across can't fit on the
+        machine, when the printer knows how far it can move"""
+        profile = getattr(self.p, 'profile', None)
+        if profile is not None:
+            profile.check_travel((x, y, z))
+
+    def _grid_points(self, distance_x, distance_y, resolution_x, resolution_y, order,
+                     feedrate=3000.0):
+        """Points of a grid scan in <order>, printing how much travel it saves
+        over the raster order."""
+        self._check_travel(distance_x, distance_y)
+        points = grid_points(distance_x, distance_y, resolution_x, resolution_y, order)
+        if order != ORDER_RASTER:
+            raster = grid_points(distance_x, distance_y, resolution_x, resolution_y, ORDER_RASTER)
+            compare_paths(raster, points, order.capitalize(), self.motion, feedrate)
+        return points
 
     def move(self, x=None, y=None, z=None, delay=MOVEMENT_DELAY_TIME, delay_factor=MOVEMENT_DELAY_MULTIPLIER):
         """Displaces the head of the CNC x, y, z units. Will find the shortest distances to get to the
-        endpoint by moving stepper motors simultaneously. Delay will pause control sequence to give
-        the CNC time to move to the location, since we are NOT BLOCKING!"""
+        endpoint by moving stepper motors simultaneously. Blocks until the head has arrived, which
+        with sleep sync means pausing for delay + distance * delay_factor seconds."""
         if not self.p.online():
             raise RuntimeError("Cannot move - printer is not connected.")
         
@@ -142,66 +286,114 @@ class Scanner(object):
         dx = 0 if not x else x
         dy = 0 if not y else y
         dz = 0 if not z else z
+        self.position += (dx, dy, dz)
         distance = (dx**2 + dy**2 + dz**2) ** 0.5
-        time.sleep(delay + distance * delay_factor)
+        self.wait_for_moves(delay + distance * delay_factor)
     
     def move_speed(self, x=None, y=None, z=None, speed=500, delay=0.2):
         """
-        TODO: FIX THIS FUNCTION YOU DOOFUS
-        Move to coordinate at a certain speed. Will calculate the delay time
-        needed for the program to wait during travel time by estimating the
-        distance traveled and the speed.
+        Move to coordinate at a certain speed and block until we're there.
+        With sleep sync, will calculate the delay time needed for the program
+        to wait during travel time from the motion model.
         @param x (int): distance to travel in x axis (mm) 
         @param y (int): distance to travel in y axis (mm) 
         @param z (int): distance to travel in z axis (mm) 
         @param speed (int): speed of nozzle in mm/min
         """
-        speed_per_second = float(speed) / 60.0
-        dx = 0.0 if not x else x
-        dy = 0.0 if not y else y
-        dz = 0.0 if not z else z
-        move_vector = np.array([dx, dy, dz])
-        distance = np.sqrt((move_vector ** 2).sum())
-
-        # Actually send the move command, overriding any previous command
-        self.p.move_coord(x=x, y=y, z=z, speed=speed)
-        # Sleep the amount of time while the nozzle is moving, plus a small
-        # delay for tolerance reasons
-        time.sleep(distance / speed_per_second + delay)
+        travel_time = self.move_speed_noblock(x=x, y=y, z=z, speed=speed)
+        # Wait while the nozzle is moving, the estimate (plus a small delay
+        # for tolerance reasons) is only used with sleep sync
+        self.wait_for_moves(travel_time + delay)
     
     def move_speed_noblock(self, x=None, y=None, z=None, speed=500, delay=0.2):
         """
-        Move to coordinate at a certain speed. Will calculate the delay time
-        needed for the program to wait during travel time by estimating the
-        distance traveled and the speed. Will not block the main program
+        Move to coordinate at a certain speed. Will not block the main program
         while moving the nozzle; will return the time it will take to actually
-        travel the distance. Allows us to record from the microphone as we are
+        travel the distance, including speeding up and slowing down, from the
+        motion model. Allows us to record from the microphone as we are
         scanning this distance.
         @param x (int): distance to travel in x axis (mm) 
         @param y (int): distance to travel in y axis (mm) 
         @param z (int): distance to travel in z axis (mm) 
         @param speed (int): speed of nozzle in mm/min
         """
-        speed_per_second = float(speed) / 60.0
-        dx = 0.0 if not x else x
-        dy = 0.0 if not y else y
-        dz = 0.0 if not z else z
-        move_vector = np.array([dx, dy, dz])
-        distance = np.sqrt((move_vector ** 2).sum())
-
         # Actually send the move command, overriding any previous command
         self.p.move_coord(x=x, y=y, z=z, speed=speed)
-        # Sleep the amount of time while the nozzle is moving, plus a small
-        # delay for tolerance reasons
-        return distance / speed_per_second
+        self.position += (x or 0.0, y or 0.0, z or 0.0)
+        return self.motion.duration(x, y, z, feedrate=speed)
+
+    def move_to(self, x=None, y=None, z=None, speed=None, delay=MOVEMENT_DELAY_TIME):
+        """Moves the head to (x, y, z) relative to the origin (see
+        set_as_origin) and blocks until it's there. Axes that are None stay
+        where they are. Unlike move and move_speed this only sends a single
+        command, and errors don't add up from move to move.
+        @param speed: mm/min, None to keep the printer's current speed
+        @param delay: padding on the travel time estimate with sleep sync
+        """
+        travel_time = self.move_to_noblock(x=x, y=y, z=z, speed=speed)
+        self.wait_for_moves(travel_time + delay)
+
+    def move_to_noblock(self, x=None, y=None, z=None, speed=None):
+        """Sends the head to (x, y, z) relative to the origin without
+        waiting, like move_to.
+        @returns seconds the move takes from the motion model, or without a
+            speed the same guess from the distance that move uses
+        """
+        if not self.p.online():
+            raise RuntimeError("Cannot move - printer is not connected.")
+        target = self.position.copy()
+        for axis, value in enumerate((x, y, z)):
+            if value is not None:
+                target[axis] = value
+        dx, dy, dz = target - self.position
+        self.p.move_abs(x=x, y=y, z=z, speed=speed)
+        self.position = target
+        if not speed:
+            return (dx**2 + dy**2 + dz**2) ** 0.5 * MOVEMENT_DELAY_MULTIPLIER
+        return self.motion.duration(dx, dy, dz, feedrate=speed)
+
+    def record_line(self, fname, start, end, speed, **record_kwargs):
+        """Moves in a straight line from <start> to <end> (the head should
+        already be at <start>) and records for exactly as long as the move
+        takes. The move is saved to <fname>.motion.json so that processing
+        can tell where the head was for each frame, and with telemetry on the
+        positions measured along the way go to <fname>.positions.npy.
+        @param start, end: (x, y) or (x, y, z) scan coordinates in mm
+        @param speed: mm/min
+        Other keyword arguments go to the microphone's record_to_file.
+        """
+        start = np.array(list(start) + [0.0] * (3 - len(start)), dtype=float)
+        end = np.array(list(end) + [0.0] * (3 - len(end)), dtype=float)
+        started = time.monotonic()
+        record_time = self.move_to_noblock(*end, speed=speed)
+        save_move(fname + '.motion.json', self.motion, start, end, speed, started)
+        self.mic.record_to_file(record_time, fname, **record_kwargs)
+        if self.telemetry:
+            self.save_positions(fname + '.positions.npy', start, started, time.monotonic())
+
+    def save_positions(self, path, start, started, ended):
+        """Saves the head positions measured between the monotonic times
+        <started> and <ended>, as rows of (time, x, y, z). The printer reports
+        machine coordinates, so they are shifted to scan coordinates assuming
+        the head was at <start> when the move was sent."""
+        latest = self.p.positions.latest()
+        if latest is None:
+            print('No head positions have been measured, not saving %s' % path)
+            return
+        times, positions = self.p.positions.between(started, ended)
+        offset = np.asarray(start, dtype=float) - self.p.positions.interpolate([started])[0]
+        np.save(path, np.column_stack([times, positions + offset]))
 
     def set_as_origin(self):
-        # TODO: Set the current location as the origin (0, 0, 0) for the
-        # scanner. The move seems to be a bit buggy with this though.
-        raise NotImplementedError()
+        """Makes where the head is (or where the last move sent ends) the
+        origin (0, 0, 0) for move_to, on the printer too (G92). Every scan
+        starts by doing this."""
+        self.p.reset_origin()
+        self.position = np.zeros(3)
 
     def scan_continuous_lattice(self, end_coord, resolution, scan_speed=500, move_speed=3000,
-        delay=0.1, sample_start=0, sample_end=10000, savepath="./data", note=""):
+        delay=None, sample_start=0, sample_end=10000, savepath="./data", note="",
+        bidirectional=False):
         """Scans lines across the x axis, with steps happening along the y axis.
         If we have a rectangular region, the scan lines will look like:
                 |-------- x distance ----|
@@ -213,13 +405,20 @@ class Scanner(object):
         during the time, so we can just linearly interpolate the location of
         the microphone at any given time here. The format of the saved files
         will be:
-            <savepath>/<time.time()>/continuous_<xmin>_<xmax>_<yloc>.wav
+            <savepath>/<time.time()>/continuous_<xstart>_<xend>_<yloc>.wav
         @param end_coord: tuple of x and y coordinate to scan until
         @param resolution: number of samples for the y dimension. For example,
             if we scan a 100 mm x 100 mm box, a scan size of 51 will mean
             a line every 2 mm on the y dimension
+        @param delay: delay between oscilloscope fetches. If None, the
+            fastest safe delay from the calibration profile is used.
         @param savepath: folder that your saved wave files will be sent to.
+        @param bidirectional: record every other line on the way back from
+            x = xmax to 0 (xstart > xend in the file name) rather than
+            travelling back to x = 0 without recording
         """
+        if delay is None:
+            delay = self.mic.default_delay(sample_start, sample_end)
         start_time = time.time()
         # Create a folder to store all of our sound samples in
         print_begin_time = int(time.time())
@@ -234,45 +433,124 @@ class Scanner(object):
             f.write('RecordTime: %d\n' % sample_start)
             f.write('end_coord: %s\n' % str(end_coord))
             f.write('resolution: %d\n' % resolution)
+            f.write('bidirectional: %s\n' % bidirectional)
             f.write("\n\n")
             f.write("Additional notes:\n%s\n" % note)
 
         # since we are assuming that we start at the begin_coord, consider the relative coordinates where
         # begin_coord is just the origin already.
-        # interweave the start and end points. The first start point is just the
-        # origin, so we remove that.
         distance_x, distance_y = end_coord[0], end_coord[1]
-        print("Expected Number of samples per line: %d" % int(scan_speed / 60.0 / delay / distance_x))
-        scan_points = [[(0, y), (distance_x, y)] for y in np.linspace(0, distance_y, resolution)]
-        scan_points = [item for sublist in scan_points for item in sublist]
-        scan_points = scan_points[1:]
-        
-        # Beginning at the begin_coord, we are doing to stop and keep scanning
-        # The even indices will be scanning/moving, while the odd indices
-        # will be moving only.
-        previous_coord = (0, 0)
-        for idx, coord in tqdm.tqdm(list(enumerate(scan_points))):
-            p_x, p_y = coord
-            dx = p_x - previous_coord[0]
-            dy = p_y - previous_coord[1]
-            if idx % 2 == 0:
-                fname = os.path.join(savefolder, "continuous_0_{}_{}".format(dx, p_y))
-                record_time = self.move_speed_noblock(x=dx, y=dy, speed=scan_speed)
-                self.mic.record_to_file(record_time, fname, delay=delay,
-                    sample_start=sample_start, sample_end=sample_end)
-                time.sleep(0.5)  # some padding time
-            else:
-                self.move_speed(x=dx, y=dy, speed=move_speed)
-                time.sleep(0.5)  # some padding time
-            previous_coord = p_x, p_y
-
-        # Move back to our original location. Important since we are using relative coordinates.
-        self.move(x=-distance_x, y=-distance_y)
+        if delay > 0:
+            print("Expected Number of samples per line: %d"
+                  % int(float(distance_x) / (scan_speed / 60.0) / delay))
+        self._check_travel(distance_x, distance_y)
+        lines = scan_lines(distance_x, distance_y, resolution, bidirectional)
+        self.set_as_origin()
+        self._scan_lines(savefolder, lines, scan_speed, move_speed, delay=delay,
+            sample_start=sample_start, sample_end=sample_end)
+
+        # Move back to our original location
+        self.move_to(x=0, y=0)
         end_time = time.time()
         print('Total Scan Time: %s s' % str(end_time - start_time))
 
+    def scan_points(self, points, record_time=2.0, scan_speed=4000, delay=None,
+        sample_start=0, sample_end=10000, savepath="./data", note="", plan=True, program=False):
+        """Records at each of an arbitrary set of points, for scanning
+        regions that aren't rectangles (say only the part above the lattice).
+        The points are visited in an order planned to keep travel short,
+        and saved in the same format as scan_grid:
+            <savepath>/<time.time()>/<xloc>_<yloc>_<zloc>.npy
+        @param points: list or (n, 2) / (n, 3) array of coordinates relative
+            to where the head is now
+        @param scan_speed: speed to move between points in mm/min
+        @param plan: reorder the points to keep travel short, False to visit
+            them in the order given
+        @param program: compile the whole scan into one G-code program and
+            stream it to the printer (see planner.program), recording when
+            it reaches each point, instead of sending the moves one by one
+        @param savepath: folder that your saved files will be sent to.
+        """
+        points = np.asarray(points, dtype=float)
+        if points.ndim != 2 or points.shape[1] not in (2, 3):
+            raise ValueError('Expected a list of (x, y) or (x, y, z) points, got shape %s'
+                             % str(points.shape))
+        if points.shape[1] == 2:
+            points = np.column_stack([points, np.zeros(len(points))])
+        if len(points):
+            self._check_travel(*np.ptp(points, axis=0))
+
+        # Create a folder to store all of our sound samples in
+        print_begin_time = int(time.time())
+        savefolder = os.path.join(savepath, str(print_begin_time))
+        if not os.path.exists(savefolder):
+            os.makedirs(savefolder)
+
+        with open(os.path.join(savefolder, 'info'), 'w') as f:
+            f.write("Scanning a list of points, stopping at each point. Using parameters\n")
+            f.write('SampleStart: %d\n' % sample_start)
+            f.write('SampleEnd: %d\n' % sample_end)
+            f.write('RecordTime: %s\n' % record_time)
+            f.write('points: %d\n' % len(points))
+            f.write("\n\n")
+            f.write("Additional notes:\n%s\n" % note)
+
+        if plan:
+            planning_start = time.time()
+            ordered = points[plan_route(points)]
+            print('Planned a route through %d points in %.1f s: %.1f mm of travel instead of '
+                  '%.1f mm in the order given' % (len(points), time.time() - planning_start,
+                                                 path_length(ordered), path_length(points)))
+        else:
+            ordered = points
+        print('Expect about %.0f s of moving at %s mm/min' % (
+            travel_time(ordered, self.motion, scan_speed), scan_speed))
+
+        def record(p_x, p_y, p_z):
+            fname = os.path.join(savefolder, "{}_{}_{}".format(p_x, p_y, p_z))
+            self.mic.record_to_file(record_time, fname, delay=delay,
+                sample_start=sample_start, sample_end=sample_end)
+
+        self.set_as_origin()
+        if program:
+            if not hasattr(self.p, 'run_program'):
+                raise RuntimeError('%s cannot run G-code programs' % type(self.p).__name__)
+            # The printer gets the whole scan at once and keeps its planner
+            # full, we only have to keep up with the recordings. The program
+            # ends back at the origin.
+            ordered_list = ordered.tolist()
+            self.p.run_program(compile_points(ordered, scan_speed),
+                               lambda command: record(*ordered_list[parse_capture(command)]))
+            return
+
+        for p_x, p_y, p_z in progress(ordered.tolist()):
+            self.move_to(x=p_x, y=p_y, z=p_z, speed=scan_speed)
+            record(p_x, p_y, p_z)
+
+        # Move back to our original location
+        self.move_to(x=0, y=0, z=0, speed=scan_speed)
+
+    def scan_mask(self, mask, spacing, z=0.0, **kwargs):
+        """Scans the points where a 2D (x, y) or 3D (x, y, z) boolean mask is
+        True, with mask[0, 0] at where the head is now and <spacing> mm
+        between cells. Other keyword arguments go to scan_points."""
+        return self.scan_points(points_from_mask(mask, spacing, z=z), **kwargs)
+
+    def _scan_lines(self, folder, lines, scan_speed, move_speed, **record_kwargs):
+        """Records along each of <lines> (from planner.scan_lines) at
+        <scan_speed>, travelling between them at <move_speed>. The lines are
+        relative to the origin. Files are named continuous_<xstart>_<xend>_<y>.
+        """
+        for start, end in progress(lines):
+            if tuple(self.position[:2]) != tuple(start):
+                self.move_to(x=start[0], y=start[1], speed=move_speed)
+            fname = os.path.join(folder, "continuous_{}_{}_{}".format(start[0], end[0], end[1]))
+            self.record_line(fname, start, end, scan_speed, **record_kwargs)
+            self.wait_for_moves(LINE_PADDING_TIME)
+
     def scan_grid(self, end_coord, resolution_x, resolution_y, scan_speed=4000, record_time=2.0, 
-        delay=0.5, sample_start=0, sample_end=10000, savepath="./data", note=""):
+        delay=None, sample_start=0, sample_end=10000, savepath="./data", note="",
+        order=ORDER_SERPENTINE):
         """Scans along a square lattice and saves each audio clip at each location.
         Audio clips will be saved the format:
             <savepath>/<time.time()>_<xloc>_<yloc>_<zloc>.wav
@@ -282,6 +560,8 @@ class Scanner(object):
         @param end_coord: tuple of x and y coordinate to scan until
         @param resolution: number of samples for each dimension. If 10 is selected, we'll scan 100 points.
         @param savepath: folder that your saved wave files will be sent to.
+        @param order: ORDER_SERPENTINE to run every other column backwards,
+                      ORDER_RASTER to start every column at y=0
         """
         # Create a folder to store all of our sound samples in
         print_begin_time = int(time.time())
@@ -304,25 +584,23 @@ class Scanner(object):
         # begin_coord is just the origin already.
         distance_x = end_coord[0]
         distance_y = end_coord[1]
-        scan_points = [(x, y) for x in np.linspace(0, distance_x, resolution_x) 
-                              for y in np.linspace(0, distance_y, resolution_y)]
+        scan_points = self._grid_points(distance_x, distance_y, resolution_x, resolution_y,
+                                        order, scan_speed)
         
         # Beginning at the begin_coord, we are doing to stop and keep scanning
-        previous_coord = (0, 0)
-        for p_x, p_y in tqdm.tqdm(scan_points):
-            dx = p_x - previous_coord[0]
-            dy = p_y - previous_coord[1]
-            self.move_speed(x=dx, y=dy, speed=scan_speed)
+        self.set_as_origin()
+        for p_x, p_y in progress(scan_points):
+            self.move_to(x=p_x, y=p_y, speed=scan_speed)
             fname = os.path.join(savefolder, "{}_{}_{}".format(p_x, p_y, 0))
             self.mic.record_to_file(record_time, fname, delay=delay,
                 sample_start=sample_start, sample_end=sample_end)
-            previous_coord = p_x, p_y
 
-        # Move back to our original location. Important since we are using relative coordinates.
-        self.move_speed(x=-distance_x, y=-distance_y, speed=scan_speed)        
+        # Move back to our original location
+        self.move_to(x=0, y=0, speed=scan_speed)
 
     def scan_continuous_lattice_with_siggen(self, frequencies, end_coord, resolution,
-        scan_speed=500, move_speed=3000, delay=0.1, savepath="./data", scan_full=False, note=""):
+        scan_speed=500, move_speed=3000, delay=None, savepath="./data", scan_full=False, note="",
+        bidirectional=False):
         """Scans lines across the x axis, with steps happening along the y axis.
         If we have a rectangular region, the scan lines will look like:
                 |-------- x distance ----|
@@ -334,18 +612,23 @@ class Scanner(object):
         during the time, so we can just linearly interpolate the location of
         the microphone at any given time here. The format of the saved files
         will be:
-            <savepath>/<time.time()>/<frequency>/continuous_<xmin>_<xmax>_<yloc>.wav
+            <savepath>/<time.time()>/<frequency>/continuous_<xstart>_<xend>_<yloc>.wav
         @param frequencies: list of frequencies to scan at
         @param end_coord: tuple of x and y coordinate to scan until
         @param resolution: number of samples for the y dimension. For example,
             if we scan a 100 mm x 100 mm box, a scan size of 51 will mean
             a line every 2 mm on the y dimension
         @param savepath: folder that your saved wave files will be sent to.
+        @param delay: delay between oscilloscope fetches. If None, the
+            fastest safe delay from the calibration profile is used.
         @param scan_full: scan the full range of our oscilloscope rather than a small chunk
         @param note: string of text to save to info file as additional notes
+        @param bidirectional: record every other line on the way back from
+            x = xmax to 0 (xstart > xend in the file name) rather than
+            travelling back to x = 0 without recording
         """
         if not self.siggen:
-            self.siggen = SignalGenerator()
+            self.siggen = self._connect_siggen()
 
         start_time = time.time()
         # Create a folder to store all of our sound samples in
@@ -366,6 +649,9 @@ class Scanner(object):
                 sample_start = int(np.floor(freq / 5.0) - 5)
                 sample_end = int(np.ceil(freq / 5.0) + 5)
             print("Recording from sample {} to {}".format(sample_start, sample_end))
+            freq_delay = delay
+            if freq_delay is None:
+                freq_delay = self.mic.default_delay(sample_start, sample_end)
             freq_folder = os.path.join(savefolder, str(freq))
             if not os.path.exists(freq_folder):
                 os.makedirs(freq_folder)
@@ -376,41 +662,24 @@ class Scanner(object):
                 f.write('RecordTime: %d\n' % sample_start)
                 f.write('end_coord: %s\n' % str(end_coord))
                 f.write('resolution: %d\n' % resolution)
+                f.write('bidirectional: %s\n' % bidirectional)
                 f.write("\n\n")
                 f.write("Additional notes:\n%s\n" % note)
 
             # since we are assuming that we start at the begin_coord, consider the relative coordinates where
             # begin_coord is just the origin already.
-            # interweave the start and end points. The first start point is just the
-            # origin, so we remove that.
             distance_x, distance_y = end_coord[0], end_coord[1]
-            expected_samples = int(float(distance_x)/ (scan_speed / 60.0) / float(delay))
-            print("Expected Number of samples per line: %d" % expected_samples)
-            scan_points = [[(0, y), (distance_x, y)] for y in np.linspace(0, distance_y, resolution)]
-            scan_points = [item for sublist in scan_points for item in sublist]
-            scan_points = scan_points[1:]
-            
-            # Beginning at the begin_coord, we are doing to stop and keep scanning
-            # The even indices will be scanning/moving, while the odd indices
-            # will be moving only.
-            previous_coord = (0, 0)
-            for idx, coord in tqdm.tqdm(list(enumerate(scan_points))):
-                p_x, p_y = coord
-                dx = p_x - previous_coord[0]
-                dy = p_y - previous_coord[1]
-                if idx % 2 == 0:
-                    fname = os.path.join(freq_folder, "continuous_0_{}_{}".format(dx, p_y))
-                    record_time = self.move_speed_noblock(x=dx, y=dy, speed=scan_speed)
-                    self.mic.record_to_file(record_time, fname, delay=delay,
-                        sample_start=sample_start, sample_end=sample_end)
-                    time.sleep(0.5)  # some padding time
-                else:
-                    self.move_speed(x=dx, y=dy, speed=move_speed)
-                    time.sleep(0.5)  # some padding time
-                previous_coord = p_x, p_y
-
-            # Move back to our original location. Important since we are using relative coordinates.
-            self.move_speed(x=-distance_x, y=-distance_y, speed=move_speed)
+            if freq_delay > 0:
+                expected_samples = int(float(distance_x)/ (scan_speed / 60.0) / float(freq_delay))
+                print("Expected Number of samples per line: %d" % expected_samples)
+            self._check_travel(distance_x, distance_y)
+            lines = scan_lines(distance_x, distance_y, resolution, bidirectional)
+            self.set_as_origin()
+            self._scan_lines(freq_folder, lines, scan_speed, move_speed, delay=freq_delay,
+                sample_start=sample_start, sample_end=sample_end)
+
+            # Move back to our original location
+            self.move_to(x=0, y=0, speed=move_speed)
             end_time = time.time()
             print('Total Scan Time: %s s' % str(end_time - start_time))
 
@@ -1 +1,17 @@
-from .rigol import SignalGenerator
\ No newline at end of file
+"""Signal generator control. SignalGenerator is imported when it is first
+used, so that importing the package doesn't pull in the VISA stack."""
+import importlib
+
+_EXPORTS = {
+    'SignalGenerator': '.rigol',
+}
+
+
+def __getattr__(name):
+    if name in _EXPORTS:
+        return getattr(importlib.import_module(_EXPORTS[name], __name__), name)
+    raise AttributeError('module %r has no attribute %r' % (__name__, name))
+
+
+def __dir__():
+    return sorted(list(globals()) + list(_EXPORTS))
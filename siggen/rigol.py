@@ -31,49 +31,26 @@ Troubleshooting:
     should be able to see the RIGOL signal generator inside the list of devices
     when searching for one using pyvisa.
 """
-import visa
-import time
+from instruments import registry_for
 
 
 class SignalGenerator(object):
-    def __init__(self):
-        # Try to connect to the first RIGOL siggen found.
-        rm = visa.ResourceManager('@py')
-        devices = rm.list_resources()
-        devnames = []
-        for d in devices:
-            # RIGOL signal generators should have more than 8 colons and also
-            # should be connected via USB, so we can filter using that.
-            if d.count(':') >= 8 and 'USB' in d:
-                devnames.append(d)
-
-        if not devnames:
-            print('Only found devices: %s' % str(devices))
-            raise RuntimeError('Could not find a USB instrument, check connection')
-        
-
-        rigol_devname = None
-        # Search through the filtered USB devices and make sure we're connecting
-        # to a RIGOL signal generator, since we're also connecting to oscilloscopes
-        # through USB.
-        for d in devnames:
-            potential_device = rm.get_instrument(d)
-            potential_device.write("*IDN?")
-            time.sleep(0.2)  # give the device a bit of time to respond
-            test_id = potential_device.read()
-            print("Checking out device with ID: %s" % test_id)
-
-            if 'RIGOL' in test_id:
-                rigol_devname = d
-                self.device = potential_device
-                self.name = test_id
-                break
-            else:
-                print("This is not a signal generator")
-                potential_device.close()
-
-        if not rigol_devname:
-            raise RuntimeError('Could not find a USB instrument, check connection')
+    def __init__(self, resource_manager=None, registry=None):
+        """Connects to the first RIGOL signal generator found over USB.
+        @param resource_manager: VISA resource manager to look for the siggen
+                                 with. Defaults to pyvisa's '@py' backend; pass
+                                 a simulation.SimulatedResourceManager to run
+                                 without hardware.
+        @param registry: instruments.InstrumentRegistry to get the siggen
+                         from, shared with the oscilloscope. Defaults to the
+                         one shared by everything using <resource_manager>.
+        """
+        # Search through the USB devices the registry identified and make sure
+        # we're connecting to a RIGOL signal generator, since we're also
+        # connecting to oscilloscopes through USB.
+        if registry is None:
+            registry = registry_for(resource_manager)
+        _, self.device, self.name = registry.find('RIGOL')
 
     def set_frequency(self, frequency, amplitude=20, offset=0):
         """Set the frequency, voltage amplitude, and voltage offset of the
@@ -0,0 +1,4 @@
+from .field import AcousticField
+from .instruments import SimulatedResourceManager, SimulatedOscilloscope, \
+    SimulatedSignalGenerator, simulated_rig
+from .printer import SimulatedPrinter
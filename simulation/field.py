@@ -0,0 +1,87 @@
+"""Synthetic acoustic field used by the simulated instruments. It is a rough
+stand-in for the metamaterial: near the resonance the sound is guided along a
+channel (the boundary between the thick and thin pillars) and decays into the
+bulk, away from it the sound spreads through the bulk as a standing wave.
+
+The field knows where the microphone head is and what the signal generator is
+driving, so the simulated oscilloscope sees a spectrum that depends on both.
+"""
+import threading
+import numpy as np
+
+
+class AcousticField(object):
+    """Sound amplitude as a function of head position and drive frequency.
+    All distances are in mm and frequencies in Hz."""
+    def __init__(self, resonance=28000.0, bandwidth=1500.0, channel_y=50.0,
+                 channel_width=5.0, wavelength=12.25, decay_length=80.0,
+                 height_decay=30.0, noise_floor=1e-4):
+        self.resonance = resonance
+        self.bandwidth = bandwidth
+        self.channel_y = channel_y
+        self.channel_width = channel_width
+        self.wavelength = wavelength
+        self.decay_length = decay_length
+        self.height_decay = height_decay
+        self.noise_floor = noise_floor
+
+        # Updated by the simulated signal generator and printer
+        self.frequency = resonance
+        self.drive_amplitude = 0.0
+        self.position = (0.0, 0.0, 0.0)
+        self._lock = threading.Lock()
+
+    def move_to(self, x, y, z):
+        with self._lock:
+            self.position = (float(x), float(y), float(z))
+
+    def move_by(self, dx=0.0, dy=0.0, dz=0.0):
+        with self._lock:
+            x, y, z = self.position
+            self.position = (x + dx, y + dy, z + dz)
+
+    def drive(self, frequency, amplitude):
+        with self._lock:
+            self.frequency = float(frequency)
+            self.drive_amplitude = float(amplitude)
+
+    def amplitude(self, position=None, frequency=None):
+        """Amplitude (V at the microphone) of the drive tone at <position>,
+        defaulting to the current head position and drive frequency."""
+        x, y, z = self.position if position is None else position
+        frequency = self.frequency if frequency is None else frequency
+        in_gap = np.exp(-((frequency - self.resonance) / self.bandwidth) ** 2)
+        edge = np.exp(-((y - self.channel_y) / self.channel_width) ** 2)
+        bulk = 0.5 * (1 + np.cos(2 * np.pi * (x + y) / self.wavelength)) * \
+            np.exp(-np.hypot(x, y - self.channel_y) / self.decay_length)
+        height = np.exp(-max(z, 0.0) / self.height_decay)
+        return 0.002 * self.drive_amplitude * (in_gap * edge + (1 - in_gap) * bulk) * height
+
+    def spectrum(self, num_bins, bin_width, rng=None):
+        """FFT magnitude spectrum seen by the microphone right now: a noise
+        floor plus the drive tone, spread over the two nearest bins.
+        @param num_bins: number of FFT bins, starting at 0 Hz
+        @param bin_width: Hz per FFT bin
+        @param rng: np.random.RandomState for the noise
+        """
+        rng = rng or np.random
+        spectrum = np.abs(rng.normal(0.0, self.noise_floor, num_bins))
+        location = self.frequency / bin_width
+        low = int(np.floor(location))
+        frac = location - low
+        amplitude = self.amplitude()
+        for idx, weight in ((low, 1 - frac), (low + 1, frac)):
+            if 0 <= idx < num_bins:
+                spectrum[idx] += amplitude * weight
+        return spectrum
+
+    def waveform(self, num_samples, sample_interval, start_time=0.0, rng=None):
+        """Microphone voltage over time, for a raw time-domain capture.
+        @param num_samples: number of points in the record
+        @param sample_interval: seconds between points
+        @param start_time: time of the first point, keeps the phase continuous
+        """
+        rng = rng or np.random
+        t = start_time + np.arange(num_samples) * sample_interval
+        tone = self.amplitude() * np.sqrt(2) * np.sin(2 * np.pi * self.frequency * t)
+        return tone + rng.normal(0.0, self.noise_floor, num_samples)
@@ -0,0 +1,351 @@
+"""Simulated VISA instruments, so that the acquisition code can run (and be
+benchmarked) without a Tektronix oscilloscope or RIGOL signal generator
+attached. The simulated resource manager hands out objects with the same
+write/read/query/query_ascii_values/query_binary_values methods that pyvisa
+instruments have, so they can be passed straight to OscilloscopeMicrophone and
+SignalGenerator:
+
+    >>> rm, field = simulated_rig(refresh_interval=0.05)
+    >>> mic = OscilloscopeMicrophone(resource_manager=rm)
+    >>> siggen = SignalGenerator(resource_manager=rm)
+
+Every command can be given a latency, and replies cost extra time depending
+on their size, which is what makes ASCII transfers slow on the real scope.
+"""
+import threading
+import time
+import numpy as np
+from .field import AcousticField
+
+SCOPE_RESOURCE = 'USB0::0x0699::0x0408::C021660::INSTR'
+SIGGEN_RESOURCE = 'USB0::0x1AB1::0x0588::DG1D000000001::INSTR'
+
+# Long forms of the SCPI mnemonics we understand, mapped to their short form,
+# so commands can be spelled either way (and in any case)
+SHORT_FORMS = {
+    'ACQUIRE': 'ACQ', 'NUMACQ': 'NUMAC', 'DATA': 'DAT', 'SOURCE': 'SOU',
+    'START': 'STAR', 'WFMOUTPRE': 'WFMO', 'ENCDG': 'ENC', 'BN_FMT': 'BN_F',
+    'BYT_NR': 'BYT_N', 'BYT_OR': 'BYT_O', 'YMULT': 'YMU', 'YOFF': 'YOF',
+    'YZERO': 'YZE', 'XINCR': 'XIN', 'XZERO': 'XZE', 'HEADER': 'HEAD',
+    'VERBOSE': 'VERB', 'CURVE': 'CURV', 'HORIZONTAL': 'HOR',
+    'VERTICAL': 'VER', 'SCALE': 'SCA', 'UNITS': 'UNI', 'RECORDLENGTH': 'RECO',
+    'APPLY': 'APPL', 'SINUSOID': 'SIN',
+}
+
+
+def normalize_header(header):
+    nodes = header.strip(':').split(':')
+    return ':'.join(SHORT_FORMS.get(node.upper(), node.upper()) for node in nodes)
+
+
+def split_message(message):
+    """Splits a ;-joined SCPI program message into (header, argument, is_query)
+    units. Headers without a leading colon are relative to the previous
+    header's parent node, like on the real instruments."""
+    units = []
+    parent = ''
+    for unit in message.strip().split(';'):
+        unit = unit.strip()
+        if not unit:
+            continue
+        header, _, argument = unit.partition(' ')
+        is_query = header.endswith('?')
+        header = header.rstrip('?')
+        if header.startswith('*'):
+            path = header.upper()
+        elif header.startswith(':') or not parent:
+            path = normalize_header(header)
+            parent = path.rpartition(':')[0]
+        else:
+            path = normalize_header(parent + ':' + header)
+        units.append((path, argument.strip(), is_query))
+    return units
+
+
+def binary_block(payload):
+    """Wraps bytes in an IEEE 488.2 definite length block"""
+    length = str(len(payload))
+    return ('#%d%s' % (len(length), length)).encode('ascii') + payload + b'\n'
+
+
+def parse_binary_block(block):
+    if not block.startswith(b'#'):
+        raise ValueError('Could not find start of binary block')
+    num_digits = int(block[1:2])
+    length = int(block[2:2 + num_digits])
+    payload = block[2 + num_digits:2 + num_digits + length]
+    if len(payload) < length:
+        raise ValueError('Binary data ended prematurely')
+    return payload
+
+
+class SimulatedInstrument(object):
+    """Base for the simulated instruments. Subclasses implement
+    _handle(path, argument, is_query), returning the reply for queries."""
+    idn = 'SIMULATED,INSTRUMENT,0,0'
+
+    def __init__(self, latency=None, default_latency=0.0, transfer_rate=None, seed=None):
+        """
+        @param latency: dict of SCPI header prefix (e.g. 'CURV') -> seconds
+                        every matching command takes
+        @param default_latency: seconds for commands not in <latency>
+        @param transfer_rate: bytes per second for replies, None for instant
+        @param seed: seed for the simulated noise and corruption
+        """
+        self.latency = dict((normalize_header(k), v) for k, v in (latency or {}).items())
+        self.default_latency = default_latency
+        self.transfer_rate = transfer_rate
+        self.timeout = 2000
+        self.rng = np.random.RandomState(seed)
+        self.commands = 0
+        self._output = []
+        self._lock = threading.Lock()
+
+    def write(self, message):
+        with self._lock:
+            replies = []
+            delay = 0.0
+            for path, argument, is_query in split_message(message):
+                self.commands += 1
+                delay += self._latency(path)
+                if path == '*IDN':
+                    reply = self.idn
+                else:
+                    reply = self._handle(path, argument, is_query)
+                if is_query:
+                    if reply is None:
+                        raise ValueError('Simulated instrument does not understand %s?' % path)
+                    replies.append(reply)
+            if replies:
+                if isinstance(replies[0], bytes):
+                    reply = replies[0]
+                else:
+                    reply = ';'.join(str(r) for r in replies) + '\n'
+                if self.transfer_rate:
+                    delay += len(reply) / float(self.transfer_rate)
+                self._output.append(reply)
+        if delay:
+            time.sleep(delay)
+
+    def read_raw(self):
+        with self._lock:
+            if not self._output:
+                raise RuntimeError('Timeout: simulated instrument has nothing to read')
+            reply = self._output.pop(0)
+        return reply if isinstance(reply, bytes) else reply.encode('ascii')
+
+    def read(self):
+        return self.read_raw().decode('ascii')
+
+    def query(self, message):
+        self.write(message)
+        return self.read()
+
+    def query_ascii_values(self, message, converter='f', separator=',', container=list):
+        values = [float(v) for v in self.query(message).strip().split(separator)]
+        return container(values)
+
+    def query_binary_values(self, message, datatype='f', is_big_endian=False, container=list):
+        self.write(message)
+        payload = parse_binary_block(self.read_raw())
+        dtype = np.dtype(datatype).newbyteorder('>' if is_big_endian else '<')
+        if len(payload) % dtype.itemsize:
+            raise ValueError('Binary data is not a whole number of values')
+        return container(np.frombuffer(payload, dtype=dtype))
+
+    def close(self):
+        pass
+
+    def _latency(self, path):
+        for prefix, seconds in self.latency.items():
+            if path.startswith(prefix):
+                return seconds
+        return self.default_latency
+
+    def _handle(self, path, argument, is_query):
+        raise NotImplementedError
+
+
+class SimulatedOscilloscope(SimulatedInstrument):
+    """Tektronix MDO3014 lookalike with the microphone on CH1 and the MATH
+    channel set to an FFT of it. A new acquisition (waveform record and FFT)
+    happens every <refresh_interval> seconds; asking again before that returns
+    the same data, like the real scope does."""
+    idn = 'TEKTRONIX,MDO3014,C021660,CF:91.1CT FV:v1.26'
+
+    def __init__(self, field, refresh_interval=0.05, corruption_rate=0.0,
+                 num_bins=10001, bin_width=5.0, full_scale=0.1,
+                 record_length=10000, sample_interval=4e-6, math_refresh_interval=None,
+                 **kwargs):
+        """
+        @param field: AcousticField the microphone sits in
+        @param refresh_interval: seconds between FFT updates
+        @param corruption_rate: probability that a CURVE? reply is garbled
+        @param num_bins: number of FFT bins the MATH channel has
+        @param bin_width: Hz per FFT bin
+        @param full_scale: largest amplitude (V) the binary encodings can hold
+        @param record_length: number of points in a CH1 waveform record
+        @param sample_interval: seconds between CH1 waveform points
+        @param math_refresh_interval: seconds between MATH FFT updates, which
+                                      can be slower than the acquisitions.
+                                      Defaults to <refresh_interval>.
+        Other keyword arguments go to SimulatedInstrument.
+        """
+        super(SimulatedOscilloscope, self).__init__(**kwargs)
+        self.field = field
+        self.refresh_interval = refresh_interval
+        self.corruption_rate = corruption_rate
+        self.num_bins = num_bins
+        self.bin_width = bin_width
+        self.full_scale = full_scale
+        self.sample_interval = sample_interval
+        self.math_refresh_interval = math_refresh_interval or refresh_interval
+        self.settings = {
+            'HOR:RECO': str(record_length),
+            'HEAD': '1', 'VERB': '1', 'DAT:SOU': 'CH1', 'DAT:STAR': '1',
+            'DAT:STOP': '10000', 'WFMO:ENC': 'BIN', 'WFMO:BN_F': 'RI',
+            'WFMO:BYT_N': '1', 'WFMO:BYT_O': 'MSB',
+        }
+        self._start_time = time.monotonic()
+        self._fft_acquisition = None
+        self._fft = None
+        self._waveform_acquisition = None
+        self._waveform = None
+
+    def acquisitions(self):
+        return int((time.monotonic() - self._start_time) / self.refresh_interval)
+
+    def fft(self):
+        """The MATH FFT of the latest acquisition"""
+        acquisition = int((time.monotonic() - self._start_time) / self.math_refresh_interval)
+        if acquisition != self._fft_acquisition:
+            self._fft = self.field.spectrum(self.num_bins, self.bin_width, self.rng)
+            self._fft_acquisition = acquisition
+        return self._fft
+
+    def waveform(self):
+        """The CH1 record of the latest acquisition"""
+        acquisition = self.acquisitions()
+        if acquisition != self._waveform_acquisition:
+            self._waveform = self.field.waveform(
+                int(self.settings['HOR:RECO']), self.sample_interval,
+                acquisition * self.refresh_interval, self.rng)
+            self._waveform_acquisition = acquisition
+        return self._waveform
+
+    def _from_channel(self):
+        return self.settings['DAT:SOU'].upper().startswith('CH')
+
+    def _binary_scale(self):
+        """(YMUlt, YOFf, YZEro) for the current binary format"""
+        if self.settings['WFMO:BN_F'].upper().startswith('FP'):
+            return 1.0, 0.0, 0.0
+        bits = 8 * int(self.settings['WFMO:BYT_N'])
+        return self.full_scale / (2 ** (bits - 1) - 1), 0.0, 0.0
+
+    def _curve(self):
+        start = int(self.settings['DAT:STAR'])
+        stop = int(self.settings['DAT:STOP'])
+        if self._from_channel():
+            # Channel records are numbered from 1, inclusive of STOP
+            values = self.waveform()[max(start, 1) - 1:stop]
+        else:
+            values = self.fft()[start:stop]
+        corrupt = self.rng.random_sample() < self.corruption_rate
+        if self.settings['WFMO:ENC'].upper().startswith('ASC'):
+            reply = ','.join('%.6e' % v for v in values)
+            if corrupt:
+                reply = reply[:len(reply) // 2] + 'ERR' + reply[len(reply) // 2:]
+            return reply
+        ymult, yoff, yzero = self._binary_scale()
+        big_endian = self.settings['WFMO:BYT_O'].upper().startswith('MSB')
+        width = int(self.settings['WFMO:BYT_N'])
+        if self.settings['WFMO:BN_F'].upper().startswith('FP'):
+            dtype = np.dtype('f%d' % width)
+            raw = values.astype(dtype)
+        else:
+            dtype = np.dtype('i%d' % width)
+            limit = 2 ** (8 * width - 1) - 1
+            raw = np.clip(np.round((values - yzero) / ymult + yoff), -limit, limit)
+        block = binary_block(raw.astype(dtype.newbyteorder('>' if big_endian else '<')).tobytes())
+        if corrupt:
+            # Reply gets cut off halfway through
+            return block[:len(block) // 2]
+        return block
+
+    def _handle(self, path, argument, is_query):
+        if path in self.settings:
+            if is_query:
+                return self.settings[path]
+            self.settings[path] = argument
+            return None
+        if path == 'CURV':
+            return self._curve()
+        if path == 'ACQ:NUMAC':
+            return self.acquisitions()
+        if path in ('WFMO:YMU', 'WFMO:YOF', 'WFMO:YZE'):
+            ymult, yoff, yzero = self._binary_scale()
+            return {'WFMO:YMU': ymult, 'WFMO:YOF': yoff, 'WFMO:YZE': yzero}[path]
+        if path == 'WFMO:XIN':
+            return self.sample_interval if self._from_channel() else self.bin_width
+        if path == 'MATH:HOR:SCA':
+            return self.bin_width
+        if path == 'MATH:VER:SCA':
+            return self.full_scale / 5.0
+        if path == 'MATH:HOR:UNI':
+            return '"Hz"'
+        if path == 'MATH:VER:UNI':
+            return '"V"'
+        if path == '*OPC':
+            return 1
+        # Settings we don't model are accepted and ignored
+        return None
+
+
+class SimulatedSignalGenerator(SimulatedInstrument):
+    """RIGOL DG1022 lookalike that drives the acoustic field."""
+    idn = 'RIGOL TECHNOLOGIES,DG1022 ,DG1D000000001,,00.03.00.09.00.02.08'
+
+    def __init__(self, field, **kwargs):
+        super(SimulatedSignalGenerator, self).__init__(**kwargs)
+        self.field = field
+
+    def _handle(self, path, argument, is_query):
+        if path == 'APPL:SIN':
+            values = [float(v) for v in argument.split(',')]
+            frequency = values[0]
+            amplitude = values[1] if len(values) > 1 else 1.0
+            self.field.drive(frequency, amplitude)
+            return None
+        if path == 'APPL' and is_query:
+            return '"SIN,%s,%s,0"' % (self.field.frequency, self.field.drive_amplitude)
+        return None
+
+
+class SimulatedResourceManager(object):
+    """Stands in for visa.ResourceManager, handing out simulated instruments"""
+    def __init__(self, instruments):
+        """@param instruments: dict of resource name -> simulated instrument"""
+        self.instruments = instruments
+
+    def list_resources(self, query='?*::INSTR'):
+        return tuple(self.instruments)
+
+    def open_resource(self, name, **kwargs):
+        return self.instruments[name]
+
+    # Older pyvisa name for open_resource
+    get_instrument = open_resource
+
+
+def simulated_rig(field=None, scope_kwargs=None, siggen_kwargs=None):
+    """Builds a simulated oscilloscope and signal generator sharing the same
+    acoustic field.
+    @returns (SimulatedResourceManager, AcousticField)
+    """
+    field = field or AcousticField()
+    rm = SimulatedResourceManager({
+        SCOPE_RESOURCE: SimulatedOscilloscope(field, **(scope_kwargs or {})),
+        SIGGEN_RESOURCE: SimulatedSignalGenerator(field, **(siggen_kwargs or {})),
+    })
+    return rm, field
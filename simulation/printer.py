@@ -0,0 +1,170 @@
+"""Simulated CNC printer, so that whole scans can run without hardware. Moves
+are queued like they are in the printer's planner and played back with the
+trapezoidal speed profile of a printer.motion.MotionModel in a background
+thread, which moves the head through the acoustic field, so a simulated
+oscilloscope recording during a move sees the field change along the way.
+"""
+import collections
+import threading
+import time
+import numpy as np
+from printer.motion import MotionModel
+from printer.telemetry import PositionLog, Poller, TELEMETRY_INTERVAL
+from planner.program import CAPTURE, parse_words
+
+# Feedrate (mm/min) used until a move sets one, same as Marlin's default
+DEFAULT_FEEDRATE = 3000.0
+# Seconds between position updates while moving
+TICK = 0.005
+
+
+class SimulatedPrinter(object):
+    """Stands in for printer.Printer, moving the head of an AcousticField."""
+    def __init__(self, field, feedrate=DEFAULT_FEEDRATE, tick=TICK, motion='default'):
+        """
+        @param field: AcousticField whose head position we move
+        @param feedrate: mm/min for moves that don't give a speed
+        @param tick: seconds between position updates while moving
+        @param motion: MotionModel, or the name of a motion profile, that
+                       moves are played back with
+        """
+        if not isinstance(motion, MotionModel):
+            motion = MotionModel.from_profile(motion)
+        self.motion = motion
+        self.field = field
+        self.feedrate = float(feedrate)
+        self.tick = tick
+        self.serial = 'simulated'
+        self.baudrate = None
+        # Head position relative to the origin set with reset_origin
+        self.origin = np.array(field.position)
+        self._target = np.array(field.position)
+        self._moves = collections.deque()
+        self._idle = threading.Event()
+        self._idle.set()
+        self._wakeup = threading.Condition()
+        self._running = True
+        self.positions = PositionLog()
+        self._poller = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def online(self):
+        return self._running
+
+    def reset(self):
+        with self._wakeup:
+            self._moves.clear()
+            self._target = np.array(self.field.position)
+
+    def move_coord(self, x=None, y=None, z=None, speed=None):
+        """Moves x, y, z units relative to where the last queued move ends."""
+        delta = np.array([x or 0.0, y or 0.0, z or 0.0], dtype=float)
+        self._queue(self._target + delta, speed)
+
+    def move_abs(self, x=None, y=None, z=None, speed=None):
+        """Moves to (x, y, z) relative to the origin. Axes that are not given
+        stay where they are."""
+        target = self._target.copy()
+        for axis, value in enumerate((x, y, z)):
+            if value is not None:
+                target[axis] = self.origin[axis] + value
+        self._queue(target, speed)
+
+    def reset_origin(self):
+        self.origin = self._target.copy()
+
+    def wait_for_moves(self, timeout=None):
+        """Blocks until every queued move has finished.
+        @returns (bool) False if we timed out first
+        """
+        return self._idle.wait(timeout)
+
+    def run_program(self, program, on_capture, timeout=None):
+        """Runs a program from planner.program line by line, like
+        Printer.run_program. Only the commands those programs use are
+        understood: G90/G91, G0/G1, M400 and ";@capture" host commands.
+        """
+        relative = False
+        for line in program:
+            command = line.raw.strip()
+            if command.startswith(CAPTURE):
+                on_capture(command)
+                continue
+            words = parse_words(command)
+            if words.get('G') in (0, 1):
+                if 'F' in words:
+                    self.feedrate = words['F']
+                axes = [words.get(axis) for axis in 'XYZ']
+                if relative:
+                    self.move_coord(*axes)
+                else:
+                    self.move_abs(*axes)
+            elif words.get('G') == 90:
+                relative = False
+            elif words.get('G') == 91:
+                relative = True
+            elif words.get('M') == 400:
+                if not self.wait_for_moves(timeout):
+                    raise RuntimeError('Program did not finish within %s s' % timeout)
+        self.wait_for_moves(timeout)
+
+    def motion_model(self, timeout=None, fallback=None):
+        """Same as Printer.motion_model, without asking any firmware"""
+        return self.motion
+
+    def start_telemetry(self, interval=TELEMETRY_INTERVAL, autoreport=None):
+        """Logs the head position to self.positions every <interval> seconds,
+        like Printer.start_telemetry"""
+        self.stop_telemetry()
+        self._poller = Poller(self._measure, None, interval)
+
+    def stop_telemetry(self):
+        if self._poller is not None:
+            self._poller.stop()
+            self._poller = None
+
+    def _measure(self, command):
+        self.positions.append(time.monotonic(), self.field.position)
+
+    @property
+    def position(self):
+        """Current head position relative to the origin"""
+        return np.array(self.field.position) - self.origin
+
+    def disconnect(self):
+        self.stop_telemetry()
+        with self._wakeup:
+            self._running = False
+            self._wakeup.notify()
+        self._thread.join()
+
+    def _queue(self, target, speed):
+        if speed:
+            self.feedrate = float(speed)
+        with self._wakeup:
+            self._moves.append(self.motion.segment(self._target, target, self.feedrate))
+            self._target = target
+            self._idle.clear()
+            self._wakeup.notify()
+
+    def _run(self):
+        while True:
+            with self._wakeup:
+                while self._running and not self._moves:
+                    self._idle.set()
+                    self._wakeup.wait()
+                if not self._running:
+                    return
+                segment = self._moves.popleft()
+            began = time.monotonic()
+            elapsed = 0.0
+            while elapsed < segment.duration and self._running:
+                self.field.move_to(*segment.position_at(elapsed))
+                time.sleep(self.tick)
+                elapsed = time.monotonic() - began
+            self.field.move_to(*segment.end)
+
+    def __repr__(self):
+        return 'SimulatedPrinter(at (%.2f, %.2f, %.2f))' % tuple(self.position)